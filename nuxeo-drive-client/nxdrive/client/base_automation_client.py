@@ -698,7 +698,9 @@ class BaseAutomationClient(BaseClient):
                 current_action.progress += buffer_size
             yield r
 
-    def do_get(self, url, file_out=None, digest=None, digest_algorithm=None):
+    def do_get(self, url, file_out=None, digest=None, digest_algorithm=None, digests=None):
+        # digests is an optional dict filled with the hexdigest of each of its
+        # algorithms, computed while streaming the content
         h = None
         if digest is not None:
             if digest_algorithm is None:
@@ -707,6 +709,15 @@ class BaseAutomationClient(BaseClient):
             if digester is None:
                 raise ValueError('Unknow digest method: ' + digest_algorithm)
             h = digester()
+        hashers = dict()
+        if digests is not None:
+            for algorithm in digests.keys():
+                if h is not None and algorithm == digest_algorithm:
+                    continue
+                digester = getattr(hashlib, algorithm, None)
+                if digester is None:
+                    raise ValueError('Unknow digest method: ' + algorithm)
+                hashers[algorithm] = digester()
         headers = self._get_common_headers()
         base_error_message = (
             "Failed to connect to Nuxeo server %r with user %r"
@@ -739,6 +750,8 @@ class BaseAutomationClient(BaseClient):
                             f.write(buffer_)
                             if h is not None:
                                 h.update(buffer_)
+                            for hasher in hashers.itervalues():
+                                hasher.update(buffer_)
                         if self._remote_error is not None:
                             # Simulate a configurable remote (e.g. network or
                             # server) error for the tests
@@ -751,6 +764,7 @@ class BaseAutomationClient(BaseClient):
                         if os.path.exists(file_out):
                             os.remove(file_out)
                         raise CorruptedFile("Corrupted file")
+                    self._set_digests(digests, h, digest_algorithm, hashers)
                     return None, file_out
                 finally:
                     self.lock_path(file_out, locker)
@@ -760,6 +774,9 @@ class BaseAutomationClient(BaseClient):
                     h.update(result)
                     if digest is not None and digest != h.hexdigest():
                         raise CorruptedFile("Corrupted file")
+                for hasher in hashers.itervalues():
+                    hasher.update(result)
+                self._set_digests(digests, h, digest_algorithm, hashers)
                 return result, None
         except urllib2.HTTPError as e:
             if e.code == 401 or e.code == 403:
@@ -772,5 +789,13 @@ class BaseAutomationClient(BaseClient):
                 e.msg = base_error_message + ": " + e.msg
             raise
 
+    def _set_digests(self, digests, h, digest_algorithm, hashers):
+        if digests is None:
+            return
+        for algorithm, hasher in hashers.iteritems():
+            digests[algorithm] = hasher.hexdigest()
+        if h is not None:
+            digests[digest_algorithm] = h.hexdigest()
+
     def get_download_buffer(self):
         return FILE_BUFFER_SIZE
@@ -85,9 +85,12 @@ class RemoteFileSystemClient(BaseAutomationClient):
         return content
 
     def stream_content(self, fs_item_id, file_path, parent_fs_item_id=None,
-                                fs_item_info=None):
+                                fs_item_info=None, digests=None):
         """Stream the binary content of a file system item to a tmp file
 
+        The digests dict, if any, is filled with the digest of the content
+        for each of its algorithms, see do_get
+
         Raises NotFound if file system item with id fs_item_id
         cannot be found
         """
@@ -101,7 +104,8 @@ class RemoteFileSystemClient(BaseAutomationClient):
                                 + str(current_thread().ident) + DOWNLOAD_TMP_FILE_SUFFIX)
         FileAction("Download", file_out, file_name, 0)
         try:
-            _, tmp_file = self.do_get(download_url, file_out=file_out, digest=fs_item_info.digest, digest_algorithm=fs_item_info.digest_algorithm)
+            _, tmp_file = self.do_get(download_url, file_out=file_out, digest=fs_item_info.digest,
+                                      digest_algorithm=fs_item_info.digest_algorithm, digests=digests)
         except Exception as e:
             if os.path.exists(file_out):
                 os.remove(file_out)
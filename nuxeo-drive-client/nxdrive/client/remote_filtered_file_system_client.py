@@ -39,10 +39,7 @@ class RemoteFilteredFileSystemClient(RemoteFileSystemClient):
         result = super(RemoteFilteredFileSystemClient, self).get_children_info(
                                                                     fs_item_id)
         # Need to filter the children result
-        filtered = []
-        for item in result:
-            if not self.is_filtered(item.path):
-                filtered.append(item)
-            else:
-                log.debug("Filtering item %r", item)
-        return filtered
+        allowed, filtered = self._dao.split_filtered(result, lambda item: item.path)
+        for item in filtered:
+            log.debug("Filtering item %r", item)
+        return allowed
@@ -39,6 +39,7 @@ class DebugDriveApi(WebDriveApi):
                         engine.get_queue_manager().get_local_file_queue(), engine.get_dao())
         result["local_watcher"] = self._export_worker(engine._local_watcher)
         result["remote_watcher"] = self._export_worker(engine._remote_watcher)
+        result["sql"] = engine.get_dao().get_sql_stats()
         try:
             result["logs"] = self._get_logs()
         except:
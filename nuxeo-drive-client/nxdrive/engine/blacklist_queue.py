@@ -4,9 +4,110 @@ Created on 1 juil. 2015
 @author: Remi Cattiau
 '''
 from threading import Lock
+from heapq import heappush, heappop, heapify
+from itertools import count
+import random
 import time
 
 
+class RetryScheduler(object):
+    '''
+    Items waiting for their next try, in a heap by next try time.
+    The cancelled or rescheduled entries are left in the heap and skipped
+    when they reach the top.
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self._heap = []
+        # Current entry [next_try, sequence, item_id, item] by item_id
+        self._entries = dict()
+        self._sequence = count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def get_backoff(interval, count, jitter=0.1, max_delay=None):
+        # Exponential delay, randomized to avoid retrying everything at once
+        delay = interval * (2 ** (max(count, 1) - 1))
+        if max_delay is not None:
+            delay = min(delay, max_delay)
+        return delay * random.uniform(1 - jitter, 1 + jitter)
+
+    def push(self, item_id, item, next_try):
+        self._lock.acquire()
+        try:
+            self._push(item_id, item, next_try)
+        finally:
+            self._lock.release()
+
+    def _push(self, item_id, item, next_try):
+        entry = [next_try, next(self._sequence), item_id, item]
+        self._entries[item_id] = entry
+        heappush(self._heap, entry)
+
+    def cancel(self, item_id):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(item_id, None)
+            return entry[3] if entry is not None else None
+        finally:
+            self._lock.release()
+
+    def _clean_top(self):
+        while self._heap and self._entries.get(self._heap[0][2]) is not self._heap[0]:
+            heappop(self._heap)
+
+    def get_next_try(self):
+        self._lock.acquire()
+        try:
+            self._clean_top()
+            return self._heap[0][0] if self._heap else None
+        finally:
+            self._lock.release()
+
+    def pop(self, cur_time=None):
+        # First item with a next try before cur_time, None if none
+        if cur_time is None:
+            cur_time = int(time.time())
+        self._lock.acquire()
+        try:
+            self._clean_top()
+            if not self._heap or self._heap[0][0] >= cur_time:
+                return None
+            entry = heappop(self._heap)
+            del self._entries[entry[2]]
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def pop_all(self, cur_time=None):
+        items = []
+        item = self.pop(cur_time)
+        while item is not None:
+            items.append(item)
+            item = self.pop(cur_time)
+        return items
+
+    def get_items(self):
+        self._lock.acquire()
+        try:
+            return [entry[3] for entry in self._entries.itervalues()]
+        finally:
+            self._lock.release()
+
+    def release_all(self):
+        # Make every item ready now, when the connectivity is back
+        self._lock.acquire()
+        try:
+            self._heap = self._entries.values()
+            for entry in self._heap:
+                entry[0] = 0
+            heapify(self._heap)
+        finally:
+            self._lock.release()
+
+
 class BlacklistItem(object):
 
     def __init__(self, item_id, item, next_try=30):
@@ -40,17 +141,12 @@ class BlacklistItem(object):
 class BlacklistQueue(object):
 
     def __init__(self, delay=30):
-        self._queue = dict()
-        self._lock = Lock()
+        self._queue = RetryScheduler()
         self._delay = delay
 
     def push(self, id_obj, obj):
         item = BlacklistItem(item_id=id_obj, item=obj, next_try=self._delay)
-        self._lock.acquire()
-        try:
-            self._queue[item.get_id()] = item
-        finally:
-            self._lock.release()
+        self._queue.push(item.get_id(), item, item._next_try)
 
     def repush(self, item, increase_wait=True):
         if not isinstance(item, BlacklistItem):
@@ -59,19 +155,7 @@ class BlacklistQueue(object):
             item.increase()
         else:
             item.increase(next_try=self._delay)
-        self._lock.acquire()
-        try:
-            self._queue[item.get_id()] = item
-        finally:
-            self._lock.release()
+        self._queue.push(item.get_id(), item, item._next_try)
 
     def get(self):
-        cur_time = int(time.time())
-        self._lock.acquire()
-        try:
-            for item in self._queue.values():
-                if item.check(cur_time=cur_time):
-                    del self._queue[item.get_id()]
-                    return item
-        finally:
-            self._lock.release()
+        return self._queue.pop()
@@ -1,14 +1,23 @@
 import sqlite3
 import os
+import sys
+import re
 import inspect
-from threading import Lock, local, current_thread
+from threading import Lock, RLock, Thread, Event, local, current_thread
+from Queue import Queue, Empty
 from datetime import datetime
+from time import time, sleep
+from bisect import bisect_right
+from collections import deque
 from nxdrive.logging_config import get_logger
 from PyQt4.QtCore import pyqtSignal, QObject
 log = get_logger(__name__)
 
 SCHEMA_VERSION = "schema_version"
 
+# Connection pragmas that can be tuned, see ConfigurationDAO
+TUNABLE_PRAGMAS = ["cache_size", "mmap_size", "synchronous"]
+
 # Summary status from last known pair of states
 
 PAIR_STATES = {
@@ -45,6 +54,14 @@ PAIR_STATES = {
     ('deleted', 'unknown'): 'deleted_unknown',
 }
 
+# Columns of the States rows read by the scanners and the processor, the
+# error date is only read by the error queries
+STATE_COLUMNS = ("id, last_local_updated, last_remote_updated, local_digest, remote_digest, local_path,"
+                 " remote_ref, local_parent_path, remote_parent_ref, remote_parent_path, local_name, remote_name,"
+                 " size, folderish, local_state, remote_state, pair_state, remote_can_rename, remote_can_delete,"
+                 " remote_can_update, remote_can_create_child, last_remote_modifier, last_sync_date, error_count,"
+                 " last_error, version, processor, last_transfer")
+
 
 class CustomRow(sqlite3.Row):
 
@@ -70,8 +87,96 @@ class CustomRow(sqlite3.Row):
             del self._custom[name]
 
 
-class StateRow(CustomRow):
-    _custom = None
+class SlotRow(object):
+    '''
+    Row factory building a record class with __slots__ for each set of
+    columns: attributes are plain slots instead of lookups by column name.
+    Extra attributes can still be set on the row, they go in its __dict__
+    '''
+    __slots__ = ()
+    _keys = ()
+    _slots = ()
+    _indexes = dict()
+    _last_class = (None, None)
+
+    def __new__(cls, cursor, row):
+        # The description is the same object for all the rows of a query
+        description, row_class = cls._last_class
+        if description is not cursor.description:
+            row_class = cls._get_row_class(cursor.description)
+            cls._last_class = (cursor.description, row_class)
+        obj = object.__new__(row_class)
+        for name, value in zip(row_class._slots, row):
+            setattr(obj, name, value)
+        return obj
+
+    def __init__(self, cursor, row):
+        pass
+
+    @classmethod
+    def _get_row_class(cls, description):
+        keys = tuple([column[0] for column in description])
+        row_class = _row_classes.get((cls, keys))
+        if row_class is None:
+            slots = []
+            for i, key in enumerate(keys):
+                # Expressions like COUNT(*) are only available by index or key
+                if _identifier.match(key) and key not in slots:
+                    slots.append(key)
+                else:
+                    slots.append('_column_%d' % i)
+            attrs = dict(__slots__=tuple(slots) + ('__dict__',), _keys=keys, _slots=tuple(slots),
+                         _indexes=dict([(key, i) for i, key in reversed(list(enumerate(keys)))]))
+            row_class = type(cls.__name__, (cls,), attrs)
+            _row_classes[(cls, keys)] = row_class
+        return row_class
+
+    def keys(self):
+        return list(self._keys)
+
+    def __getitem__(self, key):
+        if not isinstance(key, (int, long)):
+            key = self._indexes[key]
+        return getattr(self, self._slots[key])
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __iter__(self):
+        return iter(self._get_values())
+
+    def _get_values(self):
+        return tuple([getattr(self, name) for name in self._slots])
+
+    def __eq__(self, other):
+        if not isinstance(other, SlotRow):
+            return NotImplemented
+        return self._keys == other._keys and self._get_values() == other._get_values()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self._keys) ^ hash(self._get_values())
+
+    def copy(self):
+        # Mutable copy of the row, not linked to the database
+        obj = object.__new__(self.__class__)
+        for name in self._slots:
+            setattr(obj, name, getattr(self, name))
+        obj.__dict__.update(self.__dict__)
+        return obj
+
+
+_identifier = re.compile(r'^[A-Za-z_]\w*$')
+_row_classes = dict()
+
+
+class StateRow(SlotRow):
+    __slots__ = ()
 
     def is_readonly(self):
         if self.folderish:
@@ -117,28 +222,709 @@ class FakeLock(object):
         pass
 
 
+class StatementStats(object):
+    # Latest latencies kept for the percentiles
+    MAX_SAMPLES = 1000
+
+    def __init__(self, template, sql):
+        self.template = template
+        # First statement seen, used to explain the query plan
+        self.sql = sql
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.rows = 0
+        self._samples = deque(maxlen=self.MAX_SAMPLES)
+
+    def add(self, duration, rows):
+        self.count += 1
+        self.total += duration
+        self.rows += rows
+        if duration > self.max:
+            self.max = duration
+        self._samples.append(duration)
+
+    def add_fetch(self, duration, rows):
+        # Rows fetched after the first fetch of a call
+        self.total += duration
+        self.rows += rows
+
+    def get_percentile(self, percent):
+        samples = sorted(self._samples)
+        if len(samples) == 0:
+            return 0
+        return samples[min(len(samples) - 1, len(samples) * percent / 100)]
+
+    def get_metrics(self):
+        metrics = dict()
+        metrics["template"] = self.template
+        metrics["count"] = self.count
+        metrics["rows"] = self.rows
+        # Durations in milliseconds
+        metrics["total"] = self.total * 1000
+        metrics["max"] = self.max * 1000
+        metrics["p50"] = self.get_percentile(50) * 1000
+        metrics["p99"] = self.get_percentile(99) * 1000
+        return metrics
+
+
+class SQLStats(object):
+    '''
+    Timing of the statements executed on the StatsConnection, grouped by
+    template: the statement with its literals replaced by ?
+    '''
+    # Statements kept in the template cache, the dynamic IN (...) lists can make a lot of them
+    MAX_TEMPLATES = 1000
+    LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+    def __init__(self):
+        self._lock = Lock()
+        self._templates = dict()
+        self._statements = dict()
+        self._lock_waits = dict()
+
+    def get_template(self, sql):
+        template = self._templates.get(sql)
+        if template is None:
+            template = ' '.join(self.LITERALS.sub('?', sql).split())
+            if len(self._templates) < self.MAX_TEMPLATES:
+                self._templates[sql] = template
+        return template
+
+    def add_statement(self, sql, duration, rows=0):
+        template = self.get_template(sql)
+        self._lock.acquire()
+        try:
+            statement = self._statements.get(template)
+            if statement is None:
+                statement = StatementStats(template, sql)
+                self._statements[template] = statement
+            statement.add(duration, rows)
+            return statement
+        finally:
+            self._lock.release()
+
+    def add_fetch(self, statement, duration, rows):
+        self._lock.acquire()
+        try:
+            statement.add_fetch(duration, rows)
+        finally:
+            self._lock.release()
+
+    def add_lock_wait(self, name, duration):
+        self._lock.acquire()
+        try:
+            wait = self._lock_waits.get(name)
+            if wait is None:
+                wait = self._lock_waits[name] = dict(count=0, waits=0, total=0, max=0)
+            wait["count"] += 1
+            if duration > 0:
+                wait["waits"] += 1
+                wait["total"] += duration * 1000
+                wait["max"] = max(wait["max"], duration * 1000)
+        finally:
+            self._lock.release()
+
+    def get_statements(self, limit=None):
+        # Statements ordered by cumulated time
+        self._lock.acquire()
+        try:
+            statements = sorted(self._statements.values(), key=lambda statement: statement.total, reverse=True)
+        finally:
+            self._lock.release()
+        return statements[:limit]
+
+    def get_metrics(self, limit=10):
+        metrics = dict()
+        self._lock.acquire()
+        try:
+            metrics["lock_waits"] = dict((name, dict(wait)) for name, wait in self._lock_waits.iteritems())
+        finally:
+            self._lock.release()
+        metrics["statements"] = [statement.get_metrics() for statement in self.get_statements(limit)]
+        return metrics
+
+
+class StatsCursor(sqlite3.Cursor):
+    # Rows fetched at once when iterating
+    ITER_SIZE = 256
+
+    def execute(self, sql, *args):
+        return self._timed(super(StatsCursor, self).execute, sql, args)
+
+    def executemany(self, sql, *args):
+        return self._timed(super(StatsCursor, self).executemany, sql, args)
+
+    def _timed(self, method, sql, args):
+        self._pending = None
+        self._statement = None
+        start = time()
+        try:
+            return method(sql, *args)
+        finally:
+            duration = time() - start
+            if self.description is None:
+                self._statement = self.connection.stats.add_statement(sql, duration, max(self.rowcount, 0))
+            else:
+                # The rows are computed while fetching: the call ends with the first fetch
+                self._pending = (sql, duration)
+
+    def _fetched(self, start, rows):
+        duration = time() - start
+        stats = self.connection.stats
+        pending = getattr(self, '_pending', None)
+        if pending is not None:
+            self._pending = None
+            self._statement = stats.add_statement(pending[0], pending[1] + duration, rows)
+        elif getattr(self, '_statement', None) is not None:
+            stats.add_fetch(self._statement, duration, rows)
+
+    def fetchone(self):
+        start = time()
+        row = super(StatsCursor, self).fetchone()
+        self._fetched(start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, *args):
+        start = time()
+        rows = super(StatsCursor, self).fetchmany(*args)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time()
+        rows = super(StatsCursor, self).fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.ITER_SIZE)
+            if len(rows) == 0:
+                return
+            for row in rows:
+                yield row
+
+
+class StatsConnection(sqlite3.Connection):
+    # Connection.execute goes through cursor() so it is timed too
+
+    def cursor(self, factory=StatsCursor):
+        return super(StatsConnection, self).cursor(factory)
+
+
+class StatsLock(object):
+    # Lock recording the time spent waiting for it
+    def __init__(self, stats, name, lock):
+        self._lock = lock
+        self._stats = stats
+        self._name = name
+
+    def acquire(self):
+        if self._lock.acquire(False):
+            self._stats.add_lock_wait(self._name, 0)
+            return
+        start = time()
+        self._lock.acquire()
+        self._stats.add_lock_wait(self._name, time() - start)
+
+    def release(self):
+        self._lock.release()
+
+
+class GroupCommit(object):
+    '''
+    Group the writes of a thread in one transaction, committed every
+    max_rows writes, after max_delay seconds or when leaving the context
+    '''
+    def __init__(self, dao, max_rows, max_delay):
+        self._dao = dao
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.depth = 0
+        self.rows = 0
+        self.start = None
+        self.callbacks = []
+
+    def __enter__(self):
+        self.depth = self.depth + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth = self.depth - 1
+        # Flushed on error too: the writes already done stay done, as without group
+        self._dao._end_group_commit(self)
+        return False
+
+    def add_row(self, rows=1):
+        if self.rows == 0:
+            self.start = time()
+        self.rows = self.rows + rows
+
+    def is_full(self):
+        return self.rows >= self.max_rows or time() - self.start >= self.max_delay
+
+
+class LockedConnection(object):
+    '''
+    Read access to the connection shared with the writers: the statements
+    hold the DAO lock and the row factory is set on the cursors only
+    '''
+    def __init__(self, con, lock, factory):
+        self._con = con
+        self._lock = lock
+        self._factory = factory
+
+    def cursor(self):
+        return LockedCursor(self._con.cursor(), self._lock, self._factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+class LockedCursor(object):
+    def __init__(self, cursor, lock, factory):
+        self._cursor = cursor
+        self._cursor.row_factory = factory
+        self._lock = lock
+        self._rows = deque()
+        self.rowcount = -1
+
+    def execute(self, sql, parameters=()):
+        # Fetch everything with the lock, the next statements of the writers would reset the cursor
+        self._lock.acquire()
+        try:
+            self._cursor.execute(sql, parameters)
+            self._rows = deque(self._cursor.fetchall())
+            self.rowcount = self._cursor.rowcount
+            self.description = self._cursor.description
+        finally:
+            self._lock.release()
+        return self
+
+    def fetchone(self):
+        return self._rows.popleft() if self._rows else None
+
+    def fetchmany(self, size=1):
+        return [self._rows.popleft() for _ in xrange(min(size, len(self._rows)))]
+
+    def fetchall(self):
+        rows = list(self._rows)
+        self._rows.clear()
+        return rows
+
+    def __iter__(self):
+        while self._rows:
+            yield self._rows.popleft()
+
+    def close(self):
+        self._cursor.close()
+
+
+class StateIndex(object):
+    '''
+    In-memory copy of the committed States rows, with their lookups by
+    local_path and remote_ref. Keys map to sorted tuples of ids, replaced
+    and never modified so the readers do not need any lock
+    '''
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.memory = 0
+        self._rows = dict()
+        self._local_paths = dict()
+        self._remote_refs = dict()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, row):
+        old = self._rows.get(row.id)
+        self._rows[row.id] = row
+        self._add_key(self._local_paths, row.local_path, row.id)
+        self._add_key(self._remote_refs, row.remote_ref, row.id)
+        if old is not None:
+            if old.local_path != row.local_path:
+                self._remove_key(self._local_paths, old.local_path, row.id)
+            if old.remote_ref != row.remote_ref:
+                self._remove_key(self._remote_refs, old.remote_ref, row.id)
+            self.memory = self.memory - self._get_size(old)
+        self.memory = self.memory + self._get_size(row)
+
+    def remove(self, row_id):
+        old = self._rows.pop(row_id, None)
+        if old is None:
+            return
+        self._remove_key(self._local_paths, old.local_path, row_id)
+        self._remove_key(self._remote_refs, old.remote_ref, row_id)
+        self.memory = self.memory - self._get_size(old)
+
+    def _add_key(self, keys, key, row_id):
+        ids = keys.get(key, ())
+        if row_id not in ids:
+            keys[key] = tuple(sorted(ids + (row_id,)))
+
+    def _remove_key(self, keys, key, row_id):
+        ids = tuple([i for i in keys.get(key, ()) if i != row_id])
+        if ids:
+            keys[key] = ids
+        else:
+            keys.pop(key, None)
+
+    def _get_size(self, row):
+        return sys.getsizeof(row) + sum([sys.getsizeof(value) for value in row if value is not None])
+
+    def get(self, row_id):
+        # Copy as the callers update their rows
+        row = self._rows.get(row_id)
+        if row is None:
+            return None
+        return row.copy()
+
+    def get_from_local(self, path):
+        ids = self._local_paths.get(path)
+        if not ids:
+            return None
+        row = self.get(ids[0])
+        # The row can have moved since the lookup
+        if row is None or row.local_path != path:
+            return None
+        return row
+
+    def get_from_remote(self, ref):
+        rows = [self.get(row_id) for row_id in self._remote_refs.get(ref, ())]
+        return [row for row in rows if row is not None and row.remote_ref == ref]
+
+
+class WriteFuture(object):
+    '''
+    Result of a write executed by the DAOWriter
+    '''
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._started = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+
+    def start(self):
+        # Called by the writer before executing the write, False if cancelled
+        self._lock.acquire()
+        try:
+            if self._cancelled:
+                return False
+            self._started = True
+            return True
+        finally:
+            self._lock.release()
+
+    def cancel(self):
+        # Only a write not started yet can be cancelled
+        self._lock.acquire()
+        try:
+            if self._started:
+                return False
+            self._cancelled = True
+            return True
+        finally:
+            self._lock.release()
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def result(self, timeout=None):
+        # Block until the write is committed
+        if not self._event.wait(timeout):
+            raise RuntimeError("DAO write not done after %r seconds" % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class DAOWriter(Thread):
+    '''
+    Only thread writing to the database: the writes are queued by the callers
+    and executed in batches, each batch being committed once
+    '''
+    BATCH_SIZE = 100
+    STOP_TIMEOUT = 5
+    # Wait for a write before executing it in the caller thread
+    WRITE_TIMEOUT = 30
+
+    def __init__(self, dao):
+        super(DAOWriter, self).__init__(name="DAOWriter")
+        self.daemon = True
+        self._dao = dao
+        self._queue = Queue()
+
+    def is_current(self):
+        return current_thread() is self
+
+    def submit(self, method, args=(), kwargs=None):
+        future = WriteFuture()
+        self._queue.put((method, args, kwargs or dict(), future))
+        return future
+
+    def get_queue_size(self):
+        return self._queue.qsize()
+
+    def stop(self):
+        self._queue.put(None)
+        self.join(self.STOP_TIMEOUT)
+        if self.is_alive():
+            log.warn("DAOWriter is not responding - %d writes still queued", self.get_queue_size())
+
+    def run(self):
+        while True:
+            command = self._queue.get()
+            if command is None:
+                return
+            stop = False
+            futures = []
+            try:
+                with self._dao.group_commit(max_rows=self.BATCH_SIZE):
+                    for _ in xrange(self.BATCH_SIZE):
+                        futures.append(command[3])
+                        self._execute(*command)
+                        try:
+                            command = self._queue.get_nowait()
+                        except Empty:
+                            break
+                        if command is None:
+                            stop = True
+                            break
+            except Exception as e:
+                # The commit of the batch failed, report it to the writes waiting for it
+                log.exception(e)
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            if stop:
+                return
+
+    def _execute(self, method, args, kwargs, future):
+        if not future.start():
+            return
+        try:
+            result = method(*args, **kwargs)
+        except Exception as e:
+            log.exception(e)
+            future.set_exception(e)
+            return
+        # Only give the result once committed
+        self._dao._after_commit(future.set_result, result)
+
+
+def write_behind(method):
+    # Execute the DAO method in the DAOWriter thread when there is one,
+    # unless the caller already batches its writes in a transaction or a group commit
+    def new_method(self, *args, **kwargs):
+        writer = self._writer
+        if (writer is None or writer.is_current() or not writer.is_alive() or self.in_tx is not None
+                or self._get_group_commit() is not None):
+            return method(self, *args, **kwargs)
+        future = writer.submit(method, (self,) + args, kwargs)
+        if not future.wait(writer.WRITE_TIMEOUT) and future.cancel():
+            log.warn("DAOWriter is not responding, executing %s in the caller thread", method.__name__)
+            return method(self, *args, **kwargs)
+        return future.result()
+    new_method.__name__ = method.__name__
+    new_method.__doc__ = method.__doc__
+    return new_method
+
+
+class OnlineBackup(object):
+    '''
+    Online backup of a database by steps of pages, using the sqlite3_backup
+    functions of the sqlite library as the python 2 sqlite3 module does not
+    expose them. The writers are only blocked during a step, and the backup
+    restarts by itself if the database is modified between two steps.
+    Only the library already loaded by the sqlite3 module is used: a second
+    copy of sqlite in the process would break the file locks of the first one.
+    '''
+    SQLITE_OK = 0
+    SQLITE_BUSY = 5
+    SQLITE_LOCKED = 6
+    SQLITE_DONE = 101
+    SQLITE_OPEN_READONLY = 1
+    SQLITE_OPEN_READWRITE = 2
+    SQLITE_OPEN_CREATE = 4
+    # Restarts caused by the writes before giving up
+    MAX_RESTARTS = 3
+    # Consecutive steps on a locked database before giving up
+    MAX_BUSY = 200
+    _library = None
+
+    @classmethod
+    def get_library(cls):
+        if cls._library is None:
+            cls._library = False
+            try:
+                import ctypes
+                import _sqlite3
+                if sys.platform == 'win32':
+                    # Already loaded by the sqlite3 module
+                    library = ctypes.CDLL('sqlite3')
+                else:
+                    # The symbols are resolved in the sqlite library linked to the module
+                    library = ctypes.CDLL(_sqlite3.__file__)
+                library.sqlite3_libversion.restype = ctypes.c_char_p
+                version = library.sqlite3_libversion()
+                if version != sqlite3.sqlite_version:
+                    raise TypeError("sqlite library %s differs from the sqlite3 module %s"
+                                    % (version, sqlite3.sqlite_version))
+                library.sqlite3_open_v2.argtypes = [ctypes.c_char_p, ctypes.POINTER(ctypes.c_void_p), ctypes.c_int,
+                                                    ctypes.c_char_p]
+                library.sqlite3_close.argtypes = [ctypes.c_void_p]
+                library.sqlite3_errmsg.argtypes = [ctypes.c_void_p]
+                library.sqlite3_errmsg.restype = ctypes.c_char_p
+                library.sqlite3_backup_init.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p,
+                                                        ctypes.c_char_p]
+                library.sqlite3_backup_init.restype = ctypes.c_void_p
+                library.sqlite3_backup_step.argtypes = [ctypes.c_void_p, ctypes.c_int]
+                library.sqlite3_backup_remaining.argtypes = [ctypes.c_void_p]
+                library.sqlite3_backup_pagecount.argtypes = [ctypes.c_void_p]
+                library.sqlite3_backup_finish.argtypes = [ctypes.c_void_p]
+                cls._library = library
+            except (OSError, TypeError, AttributeError, ImportError) as e:
+                log.debug("Sqlite online backup not available: %r", e)
+        return cls._library or None
+
+    @classmethod
+    def is_available(cls):
+        return cls.get_library() is not None
+
+    def __init__(self, source, destination, pages, delay):
+        self._library = self.get_library()
+        self._source = source
+        self._destination = destination
+        self._pages = pages
+        self._delay = delay
+
+    def _open(self, path, flags):
+        import ctypes
+        db = ctypes.c_void_p()
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        result = self._library.sqlite3_open_v2(path, ctypes.byref(db), flags, None)
+        if result != self.SQLITE_OK:
+            message = self._library.sqlite3_errmsg(db)
+            self._library.sqlite3_close(db)
+            raise sqlite3.OperationalError("Cannot open %r: %s" % (path, message))
+        return db
+
+    def run(self):
+        source = self._open(self._source, self.SQLITE_OPEN_READONLY)
+        try:
+            destination = self._open(self._destination, self.SQLITE_OPEN_READWRITE | self.SQLITE_OPEN_CREATE)
+            try:
+                self._copy(source, destination)
+            finally:
+                self._library.sqlite3_close(destination)
+        finally:
+            self._library.sqlite3_close(source)
+
+    def _copy(self, source, destination):
+        backup = self._library.sqlite3_backup_init(destination, "main", source, "main")
+        if backup is None:
+            raise sqlite3.OperationalError(self._library.sqlite3_errmsg(destination))
+        try:
+            steps = 1
+            restarts = 0
+            busy = 0
+            remaining = None
+            while True:
+                result = self._library.sqlite3_backup_step(backup, self._pages)
+                if result == self.SQLITE_DONE:
+                    break
+                if result in (self.SQLITE_BUSY, self.SQLITE_LOCKED):
+                    busy += 1
+                    if busy >= self.MAX_BUSY:
+                        raise sqlite3.OperationalError("Backup of %s locked for %d steps" % (self._source, busy))
+                elif result != self.SQLITE_OK:
+                    raise sqlite3.OperationalError("Backup step failed with code %d" % result)
+                else:
+                    busy = 0
+                    # A step without progress means the source was modified and the copy started again
+                    if remaining is not None and self._library.sqlite3_backup_remaining(backup) >= remaining:
+                        restarts += 1
+                        if restarts >= self.MAX_RESTARTS:
+                            # Too many writes to ever finish by steps, copying the rest at once would block them
+                            raise sqlite3.OperationalError("Backup of %s restarted %d times"
+                                                           % (self._source, restarts))
+                    remaining = self._library.sqlite3_backup_remaining(backup)
+                steps += 1
+                # Let the writers work between two steps
+                sleep(self._delay)
+            log.trace("Backup of %s done in %d steps: %d pages", self._source, steps,
+                      self._library.sqlite3_backup_pagecount(backup))
+        finally:
+            result = self._library.sqlite3_backup_finish(backup)
+        if result != self.SQLITE_OK:
+            raise sqlite3.OperationalError("Backup failed: %s" % self._library.sqlite3_errmsg(destination))
+
+
 class ConfigurationDAO(QObject):
     '''
     classdocs
     '''
 
-    def __init__(self, db):
+    # Minimum delay in seconds between two ANALYZE
+    ANALYZE_INTERVAL = 3600
+    # Free pages before an incremental vacuum, and pages reclaimed at most by each run
+    VACUUM_THRESHOLD = 1024
+    VACUUM_PAGES = 512
+    # Default flush thresholds of group_commit
+    GROUP_COMMIT_MAX_ROWS = 1000
+    GROUP_COMMIT_MAX_DELAY = 1
+    # Pages copied by each step of an online backup, and pause in seconds between two steps
+    BACKUP_PAGES = 256
+    BACKUP_SLEEP = 0.005
+
+    def __init__(self, db, wal=False, pragmas=None, max_read_connections=10, writer=False, stats=False):
         '''
         Constructor
         '''
         super(ConfigurationDAO, self).__init__()
-        log.debug("Create DAO on %s", db)
+        log.debug("Create DAO on %s (wal: %r, pragmas: %r, writer: %r, stats: %r)", db, wal, pragmas, writer, stats)
+        self._writer = None
+        # Configuration values, loaded once the database is initialized
+        self._config = None
+        self._config_changes = dict()
+        # Statements timing, see get_sql_stats
+        self._stats = SQLStats() if stats else None
         self._db = db
+        # WAL journal let the readers work while a writer commits
+        self._wal = wal
+        self._pragmas = self._get_pragmas(pragmas)
+        # Idle read connections reused by the short-lived threads
+        self._read_pool = []
+        self._read_pool_lock = Lock()
+        self._max_read_connections = max_read_connections
+        self._last_analyze = 0
+        self._group_commits = local()
         migrate = os.path.exists(self._db)
         # For testing purpose only should always be True
         self.share_connection = True
         self.auto_commit = True
         self.schema_version = self.get_schema_version()
         self.in_tx = None
-        self._tx_lock = Lock()
+        self._tx_lock = self._create_lock("tx_lock")
         # If we dont share connection no need to lock
         if self.share_connection:
-            self._lock = Lock()
+            # Reentrant as the reads of a group commit take it too, see _get_read_connection
+            self._lock = self._create_lock("lock", reentrant=True)
         else:
             self._lock = FakeLock()
         # Use to clean
@@ -157,6 +943,9 @@ class ConfigurationDAO(QObject):
                 self._migrate_db(c, schema)
         self._conn.commit()
         self._conns = local()
+        self._load_config()
+        if writer:
+            self.start_writer()
         # FOR PYTHON 3.3...
         #if log.getEffectiveLevel() < 6:
         #    self._conn.set_trace_callback(self._log_trace)
@@ -167,6 +956,26 @@ class ConfigurationDAO(QObject):
     def get_db(self):
         return self._db
 
+    def _create_lock(self, name, reentrant=False):
+        lock = RLock() if reentrant else Lock()
+        if self._stats is None:
+            return lock
+        return StatsLock(self._stats, name, lock)
+
+    def _get_pragmas(self, pragmas):
+        result = dict()
+        if self._wal:
+            # Durable enough with WAL and avoid a fsync on every commit
+            result["synchronous"] = "NORMAL"
+        if pragmas is None:
+            return result
+        for name, value in pragmas.iteritems():
+            if name not in TUNABLE_PRAGMAS or not re.match(r"^-?\w+$", str(value)):
+                log.warn("Ignore invalid sqlite pragma %s=%r", name, value)
+                continue
+            result[name] = value
+        return result
+
     def _migrate_table(self, cursor, name):
         # Add the last_transfer
         tmpname = name + 'Migration'
@@ -195,8 +1004,14 @@ class ConfigurationDAO(QObject):
             self.update_config(SCHEMA_VERSION, 1)
 
     def _init_db(self, cursor):
-        # http://www.stevemcarthur.co.uk/blog/post/some-kind-of-disk-io-error-occurred-sqlite
-        cursor.execute("PRAGMA journal_mode = MEMORY")
+        # Only applied to a new database, existing ones are switched by incremental_vacuum.
+        # Must be set before the journal mode: switching to WAL creates the database file
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        if self._wal:
+            cursor.execute("PRAGMA journal_mode = WAL")
+        else:
+            # http://www.stevemcarthur.co.uk/blog/post/some-kind-of-disk-io-error-occurred-sqlite
+            cursor.execute("PRAGMA journal_mode = MEMORY")
         self._create_configuration_table(cursor)
 
     def _create_configuration_table(self, cursor):
@@ -205,24 +1020,191 @@ class ConfigurationDAO(QObject):
     def _create_main_conn(self):
         log.debug("Create main connexion on %s (dir exists: %d / file exists: %d)",
                     self._db, os.path.exists(os.path.dirname(self._db)), os.path.exists(self._db))
-        self._conn = sqlite3.connect(self._db, check_same_thread=False)
-        self._connections.append(self._conn)
+        self._conn = self._create_connection()
+
+    def _create_connection(self):
+        # Dont check same thread for closing purpose
+        if self._stats is None:
+            con = sqlite3.connect(self._db, check_same_thread=False)
+        else:
+            con = sqlite3.connect(self._db, check_same_thread=False, factory=StatsConnection)
+            con.stats = self._stats
+        for name, value in self._pragmas.iteritems():
+            con.execute("PRAGMA %s = %s" % (name, value))
+        self._connections.append(con)
+        return con
+
+    def _acquire_read_connection(self):
+        self._read_pool_lock.acquire()
+        try:
+            if len(self._read_pool) > 0:
+                return self._read_pool.pop()
+            return self._create_connection()
+        finally:
+            self._read_pool_lock.release()
+
+    def _release_read_connection(self, con):
+        self._read_pool_lock.acquire()
+        try:
+            if con not in self._connections:
+                # Already disposed
+                return
+            if len(self._read_pool) < self._max_read_connections:
+                self._read_pool.append(con)
+                return
+            self._connections.remove(con)
+            con.close()
+        finally:
+            self._read_pool_lock.release()
+
+    def get_read_pool_size(self):
+        return len(self._read_pool)
+
+    def analyze(self, force=False):
+        # Refresh the statistics used by the query planner
+        if not force and time() - self._last_analyze < self.ANALYZE_INTERVAL:
+            return
+        self._last_analyze = time()
+        self._lock.acquire()
+        try:
+            log.trace("Analyze sqlite")
+            con = self._get_write_connection()
+            con.execute("ANALYZE")
+            self._commit(con)
+            log.trace("Analyze sqlite finished")
+        finally:
+            self._lock.release()
+
+    def _enable_incremental_vacuum(self, con):
+        # The auto_vacuum mode of an existing database is only changed by a full VACUUM,
+        # done once by the first incremental_vacuum instead of blocking the start
+        self._commit(con)
+        pages = con.execute("PRAGMA page_count").fetchone()[0]
+        log.info("Vacuum sqlite to enable the incremental vacuum: %d pages", pages)
+        start = time()
+        try:
+            con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            con.execute("VACUUM")
+        except sqlite3.OperationalError as e:
+            log.warn("Cannot vacuum sqlite to enable the incremental vacuum, retrying later: %r", e)
+            return
+        log.info("Vacuum sqlite finished in %dms: %d pages", (time() - start) * 1000,
+                 con.execute("PRAGMA page_count").fetchone()[0])
+
+    def incremental_vacuum(self, max_pages=None):
+        # Give back the free pages to the file system by steps of VACUUM_PAGES,
+        # so the lock is never held for long
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # Database created before the incremental vacuum
+                self._enable_incremental_vacuum(con)
+                return 0
+            free_pages = con.execute("PRAGMA freelist_count").fetchone()[0]
+            if free_pages < self.VACUUM_THRESHOLD:
+                return 0
+            log.trace("Incremental vacuum sqlite: %d free pages", free_pages)
+            con.execute("PRAGMA incremental_vacuum(%d)" % (max_pages or self.VACUUM_PAGES)).fetchall()
+            self._commit(con)
+            reclaimed = free_pages - con.execute("PRAGMA freelist_count").fetchone()[0]
+            log.trace("Incremental vacuum sqlite finished: %d pages reclaimed", reclaimed)
+            return reclaimed
+        finally:
+            self._lock.release()
+
+    def backup(self, path):
+        '''
+        Copy a consistent snapshot of the database to path without the DAO
+        lock, return False if the online backup is not available.
+        Raise an OperationalError if the writes keep restarting it
+        '''
+        if not OnlineBackup.is_available():
+            return False
+        OnlineBackup(self._db, path, self.BACKUP_PAGES, self.BACKUP_SLEEP).run()
+        return True
 
     def _log_trace(self, query):
         log.trace(query)
 
+    def get_sql_stats(self, limit=10, explain=5):
+        '''
+        Return the time waiting for the locks and the statements taking the
+        most time, with the query plan of the explain first ones
+        '''
+        if self._stats is None:
+            return None
+        metrics = self._stats.get_metrics(limit)
+        plans = dict()
+        for statement in self._stats.get_statements():
+            if len(plans) >= explain:
+                break
+            # Only the data statements have a plan, not the PRAGMA or COMMIT
+            if self._can_explain(statement.sql):
+                plans[statement.template] = self._explain(statement.sql)
+        for statement in metrics["statements"]:
+            if statement["template"] in plans:
+                statement["plan"] = plans[statement["template"]]
+        return metrics
+
+    def _can_explain(self, sql):
+        return sql.split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+    def _explain(self, sql):
+        # Separate connection so the plans are not part of the statistics
+        con = sqlite3.connect(self._db)
+        try:
+            # The plan does not depend on the parameters values
+            rows = con.execute("EXPLAIN QUERY PLAN " + sql, (None,) * sql.count('?')).fetchall()
+            return [row[-1] for row in rows]
+        except sqlite3.Error as e:
+            return [str(e)]
+        finally:
+            con.close()
+
+    def start_writer(self):
+        # Single writer thread for the methods marked with write_behind
+        if self._writer is None:
+            self._writer = DAOWriter(self)
+            self._writer.start()
+
+    def submit_write(self, method, *args, **kwargs):
+        '''
+        Queue a write and return its WriteFuture without waiting for it,
+        the write is done immediately if there is no writer thread
+        '''
+        future = WriteFuture()
+        if self._writer is None:
+            future.set_result(method(*args, **kwargs))
+            return future
+        return self._writer.submit(method, args, kwargs)
+
+    def get_write_queue_size(self):
+        if self._writer is None:
+            return 0
+        return self._writer.get_queue_size()
+
     def dispose(self):
         log.debug("Disposing sqlite database %r", self.get_db())
-        for con in self._connections:
-            con.close()
-        self._connections = []
-        self._conn = None
+        if self._writer is not None:
+            # Finish the queued writes first
+            self._writer.stop()
+            self._writer = None
+        self._read_pool_lock.acquire()
+        try:
+            for con in self._connections:
+                con.close()
+            self._connections = []
+            self._read_pool = []
+            self._conn = None
+        finally:
+            self._read_pool_lock.release()
 
     def dispose_thread(self):
-        if not hasattr(self._conns, '_conn'):
+        if not hasattr(self._conns, '_conn') or self._conns._conn is None:
             return
-        if self._conns._conn in self._connections:
-            self._connections.remove(self._conns._conn)
+        # Give back the connection for the next thread
+        self._release_read_connection(self._conns._conn)
         self._conns._conn = None
 
     def _get_write_connection(self, factory=CustomRow):
@@ -234,6 +1216,12 @@ class ConfigurationDAO(QObject):
         return self._get_read_connection(factory)
 
     def _get_read_connection(self, factory=CustomRow):
+        group = self._get_group_commit()
+        if group is not None and group.rows > 0:
+            # Read the writes not yet committed by the group
+            if self._conn is None:
+                self._create_main_conn()
+            return LockedConnection(self._conn, self._lock, factory)
         # If in transaction
         if self.in_tx is not None:
             if current_thread().ident != self.in_tx:
@@ -245,15 +1233,80 @@ class ConfigurationDAO(QObject):
                 # Return the write connection
                 return self._conn
         if not hasattr(self._conns, '_conn') or self._conns._conn is None:
-            # Dont check same thread for closing purpose
-            self._conns._conn = sqlite3.connect(self._db, check_same_thread=False)
-            self._connections.append(self._conns._conn)
+            self._conns._conn = self._acquire_read_connection()
         self._conns._conn.row_factory = factory
             # Python3.3 feature
             #if log.getEffectiveLevel() < 6:
             #    self._conns._conn.set_trace_callback(self._log_trace)
         return self._conns._conn
 
+    def group_commit(self, max_rows=None, max_delay=None):
+        '''
+        Return a context manager that commits the writes of the current
+        thread by batch instead of one by one:
+            with dao.group_commit():
+                ...
+        Every batch is a prefix of the writes, so a crash loses at most
+        the last uncommitted batch.
+        '''
+        group = self._get_group_commit()
+        if group is None:
+            group = GroupCommit(self, max_rows or self.GROUP_COMMIT_MAX_ROWS,
+                                max_delay or self.GROUP_COMMIT_MAX_DELAY)
+            self._group_commits.current = group
+        return group
+
+    def _get_group_commit(self):
+        return getattr(self._group_commits, 'current', None)
+
+    def _end_group_commit(self, group):
+        self._lock.acquire()
+        try:
+            self._flush_group_commit(self._get_write_connection(), group)
+        finally:
+            if group.depth == 0:
+                self._group_commits.current = None
+            self._lock.release()
+
+    def _flush_group_commit(self, con, group):
+        if group.rows > 0:
+            log.trace("Group commit of %d rows", group.rows)
+            self._commit(con)
+            group.rows = 0
+        callbacks = group.callbacks
+        group.callbacks = []
+        for method, args in callbacks:
+            method(*args)
+
+    def _commit(self, con):
+        # Must be called with the lock acquired
+        con.commit()
+        if self._config is not None and len(self._config_changes) > 0:
+            for name, value in self._config_changes.iteritems():
+                if value is None:
+                    self._config.pop(name, None)
+                else:
+                    self._config[name] = value
+            self._config_changes = dict()
+
+    def _commit_write(self, con, rows=1):
+        # Must be called with the lock acquired
+        group = self._get_group_commit()
+        if group is not None:
+            group.add_row(rows)
+            if group.is_full():
+                self._flush_group_commit(con, group)
+        elif self.auto_commit:
+            self._commit(con)
+
+    def _after_commit(self, method, *args):
+        # Delay the call until the writes of the current group are committed
+        group = self._get_group_commit()
+        if group is None:
+            method(*args)
+        else:
+            group.callbacks.append((method, args))
+
     def begin_transaction(self):
         self.auto_commit = False
         self._tx_lock.acquire()
@@ -262,7 +1315,7 @@ class ConfigurationDAO(QObject):
     def end_transaction(self):
         self.auto_commit = True
         self._lock.acquire()
-        self._get_write_connection().commit()
+        self._commit(self._get_write_connection())
         self._lock.release()
         self._tx_lock.release()
         self.in_tx = None
@@ -272,37 +1325,71 @@ class ConfigurationDAO(QObject):
             return
         self._lock.acquire()
         try:
-            self._get_write_connection().commit()
+            self._commit(self._get_write_connection())
         finally:
             self._lock.release()
 
+    def _load_config(self):
+        c = self._get_read_connection().cursor()
+        self._config = dict((row.name, row.value) for row in
+                            c.execute("SELECT name, value FROM Configuration").fetchall())
+
+    def _get_config_value(self, c, name, value):
+        # Value as read back from the VARCHAR column
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, long)):
+            return unicode(value)
+        if isinstance(value, unicode):
+            return value
+        if isinstance(value, str):
+            try:
+                return value.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        return c.execute("SELECT value FROM Configuration WHERE name=?", (name,)).fetchone().value
+
     def delete_config(self, name):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("DELETE FROM Configuration WHERE name=?", (name,))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self.update_configs({name: None})
 
     def update_config(self, name, value):
+        self.update_configs({name: value})
+
+    def update_configs(self, values):
+        '''
+        Write several configuration values in one transaction, a None value
+        deletes the configuration
+        '''
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            if value is not None:
-                c.execute("UPDATE OR IGNORE Configuration SET value=? WHERE name=?", (value,name))
-                c.execute("INSERT OR IGNORE INTO Configuration(value,name) VALUES(?,?)", (value,name))
-            else:
-                c.execute("DELETE FROM Configuration WHERE name=?", (name,))
-            if self.auto_commit:
-                con.commit()
+            updates = [(name, value) for name, value in values.iteritems() if value is not None]
+            deletes = [(name,) for name, value in values.iteritems() if value is None]
+            if len(updates) > 0:
+                c.executemany("INSERT OR REPLACE INTO Configuration(name, value) VALUES(?, ?)", updates)
+            if len(deletes) > 0:
+                c.executemany("DELETE FROM Configuration WHERE name=?", deletes)
+            # The cache is only loaded once the database is initialized, and updated on commit
+            if self._config is not None:
+                for name, value in updates:
+                    self._config_changes[name] = self._get_config_value(c, name, value)
+                for name, in deletes:
+                    self._config_changes[name] = None
+            self._commit_write(con)
         finally:
             self._lock.release()
 
+    def _has_uncommitted_writes(self):
+        if not self.auto_commit or self.in_tx == current_thread().ident:
+            return True
+        group = self._get_group_commit()
+        return group is not None and group.rows > 0
+
     def get_config(self, name, default=None):
+        # Served from the cache unless the current thread should see its uncommitted writes
+        if self._config is not None and not self._has_uncommitted_writes():
+            return self._config.get(name, default)
         c = self._get_read_connection().cursor()
         obj = c.execute("SELECT value FROM Configuration WHERE name=?",(name,)).fetchone()
         if obj is None:
@@ -327,8 +1414,7 @@ class ManagerDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("INSERT INTO Notifications(uid,engine,level,title,description,action, flags) VALUES(?,?,?,?,?,?,?)",
                       (notification.get_uid(), notification.get_engine_uid(), notification.get_level(), notification.get_title(), notification.get_description(), notification.get_action(), notification.get_flags()))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -339,8 +1425,7 @@ class ManagerDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE Notifications SET level=?, title=?, description=? WHERE uid = ?",
                       (notification.get_level(), notification.get_title(), notification.get_description(), notification.get_uid()))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -359,8 +1444,7 @@ class ManagerDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("UPDATE Notifications SET flags = (flags | " + str(Notification.FLAG_DISCARD) + ") WHERE uid=? AND (flags & " + str(Notification.FLAG_DISCARDABLE) + ") = " + str(Notification.FLAG_DISCARDABLE), (uid,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -370,8 +1454,7 @@ class ManagerDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("DELETE FROM Notifications WHERE uid=?", (uid,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -391,8 +1474,7 @@ class ManagerDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("INSERT INTO Engines(local_folder, engine, uid, name) VALUES(?,?,?,?)", (path, engine, key, name))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
             result = c.execute("SELECT * FROM Engines WHERE uid=?", (key,)).fetchone()
         finally:
             self._lock.release()
@@ -404,8 +1486,7 @@ class ManagerDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("DELETE FROM Engines WHERE uid=?", (uid,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -415,20 +1496,34 @@ class EngineDAO(ConfigurationDAO):
     classdocs
     '''
     newConflict = pyqtSignal(object)
-    def __init__(self, db):
+    # Maximum number of States rows kept by the state index
+    STATE_INDEX_MAX_ROWS = 500000
+
+    def __init__(self, db, wal=False, pragmas=None, max_read_connections=10, writer=False, state_index=False,
+                 stats=False):
         '''
         Constructor
         '''
         self._filters = None
         self._queue_manager = None
-        super(EngineDAO, self).__init__(db)
-        self._filters = self.get_filters()
+        self._state_index = None
+        super(EngineDAO, self).__init__(db, wal=wal, pragmas=pragmas, max_read_connections=max_read_connections,
+                                        writer=writer, stats=stats)
+        self._filters = self._get_filter_index()
         self.reinit_processors()
+        if state_index:
+            self.enable_state_index()
 
     def get_schema_version(self):
-        return 2
+        return 6
 
     def _migrate_db(self, cursor, version):
+        if (version < 6):
+            # Before any migration of States, which would drop the error details
+            self._create_state_errors(cursor)
+            if "last_error_details" in self._get_columns(cursor, "States"):
+                cursor.execute("INSERT OR REPLACE INTO StatesErrors(id, last_error_details)"
+                               " SELECT id, last_error_details FROM States WHERE last_error_details IS NOT NULL")
         if (version < 1):
             self._migrate_table(cursor, 'States')
             cursor.execute(u"UPDATE States SET last_transfer = 'upload' WHERE last_local_updated < last_remote_updated AND folderish=0;")
@@ -437,6 +1532,27 @@ class EngineDAO(ConfigurationDAO):
         if (version < 2):
             cursor.execute("CREATE TABLE if not exists ToRemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
             self.update_config(SCHEMA_VERSION, 2)
+        if (version < 3):
+            # States indexes are lost when the table is migrated
+            self._create_state_indexes(cursor)
+            self.update_config(SCHEMA_VERSION, 3)
+        if (version < 4):
+            # Triggers are also lost when the table is migrated
+            self._create_state_counters(cursor)
+            self._count_states(cursor)
+            self.update_config(SCHEMA_VERSION, 4)
+        if (version < 5):
+            # The incremental vacuum is enabled by the first incremental_vacuum
+            self.update_config(SCHEMA_VERSION, 5)
+        if (version < 6):
+            # Drop the error details from the States rows, they are already in StatesErrors
+            if "last_error_details" in self._get_columns(cursor, "States"):
+                self._migrate_table(cursor, 'States')
+                # Indexes and triggers are lost when the table is migrated
+                self._create_state_indexes(cursor)
+                self._create_state_counters(cursor)
+                self._create_state_errors(cursor)
+            self.update_config(SCHEMA_VERSION, 6)
 
     def _create_table(self, cursor, name, force=False):
         if name == "States":
@@ -454,7 +1570,55 @@ class EngineDAO(ConfigurationDAO):
           + "local_name VARCHAR, remote_name VARCHAR, size INTEGER DEFAULT (0), folderish INTEGER, local_state VARCHAR DEFAULT('unknown'), remote_state VARCHAR DEFAULT('unknown'),"
           + "pair_state VARCHAR DEFAULT('unknown'), remote_can_rename INTEGER, remote_can_delete INTEGER, remote_can_update INTEGER,"
           + "remote_can_create_child INTEGER, last_remote_modifier VARCHAR,"
-          + "last_sync_date TIMESTAMP, error_count INTEGER DEFAULT (0), last_sync_error_date TIMESTAMP, last_error VARCHAR, last_error_details TEXT, version INTEGER DEFAULT (0), processor INTEGER DEFAULT (0), last_transfer VARCHAR, PRIMARY KEY (id));")
+          + "last_sync_date TIMESTAMP, error_count INTEGER DEFAULT (0), last_sync_error_date TIMESTAMP, last_error VARCHAR, version INTEGER DEFAULT (0), processor INTEGER DEFAULT (0), last_transfer VARCHAR, PRIMARY KEY (id));")
+
+    def _create_state_errors(self, cursor):
+        # The error details are big and rarely read, keep them out of the States pages
+        cursor.execute("CREATE TABLE if not exists StatesErrors(id INTEGER NOT NULL, last_error_details TEXT,"
+                       " PRIMARY KEY (id))")
+        cursor.execute("CREATE TRIGGER if not exists StatesErrorsDelete AFTER DELETE ON States BEGIN"
+                       " DELETE FROM StatesErrors WHERE id=OLD.id; END")
+
+    def _create_state_indexes(self, cursor):
+        cursor.execute("CREATE INDEX if not exists StatesLocalPath ON States(local_path)")
+        cursor.execute("CREATE INDEX if not exists StatesLocalParentPath ON States(local_parent_path)")
+        cursor.execute("CREATE INDEX if not exists StatesRemoteRef ON States(remote_ref, remote_parent_path)")
+        cursor.execute("CREATE INDEX if not exists StatesRemoteParentRef ON States(remote_parent_ref, remote_name)")
+        cursor.execute("CREATE INDEX if not exists StatesPairState ON States(pair_state, folderish, last_sync_date)")
+        cursor.execute("CREATE INDEX if not exists StatesRemoteDigest ON States(remote_digest, pair_state)")
+        cursor.execute("CREATE INDEX if not exists StatesErrorCount ON States(error_count)")
+        cursor.execute("CREATE INDEX if not exists StatesLastSyncDate ON States(last_sync_date)")
+
+    def _create_state_counters(self, cursor):
+        # Number and size of the States rows for each pair_state, folderish and error_count,
+        # kept up to date by triggers so the metrics do not need to scan States
+        cursor.execute("CREATE TABLE if not exists StatesCounters(pair_state VARCHAR, folderish INTEGER,"
+                       " error_count INTEGER, total INTEGER DEFAULT (0), size INTEGER DEFAULT (0))")
+        cursor.execute("CREATE INDEX if not exists StatesCountersKey ON StatesCounters(pair_state, folderish, error_count)")
+        cursor.execute("CREATE TRIGGER if not exists StatesCountersInsert AFTER INSERT ON States BEGIN "
+                       + self._get_counter_update("NEW", "+") + " END")
+        cursor.execute("CREATE TRIGGER if not exists StatesCountersDelete AFTER DELETE ON States BEGIN "
+                       + self._get_counter_update("OLD", "-") + " END")
+        cursor.execute("CREATE TRIGGER if not exists StatesCountersUpdate AFTER UPDATE OF pair_state, folderish,"
+                       " error_count, size ON States WHEN OLD.pair_state IS NOT NEW.pair_state"
+                       " OR OLD.folderish IS NOT NEW.folderish OR OLD.error_count IS NOT NEW.error_count"
+                       " OR OLD.size IS NOT NEW.size BEGIN "
+                       + self._get_counter_update("OLD", "-") + self._get_counter_update("NEW", "+") + " END")
+
+    def _get_counter_update(self, row, sign):
+        # IS instead of = as the columns can be NULL
+        condition = (" WHERE pair_state IS %s.pair_state AND folderish IS %s.folderish"
+                     " AND error_count IS %s.error_count" % (row, row, row))
+        return ("INSERT INTO StatesCounters(pair_state, folderish, error_count) SELECT %s.pair_state, %s.folderish,"
+                " %s.error_count WHERE NOT EXISTS (SELECT 1 FROM StatesCounters%s);"
+                " UPDATE StatesCounters SET total=total%s1, size=size%sIFNULL(%s.size, 0)%s;" % (
+                    row, row, row, condition, sign, sign, row, condition))
+
+    def _count_states(self, cursor):
+        cursor.execute("DELETE FROM StatesCounters")
+        cursor.execute("INSERT INTO StatesCounters(pair_state, folderish, error_count, total, size)"
+                       " SELECT pair_state, folderish, error_count, COUNT(*), SUM(IFNULL(size, 0)) FROM States"
+                       " GROUP BY pair_state, folderish, error_count")
 
     def _init_db(self, cursor):
         super(EngineDAO, self)._init_db(cursor)
@@ -462,10 +1626,116 @@ class EngineDAO(ConfigurationDAO):
         cursor.execute("CREATE TABLE if not exists RemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
         cursor.execute("CREATE TABLE if not exists ToRemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
         self._create_state_table(cursor)
+        self._create_state_indexes(cursor)
+        self._create_state_counters(cursor)
+        self._create_state_errors(cursor)
 
     def _get_read_connection(self, factory=StateRow):
         return super(EngineDAO, self)._get_read_connection(factory)
 
+    def enable_state_index(self, max_rows=None):
+        '''
+        Keep the States rows in memory for the lookups by id, local_path and remote_ref,
+        the rows changed are tracked by temporary triggers and reloaded after each commit
+        '''
+        self._lock.acquire()
+        try:
+            return self._load_state_index(self._get_write_connection(), max_rows or self.STATE_INDEX_MAX_ROWS)
+        finally:
+            self._lock.release()
+
+    def _load_state_index(self, con, max_rows):
+        # Must be called with the lock acquired
+        self._state_index = None
+        c = con.cursor()
+        count = c.execute("SELECT COUNT(*) FROM States").fetchone()[0]
+        if count > max_rows:
+            log.info("State index disabled: %d rows is more than %d", count, max_rows)
+            return False
+        c.execute("CREATE TEMP TABLE if not exists StatesChanges(id INTEGER)")
+        c.execute("CREATE TEMP TRIGGER if not exists StatesChangesInsert AFTER INSERT ON main.States BEGIN"
+                  " INSERT INTO StatesChanges(id) VALUES(NEW.id); END")
+        c.execute("CREATE TEMP TRIGGER if not exists StatesChangesUpdate AFTER UPDATE ON main.States BEGIN"
+                  " INSERT INTO StatesChanges(id) VALUES(NEW.id); END")
+        c.execute("CREATE TEMP TRIGGER if not exists StatesChangesDelete AFTER DELETE ON main.States BEGIN"
+                  " INSERT INTO StatesChanges(id) VALUES(OLD.id); END")
+        c.execute("DELETE FROM StatesChanges")
+        index = StateIndex(max_rows)
+        for row in c.execute("SELECT " + STATE_COLUMNS + " FROM States"):
+            index.add(row)
+        con.commit()
+        self._state_index = index
+        log.debug("State index loaded: %d rows, %d bytes", len(index), index.memory)
+        return True
+
+    def disable_state_index(self):
+        self._lock.acquire()
+        try:
+            self._state_index = None
+            c = self._get_write_connection().cursor()
+            c.execute("DROP TRIGGER if exists StatesChangesInsert")
+            c.execute("DROP TRIGGER if exists StatesChangesUpdate")
+            c.execute("DROP TRIGGER if exists StatesChangesDelete")
+            c.execute("DROP TABLE if exists StatesChanges")
+        finally:
+            self._lock.release()
+
+    def dispose(self):
+        self._state_index = None
+        super(EngineDAO, self).dispose()
+
+    def _commit(self, con):
+        super(EngineDAO, self)._commit(con)
+        if self._state_index is not None:
+            self._refresh_state_index(con)
+
+    def _refresh_state_index(self, con):
+        # Reload the rows changed by the last commit
+        index = self._state_index
+        c = con.cursor()
+        ids = [row[0] for row in c.execute("SELECT DISTINCT id FROM StatesChanges").fetchall()]
+        if not ids:
+            return
+        c.execute("DELETE FROM StatesChanges")
+        con.commit()
+        for i in xrange(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            found = set()
+            for row in c.execute("SELECT " + STATE_COLUMNS + " FROM States WHERE id IN (" + ','.join(['?'] * len(chunk)) + ")", chunk):
+                index.add(row)
+                found.add(row.id)
+            for row_id in chunk:
+                if row_id not in found:
+                    index.remove(row_id)
+        if len(index) > index.max_rows:
+            log.info("State index disabled: more than %d rows", index.max_rows)
+            self._state_index = None
+
+    def _get_state_index(self):
+        # The index only knows the committed rows
+        index = self._state_index
+        if index is None or self.in_tx is not None:
+            return None
+        group = self._get_group_commit()
+        if group is not None and group.rows > 0:
+            return None
+        return index
+
+    def get_metrics(self):
+        metrics = dict()
+        metrics["write_queue_size"] = self.get_write_queue_size()
+        index = self._state_index
+        if index is not None:
+            metrics["state_index_rows"] = len(index)
+            metrics["state_index_memory"] = index.memory
+        # The SQL stats are added by the Engine metrics, see get_sql_stats
+        return metrics
+
+    def _get_write_connection(self, factory=StateRow):
+        # Always the same factory as the write connection can be read by a group commit
+        return super(EngineDAO, self)._get_write_connection(factory)
+
+    @write_behind
     def release_processor(self, processor_id):
         self._lock.acquire()
         try:
@@ -473,21 +1743,20 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             # TO_REVIEW Might go back to primary key id
             c.execute("UPDATE States SET processor=0 WHERE processor=?", (processor_id,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
             log.trace('Released processor %d', processor_id)
         finally:
             self._lock.release()
         return c.rowcount == 1
 
+    @write_behind
     def acquire_processor(self, thread_id, row_id):
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("UPDATE States SET processor=? WHERE id=? AND processor=0", (thread_id, row_id))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
             log.trace('Acquired processor %d for row %d', thread_id, row_id)
         finally:
             self._lock.release()
@@ -499,11 +1768,16 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("DROP TABLE States")
+            c.execute("DELETE FROM StatesErrors")
             self._create_state_table(c, force=True)
+            self._create_state_indexes(c)
+            self._create_state_counters(c)
+            self._create_state_errors(c)
+            self._count_states(c)
             con.commit()
-            log.trace("Vacuum sqlite")
-            con.execute("VACUUM")
-            log.trace("Vacuum sqlite finished")
+            if self._state_index is not None:
+                # The temporary triggers are dropped with the table
+                self._load_state_index(con, self._state_index.max_rows)
         finally:
             self._lock.release()
 
@@ -514,11 +1788,7 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET processor=0")
             c.execute("UPDATE States SET error_count=0, last_sync_error_date=NULL, last_error = NULL WHERE pair_state='synchronized'")
-            if self.auto_commit:
-                con.commit()
-            log.trace("Vacuum sqlite")
-            con.execute("VACUUM")
-            log.trace("Vacuum sqlite finished")
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -531,11 +1801,12 @@ class EngineDAO(ConfigurationDAO):
             c.execute(update + " WHERE id=?", ('remotely_deleted',doc_pair.id))
             if doc_pair.folderish:
                 # TO_REVIEW New state recursive_remotely_deleted
-                c.execute(update + self._get_recursive_condition(doc_pair), ('parent_remotely_deleted',))
+                c.execute(update + self._get_recursive_condition(doc_pair),
+                          ('parent_remotely_deleted',) + self._get_recursive_params(doc_pair))
             # Only queue parent
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted')
-            if self.auto_commit:
-                con.commit()
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted',
+                                   fields=self._get_queue_fields(doc_pair))
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -545,7 +1816,7 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             # Check parent to see current pair state
-            parent = c.execute("SELECT * FROM States WHERE local_path=?", (doc_pair.local_parent_path,)).fetchone()
+            parent = c.execute("SELECT pair_state FROM States WHERE local_path=?", (doc_pair.local_parent_path,)).fetchone()
             if parent is not None and (parent.pair_state == 'locally_deleted' or parent.pair_state == 'parent_locally_deleted'):
                 current_state = 'parent_locally_deleted'
             else:
@@ -554,12 +1825,13 @@ class EngineDAO(ConfigurationDAO):
             c.execute(update + " WHERE id=?", (current_state, doc_pair.id))
             if doc_pair.folderish:
                 # TO_REVIEW New state recursive_locally_deleted
-                c.execute(update + self._get_recursive_condition(doc_pair), ('parent_locally_deleted',))
+                c.execute(update + self._get_recursive_condition(doc_pair),
+                          ('parent_locally_deleted',) + self._get_recursive_params(doc_pair))
             # Only queue parent
             if current_state == "locally_deleted":
-                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state)
-            if self.auto_commit:
-                con.commit()
+                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state,
+                                       fields=self._get_queue_fields(doc_pair))
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -576,16 +1848,62 @@ class EngineDAO(ConfigurationDAO):
                       + " VALUES(?,?,?,?,?,?,?,'created','unknown',?)", (info.last_modification_time, digest, info.path,
                                                     parent_path, name, info.folderish, info.size, pair_state))
             row_id = c.lastrowid
-            parent = c.execute("SELECT * FROM States WHERE local_path=?", (parent_path,)).fetchone()
+            parent = c.execute("SELECT pair_state FROM States WHERE local_path=?", (parent_path,)).fetchone()
             # Dont queue if parent is not yet created
             if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
-            if self.auto_commit:
-                con.commit()
+                self._queue_pair_state(row_id, info.folderish, pair_state, fields=self._get_queue_fields(
+                    None, local_path=info.path, size=info.size, last_local_updated=info.last_modification_time))
+            self._commit_write(con)
         finally:
             self._lock.release()
         return row_id
 
+    @write_behind
+    def insert_local_states(self, infos, parent_path, digests=None):
+        '''
+        Same as insert_local_state for several children of parent_path,
+        return the ids of the new rows in the same order as infos
+
+        digests, if any, are the already computed digests of infos
+        '''
+        if not infos:
+            return []
+        if digests is None:
+            digests = [info.get_digest() for info in infos]
+        pair_state = PAIR_STATES.get(('created', 'unknown'))
+        values = [(info.last_modification_time, digest, info.path, parent_path,
+                   os.path.basename(info.path), info.folderish, info.size, pair_state)
+                  for info, digest in zip(infos, digests)]
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            row_ids = self._insert_states(c, "INSERT INTO States(last_local_updated, local_digest, "
+                      + "local_path, local_parent_path, local_name, folderish, size, local_state, remote_state, pair_state)"
+                      + " VALUES(?,?,?,?,?,?,?,'created','unknown',?)", values)
+            parent = c.execute("SELECT pair_state FROM States WHERE local_path=?", (parent_path,)).fetchone()
+            # Dont queue if parent is not yet created
+            if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
+                for row_id, info in zip(row_ids, infos):
+                    self._queue_pair_state(row_id, info.folderish, pair_state, fields=self._get_queue_fields(
+                        None, local_path=info.path, size=info.size, last_local_updated=info.last_modification_time))
+            self._commit_write(con, len(row_ids))
+        finally:
+            self._lock.release()
+        return row_ids
+
+    def _insert_states(self, c, query, values):
+        # executemany does not give the new ids, but they are all greater than the
+        # previous maximum as the lock is held
+        last_id = c.execute("SELECT IFNULL(MAX(id), 0) FROM States").fetchone()[0]
+        try:
+            c.executemany(query, values)
+        except:
+            # Remove the rows inserted before the failure so the caller can retry them one by one
+            c.execute("DELETE FROM States WHERE id > ?", (last_id,))
+            raise
+        return [row[0] for row in c.execute("SELECT id FROM States WHERE id > ? ORDER BY id", (last_id,)).fetchall()]
+
     def get_last_files(self, number, direction=""):
         c = self._get_read_connection(factory=StateRow).cursor()
         condition = ""
@@ -599,28 +1917,41 @@ class EngineDAO(ConfigurationDAO):
         return "pair_state != 'synchronized' AND pair_state != 'unsynchronized'"
 
     def register_queue_manager(self, manager):
-        # Prevent any update while init queue
-        self._lock.acquire()
-        con = None
-        try:
-            self._queue_manager = manager
-            con = self._get_write_connection(factory=StateRow)
-            c = con.cursor()
-            # Order by path to be sure to process parents before childs
-            pairs = c.execute("SELECT * FROM States WHERE " + self._get_to_sync_condition() + " ORDER BY local_path ASC").fetchall()
-            folders = dict()
-            for pair in pairs:
-                # Add all the folders
-                if pair.folderish:
-                    folders[pair.local_path] = True
-                if not  pair.local_parent_path in folders:
-                    self._queue_manager.push_ref(pair.id, pair.folderish, pair.pair_state)
-        # Dont block everything if queue manager fail
-        # TODO As the error should be fatal not sure we need this
-        finally:
-            self._lock.release()
+        # The queues are filled lazily from the database by get_queue_window
+        self._queue_manager = manager
+        manager.init_queue_windows()
 
-    def _queue_pair_state(self, row_id, folderish, pair_state, pair=None):
+    def get_queue_window(self, condition, last_path, last_id, limit):
+        '''
+        Return the next pairs to synchronize matching condition, ordered by
+        local_path then id and after (last_path, last_id).
+        The childs of a folder to synchronize are queued once it is synchronized,
+        and the pairs in error by the error queue of the QueueManager
+        '''
+        c = self._get_read_connection(factory=StateRow).cursor()
+        # Order by path to be sure to process parents before childs
+        query = ("SELECT id, folderish, pair_state, local_path, remote_ref, size, last_local_updated,"
+                 " last_remote_updated FROM States WHERE " + self._get_to_sync_condition()
+                 + " AND " + condition + " AND processor = 0 AND error_count = 0"
+                 " AND local_path >= ? AND (local_path > ? OR id > ?)"
+                 " AND NOT EXISTS (SELECT 1 FROM States AS parent WHERE parent.local_path = States.local_parent_path"
+                 " AND parent.folderish = 1 AND parent.pair_state != 'synchronized'"
+                 " AND parent.pair_state != 'unsynchronized')"
+                 " ORDER BY local_path, id LIMIT ?")
+        return c.execute(query, (last_path, last_path, last_id, limit)).fetchall()
+
+    def _queue_pair_state(self, row_id, folderish, pair_state, pair=None, fields=None):
+        # fields are the values of the pair used by the queue priorities, see _get_queue_fields
+        self._after_commit(self._push_pair_state, row_id, folderish, pair_state, pair, fields)
+
+    def _get_queue_fields(self, row, **fields):
+        # The fields not given are taken from row, which can be None
+        for name in ("local_path", "remote_ref", "size", "last_local_updated", "last_remote_updated"):
+            if name not in fields:
+                fields[name] = getattr(row, name, None)
+        return fields
+
+    def _push_pair_state(self, row_id, folderish, pair_state, pair=None, fields=None):
         if (self._queue_manager is not None
              and pair_state != 'synchronized' and pair_state != 'unsynchronized'):
             if pair_state == 'conflicted':
@@ -628,7 +1959,7 @@ class EngineDAO(ConfigurationDAO):
                 self.newConflict.emit(row_id)
             else:
                 log.trace("Push to queue: %s: %r", pair_state, pair)
-                self._queue_manager.push_ref(row_id, folderish, pair_state)
+                self._queue_manager.push_ref(row_id, folderish, pair_state, **(fields or dict()))
         else:
             log.trace("Will not push pair: %s: %r", pair_state, pair)
         return
@@ -636,17 +1967,18 @@ class EngineDAO(ConfigurationDAO):
     def _get_pair_state(self, row):
         return PAIR_STATES.get((row.local_state, row.remote_state))
 
+    @write_behind
     def update_last_transfer(self, row_id, transfer):
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("UPDATE States SET last_transfer=? WHERE id=?", (transfer, row_id))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
+    @write_behind
     def update_local_state(self, row, info, versionned=True, queue=True):
         pair_state = self._get_pair_state(row)
         version = ''
@@ -664,29 +1996,29 @@ class EngineDAO(ConfigurationDAO):
                                         os.path.basename(info.path), row.local_state, info.size, row.remote_state,
                                         pair_state, row.id))
             if queue:
-                self._queue_pair_state(row.id, info.folderish, pair_state, row)
-            if self.auto_commit:
-                con.commit()
+                self._queue_pair_state(row.id, info.folderish, pair_state, row, fields=self._get_queue_fields(
+                    row, local_path=info.path, size=info.size, last_local_updated=info.last_modification_time))
+            self._commit_write(con)
         finally:
             self._lock.release()
 
     def get_valid_duplicate_file(self, digest):
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_digest=? AND pair_state='synchronized'", (digest,)).fetchone()
+        return c.execute("SELECT " + STATE_COLUMNS + " FROM States WHERE remote_digest=? AND pair_state='synchronized'", (digest,)).fetchone()
 
     def get_remote_children(self, ref):
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_ref=?", (ref,)).fetchall()
+        return c.execute("SELECT " + STATE_COLUMNS + " FROM States WHERE remote_parent_ref=?", (ref,)).fetchall()
 
     def get_conflict_count(self):
-        return self.get_count("pair_state='conflicted'")
+        return self._get_counter("pair_state='conflicted'")
 
     def get_error_count(self, threshold=3):
-        return self.get_count("error_count > " + str(threshold))
+        return self._get_counter("error_count > " + str(int(threshold)))
 
     def get_syncing_count(self):
         query = "pair_state!='synchronized' AND pair_state!='conflicted' AND pair_state!='unsynchronized'"
-        return self.get_count(query)
+        return self._get_counter(query)
 
     def get_sync_count(self, filetype=None):
         query = "pair_state='synchronized'"
@@ -694,7 +2026,13 @@ class EngineDAO(ConfigurationDAO):
             query = query + " AND folderish=0"
         elif filetype == "folder":
             query = query + " AND folderish=1"
-        return self.get_count(query)
+        return self._get_counter(query)
+
+    def _get_counter(self, condition):
+        # Same as get_count but read from the StatesCounters groups
+        c = self._get_read_connection(factory=StateRow).cursor()
+        return c.execute("SELECT IFNULL(SUM(total), 0) as count FROM StatesCounters WHERE "
+                         + condition).fetchone().count
 
     def get_count(self, condition=None):
         query = "SELECT COUNT(*) as count FROM States"
@@ -705,23 +2043,28 @@ class EngineDAO(ConfigurationDAO):
 
     def get_global_size(self):
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT SUM(size) as sum FROM States WHERE pair_state='synchronized'").fetchone().sum
+        return c.execute("SELECT SUM(size) as sum FROM StatesCounters WHERE pair_state='synchronized'").fetchone().sum
 
-    def get_conflicts(self):
+    def _get_states_with_errors(self, condition, params=()):
+        # States rows with their error details
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE pair_state='conflicted'").fetchall()
+        return c.execute("SELECT States.*, StatesErrors.last_error_details FROM States"
+                         " LEFT JOIN StatesErrors ON StatesErrors.id = States.id WHERE " + condition, params).fetchall()
+
+    def get_conflicts(self):
+        return self._get_states_with_errors("pair_state='conflicted'")
 
     def get_errors(self, limit=3):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE error_count>?", (limit,)).fetchall()
+        return self._get_states_with_errors("error_count>?", (limit,))
 
     def get_local_children(self, path):
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE local_parent_path=?", (path,)).fetchall()
+        return c.execute("SELECT " + STATE_COLUMNS + " FROM States WHERE local_parent_path=?", (path,)).fetchall()
 
     def get_states_from_partial_local(self, path):
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE local_path LIKE ?", (path + '%',)).fetchall()
+        return c.execute("SELECT " + STATE_COLUMNS + " FROM States WHERE local_path >= ? AND local_path < ?",
+                         (path, self._get_prefix_upper_bound(path))).fetchall()
 
     def get_first_state_from_partial_remote(self, ref):
         c = self._get_read_connection(factory=StateRow).cursor()
@@ -740,31 +2083,51 @@ class EngineDAO(ConfigurationDAO):
         if path == '/':
             path = ""
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_ref=? AND remote_parent_path=?", (ref,path)).fetchone()
+        return c.execute("SELECT " + STATE_COLUMNS + " FROM States WHERE remote_ref=? AND remote_parent_path=?", (ref,path)).fetchone()
 
     def get_states_from_remote(self, ref):
+        index = self._get_state_index()
+        if index is not None:
+            return index.get_from_remote(ref)
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_ref=?", (ref,)).fetchall()
+        return c.execute("SELECT " + STATE_COLUMNS + " FROM States WHERE remote_ref=?", (ref,)).fetchall()
 
     def get_state_from_id(self, row_id, from_write=False):
         # Dont need to read from write as auto_commit is True
         if from_write and self.auto_commit:
             from_write = False
+        index = self._get_state_index()
+        if index is not None and not from_write:
+            return index.get(row_id)
         try:
             if from_write:
                 self._lock.acquire()
                 c = self._get_write_connection(factory=StateRow).cursor()
             else:
                 c = self._get_read_connection(factory=StateRow).cursor()
-            state = c.execute("SELECT * FROM States WHERE id=?", (row_id,)).fetchone()
+            state = c.execute("SELECT " + STATE_COLUMNS + " FROM States WHERE id=?", (row_id,)).fetchone()
         finally:
             if from_write:
                 self._lock.release()
         return state
 
+    def _get_prefix_upper_bound(self, prefix):
+        # Smallest string greater than every string starting with prefix,
+        # allows prefix searches as an indexed range instead of a LIKE
+        if not prefix:
+            return u'\U0010ffff'
+        return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
     def _get_recursive_condition(self, doc_pair):
-        return (" WHERE local_parent_path LIKE '" + self._escape(doc_pair.local_path) + "/%'"
-                    + " OR local_parent_path = '" + self._escape(doc_pair.local_path) + "'")
+        # The descendants are the single range of local_path starting with the folder path,
+        # to be used with _get_recursive_params
+        return " WHERE local_path > ? AND local_path < ?"
+
+    def _get_recursive_params(self, doc_pair):
+        prefix = doc_pair.local_path
+        if not prefix.endswith('/'):
+            prefix = prefix + '/'
+        return (prefix, self._get_prefix_upper_bound(prefix))
 
     def update_remote_parent_path(self, doc_pair, new_path):
         self._lock.acquire()
@@ -773,14 +2136,15 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             if doc_pair.folderish:
                 remote_path = doc_pair.remote_parent_path + "/" + doc_pair.remote_ref
-                query = "UPDATE States SET remote_parent_path='%s/%s' || substr(remote_parent_path,%d)" % (
-                    self._escape(new_path), self._escape(doc_pair.remote_ref), len(remote_path) + 1)
+                # Rewrite the prefix of the whole subtree in one indexed range update,
+                # still one row write per descendant as the rows store their full paths
+                query = "UPDATE States SET remote_parent_path=? || substr(remote_parent_path,?)"
                 query = query + self._get_recursive_condition(doc_pair)
                 log.trace("Update remote_parent_path: " + query)
-                c.execute(query)
+                c.execute(query, (new_path + '/' + doc_pair.remote_ref, len(remote_path) + 1)
+                                 + self._get_recursive_params(doc_pair))
             c.execute("UPDATE States SET remote_parent_path=? WHERE id=?", (new_path, doc_pair.id))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -790,8 +2154,7 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("UPDATE States SET local_parent_path=?, local_path=? WHERE id=?", (doc_pair.local_parent_path, doc_pair.local_path, doc_pair.id))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -803,17 +2166,17 @@ class EngineDAO(ConfigurationDAO):
             if doc_pair.folderish:
                 if new_path == '/':
                     new_path = ''
-                escaped_new_path = self._escape(new_path)
-                escaped_new_name = self._escape(new_name)
-                query = ("UPDATE States SET local_parent_path='%s/%s' || substr(local_parent_path,%d), local_path='%s/%s' || substr(local_path,%d)" %
-                         (escaped_new_path, escaped_new_name, len(doc_pair.local_path) + 1,
-                          escaped_new_path, escaped_new_name, len(doc_pair.local_path)+1))
+                new_prefix = new_path + '/' + new_name
+                # Rewrite the prefix of the whole subtree in one indexed range update,
+                # still one row write per descendant as the rows store their full paths
+                query = ("UPDATE States SET local_parent_path=? || substr(local_parent_path,?),"
+                         " local_path=? || substr(local_path,?)")
                 query = query + self._get_recursive_condition(doc_pair)
-                c.execute(query)
+                c.execute(query, (new_prefix, len(doc_pair.local_path) + 1, new_prefix, len(doc_pair.local_path) + 1)
+                                 + self._get_recursive_params(doc_pair))
             # Dont need to update the path as it is refresh later
             c.execute("UPDATE States SET local_parent_path=? WHERE id=?", (new_path, doc_pair.id))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -825,10 +2188,10 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state='deleted', pair_state='remotely_deleted'"
             c.execute(update + " WHERE id=?", (doc_pair.id,))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+                c.execute(update + self._get_recursive_condition(doc_pair), self._get_recursive_params(doc_pair))
+            self._commit_write(con)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state,
+                                   fields=self._get_queue_fields(doc_pair))
         finally:
             self._lock.release()
 
@@ -840,10 +2203,10 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state='created', pair_state='remotely_created'"
             c.execute(update + " WHERE id=" + str(doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+                c.execute(update + self._get_recursive_condition(doc_pair), self._get_recursive_params(doc_pair))
+            self._commit_write(con)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state,
+                                   fields=self._get_queue_fields(doc_pair))
         finally:
             self._lock.release()
 
@@ -855,13 +2218,14 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET remote_digest=NULL, remote_ref=NULL, remote_parent_ref=NULL, remote_parent_path=NULL, last_remote_updated=NULL, remote_name=NULL, remote_state='unknown', local_state='created', pair_state='locally_created'"
             c.execute(update + " WHERE id=" + str(doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+                c.execute(update + self._get_recursive_condition(doc_pair), self._get_recursive_params(doc_pair))
+            self._commit_write(con)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state,
+                                   fields=self._get_queue_fields(doc_pair))
         finally:
             self._lock.release()
 
+    @write_behind
     def remove_state(self, doc_pair):
         self._lock.acquire()
         try:
@@ -869,15 +2233,18 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("DELETE FROM States WHERE id=?", (doc_pair.id,))
             if doc_pair.folderish:
-                c.execute("DELETE FROM States" + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
+                c.execute("DELETE FROM States" + self._get_recursive_condition(doc_pair),
+                          self._get_recursive_params(doc_pair))
+            self._commit_write(con)
         finally:
             self._lock.release()
 
     def get_state_from_local(self, path):
+        index = self._get_state_index()
+        if index is not None:
+            return index.get_from_local(path)
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE local_path=?", (path,)).fetchone()
+        return c.execute("SELECT " + STATE_COLUMNS + " FROM States WHERE local_path=?", (path,)).fetchone()
 
     def insert_remote_state(self, info, remote_parent_path, local_path, local_parent_path):
         pair_state = PAIR_STATES.get(('unknown','created'))
@@ -896,55 +2263,94 @@ class EngineDAO(ConfigurationDAO):
                        info.can_create_child, info.last_contributor, info.digest, info.folderish, info.last_contributor,
                        local_path, local_parent_path, pair_state))
             row_id = c.lastrowid
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
             # Check if parent is not in creation
-            parent = c.execute("SELECT * FROM States WHERE local_path=?", (local_parent_path,)).fetchone()
+            parent = c.execute("SELECT pair_state FROM States WHERE local_path=?", (local_parent_path,)).fetchone()
             if (parent is None and local_parent_path == '') or (parent is not None and parent.pair_state != "remotely_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
+                self._queue_pair_state(row_id, info.folderish, pair_state, fields=self._get_queue_fields(
+                    None, local_path=local_path, remote_ref=info.uid, last_remote_updated=info.last_modification_time))
         finally:
             self._lock.release()
         return row_id
 
+    @write_behind
+    def insert_remote_states(self, infos, remote_parent_path, local_paths, local_parent_path):
+        '''
+        Same as insert_remote_state for several children of the same folder,
+        return the ids of the new rows in the same order as infos
+        '''
+        if not infos:
+            return []
+        pair_state = PAIR_STATES.get(('unknown','created'))
+        values = [(info.uid, info.parent_uid, remote_parent_path, info.name,
+                   info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
+                   info.can_create_child, info.last_contributor, info.digest, info.folderish, info.last_contributor,
+                   local_path, local_parent_path, pair_state) for info, local_path in zip(infos, local_paths)]
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            row_ids = self._insert_states(c, "INSERT INTO States (remote_ref, remote_parent_ref, " +
+                      "remote_parent_path, remote_name, last_remote_updated, remote_can_rename," +
+                      "remote_can_delete, remote_can_update, " +
+                      "remote_can_create_child, last_remote_modifier, remote_digest," +
+                      "folderish, last_remote_modifier, local_path, local_parent_path, remote_state, local_state, pair_state)" +
+                      " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,'created','unknown',?)", values)
+            self._commit_write(con, len(row_ids))
+            # Check if parent is not in creation
+            parent = c.execute("SELECT pair_state FROM States WHERE local_path=?", (local_parent_path,)).fetchone()
+            if (parent is None and local_parent_path == '') or (parent is not None and parent.pair_state != "remotely_created"):
+                for row_id, info, local_path in zip(row_ids, infos, local_paths):
+                    self._queue_pair_state(row_id, info.folderish, pair_state, fields=self._get_queue_fields(
+                        None, local_path=local_path, remote_ref=info.uid, last_remote_updated=info.last_modification_time))
+        finally:
+            self._lock.release()
+        return row_ids
+
     def queue_children(self, row):
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            children = c.execute("SELECT * FROM States WHERE remote_parent_ref=? or local_parent_path=? AND " +
+            children = c.execute("SELECT " + STATE_COLUMNS + " FROM States WHERE remote_parent_ref=? or local_parent_path=? AND " +
                                     self._get_to_sync_condition(), (row.remote_ref, row.local_path)).fetchall()
             log.debug("Queuing %d children of '%r'", len(children), row)
             for child in children:
-                self._queue_pair_state(child.id, child.folderish, child.pair_state)
+                self._queue_pair_state(child.id, child.folderish, child.pair_state, fields=self._get_queue_fields(child))
         finally:
             self._lock.release()
 
+    @write_behind
     def increase_error(self, row, error, details=None, incr=1):
         error_date = datetime.utcnow()
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("UPDATE States SET last_error=?, last_sync_error_date=?, error_count = error_count + ?, last_error_details=? " +
-                      "WHERE id=?", (error, error_date, incr, details, row.id))
-            if self.auto_commit:
-                con.commit()
+            c.execute("UPDATE States SET last_error=?, last_sync_error_date=?, error_count = error_count + ? " +
+                      "WHERE id=?", (error, error_date, incr, row.id))
+            if details is not None:
+                c.execute("INSERT OR REPLACE INTO StatesErrors(id, last_error_details) VALUES(?, ?)", (row.id, details))
+            else:
+                c.execute("DELETE FROM StatesErrors WHERE id=?", (row.id,))
+            self._commit_write(con)
         finally:
             self._lock.release()
         row.last_error = error
         row.error_count = row.error_count + incr
         row.last_sync_error_date = error_date
 
+    @write_behind
     def reset_error(self, row):
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("UPDATE States SET last_error=NULL, last_error_details=NULL, last_sync_error_date=NULL, error_count = 0" +
+            c.execute("UPDATE States SET last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
                       " WHERE id=?", (row.id,))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(row.id, row.folderish, row.pair_state)
+            c.execute("DELETE FROM StatesErrors WHERE id=?", (row.id,))
+            self._commit_write(con)
+            self._queue_pair_state(row.id, row.folderish, row.pair_state, fields=self._get_queue_fields(row))
         finally:
             self._lock.release()
         row.last_error = None
@@ -958,9 +2364,8 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET local_state='synchronized', remote_state='modified', pair_state='remotely_modified', last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
                       " WHERE id=? AND version=?", (row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, "remotely_modified")
-            if self.auto_commit:
-                con.commit()
+            self._queue_pair_state(row.id, row.folderish, "remotely_modified", fields=self._get_queue_fields(row))
+            self._commit_write(con)
         finally:
             self._lock.release()
         return c.rowcount == 1
@@ -972,13 +2377,13 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET local_state='created', remote_state='unknown', pair_state='locally_created', last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
                       " WHERE id=? AND version=?", (row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, "locally_created")
-            if self.auto_commit:
-                con.commit()
+            self._queue_pair_state(row.id, row.folderish, "locally_created", fields=self._get_queue_fields(row))
+            self._commit_write(con)
         finally:
             self._lock.release()
         return c.rowcount == 1
 
+    @write_behind
     def set_conflict_state(self, row):
         self._lock.acquire()
         try:
@@ -987,12 +2392,12 @@ class EngineDAO(ConfigurationDAO):
             c.execute("UPDATE States SET pair_state='conflicted' WHERE id=?",
                       (row.id, ))
             self.newConflict.emit(row.id)
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
         return c.rowcount == 1
 
+    @write_behind
     def synchronize_state(self, row, version=None, state='synchronized'):
         if version is None:
             version = row.version
@@ -1006,8 +2411,7 @@ class EngineDAO(ConfigurationDAO):
                       "pair_state=?, last_sync_date=?, processor = 0, last_error=NULL, error_count=0, last_sync_error_date=NULL " +
                       "WHERE id=? and version=?",
                       (state, datetime.utcnow(), row.id, version))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
         result = c.rowcount == 1
@@ -1021,8 +2425,7 @@ class EngineDAO(ConfigurationDAO):
                           "pair_state=?, last_sync_date=?, processor = 0, last_error=NULL, error_count=0, last_sync_error_date=NULL " +
                           "WHERE id=? and local_path=? and remote_name=? and remote_ref=? and remote_parent_ref=?",
                           (state, datetime.utcnow(), row.id, row.local_path, row.remote_name, row.remote_ref, row.remote_parent_ref))
-                if self.auto_commit:
-                    con.commit()
+                self._commit_write(con)
             finally:
                 self._lock.release()
             result = c.rowcount == 1
@@ -1034,8 +2437,7 @@ class EngineDAO(ConfigurationDAO):
                 c.execute("UPDATE States SET pair_state=?, last_sync_date=?, processor = 0, last_error=NULL, error_count=0, last_sync_error_date=NULL " +
                           "WHERE id=?",
                           (state, datetime.utcnow(), row.id))
-                if self.auto_commit:
-                    con.commit()
+                self._commit_write(con)
             finally:
                 self._lock.release()
         if not result:
@@ -1052,16 +2454,14 @@ class EngineDAO(ConfigurationDAO):
             self.queue_children(row)
         return result
 
+    @write_behind
     def update_remote_state(self, row, info, remote_parent_path=None, versionned=True, queue=True):
         pair_state = self._get_pair_state(row)
         if remote_parent_path is None:
             remote_parent_path = row.remote_parent_path
         version = ''
         # Check if it really needs an update
-        if (row.remote_ref == info.uid and info.parent_uid == row.remote_parent_ref and remote_parent_path == row.remote_parent_path
-            and info.name == row.remote_name and info.last_modification_time == row.last_remote_updated and info.can_rename == row.remote_can_rename
-            and info.can_delete == row.remote_can_delete and info.can_update == row.remote_can_update and info.can_create_child == row.remote_can_create_child
-            and info.last_contributor == row.last_remote_modifier and info.digest == row.remote_digest):
+        if not self._is_remote_state_changed(row, info, remote_parent_path):
             return
         if versionned:
             version = ', version=version+1'
@@ -1079,10 +2479,57 @@ class EngineDAO(ConfigurationDAO):
                        info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
                        info.can_create_child, info.last_contributor, info.digest, row.local_state,
                        row.remote_state, pair_state, row.id))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
             if queue:
-                self._queue_pair_state(row.id, info.folderish, pair_state)
+                self._queue_pair_state(row.id, info.folderish, pair_state, fields=self._get_queue_fields(
+                    row, remote_ref=info.uid, last_remote_updated=info.last_modification_time))
+        finally:
+            self._lock.release()
+
+    def _is_remote_state_changed(self, row, info, remote_parent_path):
+        return not (row.remote_ref == info.uid and info.parent_uid == row.remote_parent_ref and remote_parent_path == row.remote_parent_path
+            and info.name == row.remote_name and info.last_modification_time == row.last_remote_updated and info.can_rename == row.remote_can_rename
+            and info.can_delete == row.remote_can_delete and info.can_update == row.remote_can_update and info.can_create_child == row.remote_can_create_child
+            and info.last_contributor == row.last_remote_modifier and info.digest == row.remote_digest)
+
+    @write_behind
+    def update_remote_states(self, rows, remote_parent_path=None, versionned=True, queue=True):
+        '''
+        Same as update_remote_state for a list of (row, info), usually the children of one folder
+        '''
+        values = []
+        queued = []
+        for row, info in rows:
+            parent_path = remote_parent_path
+            if parent_path is None:
+                parent_path = row.remote_parent_path
+            if not self._is_remote_state_changed(row, info, parent_path):
+                continue
+            pair_state = self._get_pair_state(row)
+            values.append((info.uid, info.parent_uid, parent_path, info.name,
+                           info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
+                           info.can_create_child, info.last_contributor, info.digest, row.local_state,
+                           row.remote_state, pair_state, row.id))
+            queued.append((row.id, info.folderish, pair_state, self._get_queue_fields(
+                row, remote_ref=info.uid, last_remote_updated=info.last_modification_time)))
+        if not values:
+            return
+        version = ''
+        if versionned:
+            version = ', version=version+1'
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.executemany("UPDATE States SET remote_ref=?, remote_parent_ref=?, " +
+                          "remote_parent_path=?, remote_name=?, last_remote_updated=?, remote_can_rename=?," +
+                          "remote_can_delete=?, remote_can_update=?, " +
+                          "remote_can_create_child=?, last_remote_modifier=?, remote_digest=?, local_state=?," +
+                          "remote_state=?, pair_state=?" + version + " WHERE id=?", values)
+            self._commit_write(con, len(values))
+            if queue:
+                for row_id, folderish, pair_state, fields in queued:
+                    self._queue_pair_state(row_id, folderish, pair_state, fields=fields)
         finally:
             self._lock.release()
 
@@ -1101,8 +2548,7 @@ class EngineDAO(ConfigurationDAO):
             c.execute("DELETE FROM ToRemoteScan WHERE path LIKE ?", (path+'%',))
             # ADD IT
             c.execute("INSERT INTO ToRemoteScan(path) VALUES(?)", (path,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         except sqlite3.IntegrityError:
             pass
         finally:
@@ -1116,8 +2562,7 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             # ADD IT
             c.execute("DELETE FROM ToRemoteScan WHERE path=?", (path,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         except sqlite3.IntegrityError:
             pass
         finally:
@@ -1135,8 +2580,7 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             # ADD IT
             c.execute("INSERT INTO RemoteScan(path) VALUES(?)", (path,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         except sqlite3.IntegrityError:
             pass
         finally:
@@ -1148,8 +2592,7 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("DELETE FROM RemoteScan")
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -1192,12 +2635,39 @@ class EngineDAO(ConfigurationDAO):
         c = self._get_read_connection().cursor()
         return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_name < ? AND folderish=0 ORDER BY remote_name DESC LIMIT 1", (state.remote_parent_ref,state.remote_name)).fetchone()
 
+    def _get_filter_index(self):
+        # Sorted filter paths without the ones inside another filter: the only filter
+        # that can be a prefix of a path is then the greatest one lower or equal to it
+        index = []
+        for path in sorted([filter_obj.path for filter_obj in self.get_filters()]):
+            if not index or not path.startswith(index[-1]):
+                index.append(path)
+        return index
+
+    def _is_filter_in(self, index, path):
+        i = bisect_right(index, path)
+        return i > 0 and path.startswith(index[i - 1])
+
     def is_filter(self, path):
-        path = self._clean_filter_path(path)
-        if any([path.startswith(filter_obj.path) for filter_obj in self._filters]):
-            return True
-        else:
-            return False
+        return self._is_filter_in(self._filters, self._clean_filter_path(path))
+
+    def split_filtered(self, items, get_path):
+        '''
+        Partition items in two lists, the not filtered ones and the filtered ones,
+        get_path returns the path of an item
+        '''
+        # Same index for all the items even if the filters are updated meanwhile
+        index = self._filters
+        if not index:
+            return list(items), []
+        allowed = []
+        filtered = []
+        for item in items:
+            if self._is_filter_in(index, self._clean_filter_path(get_path(item))):
+                filtered.append(item)
+            else:
+                allowed.append(item)
+        return allowed, filtered
 
     def get_filters(self):
         c = self._get_read_connection().cursor()
@@ -1218,9 +2688,8 @@ class EngineDAO(ConfigurationDAO):
             # ADD IT
             c.execute("INSERT INTO Filters(path) VALUES(?)", (path,))
             # TODO ADD THIS path AS remotely_deleted
-            if self.auto_commit:
-                con.commit()
-            self._filters = self.get_filters()
+            self._commit_write(con)
+            self._filters = self._get_filter_index()
         finally:
             self._lock.release()
 
@@ -1231,9 +2700,8 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
-            if self.auto_commit:
-                con.commit()
-            self._filters = self.get_filters()
+            self._commit_write(con)
+            self._filters = self._get_filter_index()
         finally:
             self._lock.release()
 
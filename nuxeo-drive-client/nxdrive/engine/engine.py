@@ -93,8 +93,9 @@ class EngineLogger(QObject):
         self._log_pair(row_id, "Error on %r")
 
     @pyqtSlot(object)
-    def logQueueItem(self, row_id):
-        self._log_pair(row_id, "QueueItem on %r")
+    def logQueueItem(self, count):
+        if count:
+            log.log(self._level, "%d items queued", count)
 
 '''
 ' Used for threads interaction
@@ -106,6 +107,8 @@ class Engine(QObject):
     BATCH_MODE_FOLDER = "folder"
     BATCH_MODE_DOWNLOAD = "download"
     BATCH_MODE_SYNC = "sync"
+    # Statements taking the most time given in the metrics
+    SQL_METRICS_STATEMENTS = 5
     _start = pyqtSignal()
     _stop = pyqtSignal()
     _scanPair = pyqtSignal(str)
@@ -198,7 +201,7 @@ class Engine(QObject):
         self._user_cache = dict()
 
     @pyqtSlot(object)
-    def _check_sync_start(self, row_id):
+    def _check_sync_start(self, count):
         if not self._sync_started:
             queue_size = self._queue_manager.get_overall_size()
             if queue_size > 0:
@@ -409,9 +412,13 @@ class Engine(QObject):
 
     def _create_queue_manager(self, processors):
         from nxdrive.engine.queue_manager import QueueManager
+        # Comma separated policies, see QueuePriority
+        priorities = [policy.strip() for policy in self._manager.get_config("queue_priority", "").split(',')
+                      if policy.strip()]
+        autotune = self._manager.get_config("processors_autotune", "0") == "1"
         if self._manager.is_debug():
-            return QueueManager(self, self._dao, max_file_processors=2)
-        return QueueManager(self, self._dao)
+            return QueueManager(self, self._dao, max_file_processors=2, priorities=priorities, autotune=autotune)
+        return QueueManager(self, self._dao, priorities=priorities, autotune=autotune)
 
     def _create_remote_watcher(self, delay):
         from nxdrive.engine.watcher.remote_watcher import RemoteWatcher
@@ -426,8 +433,19 @@ class Engine(QObject):
                                 "ndrive_" + self._uid + ".db")
 
     def _create_dao(self):
-        from nxdrive.engine.dao.sqlite import EngineDAO
-        return EngineDAO(self._get_db_file())
+        from nxdrive.engine.dao.sqlite import EngineDAO, TUNABLE_PRAGMAS
+        # WAL journal, connection pragmas, single writer thread, state index and statistics are opt-in
+        wal = self._manager.get_config("sqlite_wal", "0") == "1"
+        writer = self._manager.get_config("sqlite_writer", "0") == "1"
+        state_index = self._manager.get_config("sqlite_state_index", "0") == "1"
+        stats = self._manager.get_config("sqlite_stats", "0") == "1"
+        pragmas = dict()
+        for name in TUNABLE_PRAGMAS:
+            value = self._manager.get_config("sqlite_" + name)
+            if value is not None:
+                pragmas[name] = value
+        return EngineDAO(self._get_db_file(), wal=wal, pragmas=pragmas, writer=writer,
+                         state_index=state_index, stats=stats)
 
     def get_remote_url(self):
         server_link = self._dao.get_config("server_url", "")
@@ -590,7 +608,12 @@ class Engine(QObject):
         metrics["error_files"] = self._dao.get_error_count()
         metrics["conflicted_files"] = self._dao.get_conflict_count()
         metrics["files_size"] = self._dao.get_global_size()
+        metrics.update(self._dao.get_metrics())
         metrics["invalid_credentials"] = self._invalid_credentials
+        # Only when sqlite_stats is enabled, the query plans stay in the debug UI
+        sql = self._dao.get_sql_stats(limit=self.SQL_METRICS_STATEMENTS, explain=0)
+        if sql is not None:
+            metrics["sql"] = sql
         return metrics
 
     def get_conflicts(self):
@@ -621,6 +644,8 @@ class Engine(QObject):
         self._stopped = True
         log.debug("Engine %s stopping", self._uid)
         self._stop.emit()
+        # The idle processors are waiting for the next items
+        self._queue_manager.wake_processors()
         for thread in self._threads:
             if not thread.wait(5000):
                 log.warn("Thread is not responding - terminate it")
@@ -725,11 +750,11 @@ class Engine(QObject):
             # password in the DB
             self._remote_password = None
         # Save the configuration
-        self._dao.update_config("web_authentication", self._web_authentication)
-        self._dao.update_config("server_url", self._server_url)
-        self._dao.update_config("remote_user", self._remote_user)
-        self._dao.update_config("remote_password", self._remote_password)
-        self._dao.update_config("remote_token", self._remote_token)
+        self._dao.update_configs({"web_authentication": self._web_authentication,
+                                  "server_url": self._server_url,
+                                  "remote_user": self._remote_user,
+                                  "remote_password": self._remote_password,
+                                  "remote_token": self._remote_token})
         if nxclient:
             self.get_update_infos(nxclient)
             # Check for the root
@@ -909,9 +934,9 @@ class Engine(QObject):
             cache[cache_key] = remote_client
         return remote_client
 
-    def create_processor(self, item_getter, name=None):
+    def create_processor(self, item_getter, name=None, persistent=False):
         from nxdrive.engine.processor import Processor
-        return Processor(self, item_getter, name=name)
+        return Processor(self, item_getter, name=name, persistent=persistent)
 
     def dispose_db(self):
         if self._dao is not None:
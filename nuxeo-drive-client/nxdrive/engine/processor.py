@@ -32,14 +32,19 @@ class Processor(EngineWorker):
     readonly_locks = dict()
     readonly_locker = Lock()
 
-    def __init__(self, engine, item_getter, name=None):
+    def __init__(self, engine, item_getter, name=None, persistent=False):
         '''
         Constructor
         '''
         super(Processor, self).__init__(engine, engine.get_dao(), name=name)
         self._current_item = None
         self._current_doc_pair = None
-        self._get_item = item_getter
+        self._item_getter = item_getter
+        # A persistent processor waits for the next item instead of ending, its
+        # item_getter takes a wait argument to block until an item is available
+        self._persistent = persistent
+        # Set by drain, the processor ends once its current item is done
+        self._draining = False
         self._engine = engine
 
     def _unlock_soft_path(self, path):
@@ -143,17 +148,45 @@ class Processor(EngineWorker):
     def acquire_state(self, row_id):
         if self._dao.acquire_processor(self._thread_id, row_id):
             # Avoid any lock for this call by using the write connection
-            return self._dao.get_state_from_id(row_id, from_write=True)
+            doc_pair = self._dao.get_state_from_id(row_id, from_write=True)
+            self._engine.get_queue_manager().set_processing(self, doc_pair)
+            return doc_pair
         return None
 
     def release_state(self):
-        self._dao.release_processor(self._thread_id)
+        self._engine.get_queue_manager().set_processing(self, None)
+        # No need to wait for the release to be committed
+        self._dao.submit_write(self._dao.release_processor, self._thread_id)
+
+    def drain(self):
+        self._draining = True
+
+    def _get_item(self, wait=False):
+        if self._draining:
+            return None
+        return self._item_getter(wait=wait)
+
+    def _get_next_item(self):
+        # The previous pair is done
+        self._current_doc_pair = None
+        item = self._get_item()
+        while item is None and self._persistent and not self._draining:
+            self._interact()
+            if self._engine.is_stopped():
+                break
+            item = self._get_item(wait=True)
+        return item
 
     def _execute(self):
         self._current_metrics = dict()
-        self._current_item = self._get_item()
+        self._current_item = None
         soft_lock = None
-        while (self._current_item != None):
+        while True:
+            if self._current_item is None:
+                # Out of the pair handling as the wait can be interrupted
+                self._current_item = self._get_next_item()
+                if self._current_item is None:
+                    break
             # Take client every time as it is cached in engine
             local_client = self._engine.get_local_client()
             remote_client = self._engine.get_remote_client()
@@ -297,7 +330,7 @@ class Processor(EngineWorker):
                     parent_fs_item_id=doc_pair.remote_parent_ref,
                     filename=doc_pair.remote_name,# Use remote name to avoid rename in case of duplicate
                 )
-                self._dao.update_last_transfer(doc_pair.id, "upload")
+                self._dao.submit_write(self._dao.update_last_transfer, doc_pair.id, "upload")
                 self._update_speed_metrics()
                 self._dao.update_remote_state(doc_pair, fs_item_info, versionned=False)
                 # TODO refresh_client
@@ -337,6 +370,10 @@ class Processor(EngineWorker):
             if local_client.exists(doc_pair.local_parent_path):
                 parent_ref = local_client.get_remote_id(doc_pair.local_parent_path)
                 parent_pair = self._get_normal_state_from_remote_ref(parent_ref)
+        if parent_pair is not None and parent_pair.remote_ref is None and parent_pair.pair_state == 'locally_created':
+            # The parent is being created by another processor, it will queue its childs once done
+            log.debug("Parent folder of %r is not created yet, wait for it", doc_pair)
+            return
         if parent_pair is None or parent_pair.remote_ref is None:
             # Illegal state: report the error and let's wait for the
             # parent folder issue to get resolved first
@@ -395,10 +432,13 @@ class Processor(EngineWorker):
                 fs_item_info = remote_client.stream_file(
                     parent_ref, local_client._abspath(doc_pair.local_path), filename=name)
                 remote_ref = fs_item_info.uid
-                self._dao.update_last_transfer(doc_pair.id, "upload")
+                self._dao.submit_write(self._dao.update_last_transfer, doc_pair.id, "upload")
                 self._update_speed_metrics()
             self._dao.update_remote_state(doc_pair, fs_item_info, remote_parent_path,
                                           versionned=False)
+            if doc_pair.folderish:
+                # The childs only need the remote ref of their parent
+                self._dao.queue_children(doc_pair)
             log.trace("Put remote_ref in %s", remote_ref)
             try:
                 local_client.set_remote_id(doc_pair.local_path, remote_ref)
@@ -522,7 +562,7 @@ class Processor(EngineWorker):
                                 + DOWNLOAD_TMP_FILE_SUFFIX)
         return file_out
 
-    def _download_content(self, local_client, remote_client, doc_pair, file_path):
+    def _download_content(self, local_client, remote_client, doc_pair, file_path, digests=None):
         # Check if the file is already on the HD
         pair = self._dao.get_valid_duplicate_file(doc_pair.remote_digest)
         if pair:
@@ -532,10 +572,14 @@ class Processor(EngineWorker):
             return file_out
         tmp_file = remote_client.stream_content(
                                 doc_pair.remote_ref, file_path,
-                                parent_fs_item_id=doc_pair.remote_parent_ref)
+                                parent_fs_item_id=doc_pair.remote_parent_ref, digests=digests)
         self._update_speed_metrics()
         return tmp_file
 
+    def _get_download_digests(self, local_client):
+        # Get the local digest while downloading instead of reading the file again
+        return {local_client._digest_func: None}
+
     def _synchronize_remotely_modified(self, doc_pair, local_client, remote_client):
         tmp_file = None
         try:
@@ -552,7 +596,9 @@ class Processor(EngineWorker):
                     new_os_path = os_path
                     log.debug("Updating content of local file '%s'.",
                               os_path)
-                tmp_file = self._download_content(local_client, remote_client, doc_pair, new_os_path)
+                digests = self._get_download_digests(local_client)
+                tmp_file = self._download_content(local_client, remote_client, doc_pair, new_os_path,
+                                                  digests=digests)
                 # Delete original file and rename tmp file
                 remote_id = local_client.get_remote_id(doc_pair.local_path)
                 local_client.delete_final(doc_pair.local_path)
@@ -562,8 +608,10 @@ class Processor(EngineWorker):
                 if remote_id is not None:
                     local_client.set_remote_id(doc_pair.local_parent_path + '/' + doc_pair.remote_name,
                                                doc_pair.remote_ref)
-                doc_pair.local_digest = updated_info.get_digest()
-                self._dao.update_last_transfer(doc_pair.id, "download")
+                doc_pair.local_digest = digests[local_client._digest_func]
+                if doc_pair.local_digest is None:
+                    doc_pair.local_digest = updated_info.get_digest()
+                self._dao.submit_write(self._dao.update_last_transfer, doc_pair.id, "download")
                 self._refresh_local_state(doc_pair, updated_info)
             else:
                 # digest agree so this might be a renaming and/or a move,
@@ -648,8 +696,9 @@ class Processor(EngineWorker):
             # It is filtered so skip and remove from the LastKnownState
             self._dao.remove_state(doc_pair)
             return
+        digests = self._get_download_digests(local_client)
         if not local_client.exists(doc_pair.local_path):
-            path = self._create_remotely(local_client, remote_client, doc_pair, parent_pair, name)
+            path = self._create_remotely(local_client, remote_client, doc_pair, parent_pair, name, digests=digests)
         else:
             path = doc_pair.local_path
             remote_ref = local_client.get_remote_id(doc_pair.local_path)
@@ -663,11 +712,13 @@ class Processor(EngineWorker):
             elif remote_ref is not None:
                 # Case of several documents with same name or case insensitive hard drive
                 # TODO dedup
-                path = self._create_remotely(local_client, remote_client, doc_pair, parent_pair, name)
+                path = self._create_remotely(local_client, remote_client, doc_pair, parent_pair, name, digests=digests)
         local_client.set_remote_id(path, doc_pair.remote_ref)
         if path != doc_pair.local_path and doc_pair.folderish:
             # Update childs
             self._dao.update_local_parent_path(doc_pair, os.path.basename(path), os.path.dirname(path))
+        if doc_pair.local_digest is None:
+            doc_pair.local_digest = digests[local_client._digest_func]
         self._refresh_local_state(doc_pair, local_client.get_info(path))
         self._handle_readonly(local_client, doc_pair)
         if not self._dao.synchronize_state(doc_pair):
@@ -683,7 +734,7 @@ class Processor(EngineWorker):
                 else:
                     self._synchronize_remotely_modified(new_pair, local_client, remote_client)
 
-    def _create_remotely(self, local_client, remote_client, doc_pair, parent_pair, name):
+    def _create_remotely(self, local_client, remote_client, doc_pair, parent_pair, name, digests=None):
         local_parent_path = parent_pair.local_path
         # TODO Shared this locking system / Can have concurrent lock
         self._unlock_readonly(local_client, local_parent_path)
@@ -698,10 +749,11 @@ class Processor(EngineWorker):
                                                                 name)
                 log.debug("Creating local file '%s' in '%s'", name,
                           local_client._abspath(parent_pair.local_path))
-                tmp_file = self._download_content(local_client, remote_client, doc_pair, os_path)
+                tmp_file = self._download_content(local_client, remote_client, doc_pair, os_path,
+                                                  digests=digests)
                 # Rename tmp file
                 local_client.rename(local_client.get_path(tmp_file), name)
-                self._dao.update_last_transfer(doc_pair.id, "download")
+                self._dao.submit_write(self._dao.update_last_transfer, doc_pair.id, "download")
         finally:
             self._lock_readonly(local_client, local_parent_path)
             # Clean .nxpart if needed
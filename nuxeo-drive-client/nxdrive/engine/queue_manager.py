@@ -1,8 +1,13 @@
 from PyQt4.QtCore import QObject, pyqtSignal, pyqtSlot, QTimer
 from Queue import Queue, Empty
 from nxdrive.logging_config import get_logger
-from threading import Lock, local
+from nxdrive.engine.blacklist_queue import RetryScheduler
+from threading import Lock, Condition, local, current_thread
 from copy import deepcopy
+from datetime import datetime
+from itertools import count
+from heapq import heappush, heappop, heapify
+import calendar
 import time
 log = get_logger(__name__)
 
@@ -16,10 +21,19 @@ except ImportError:
 
 
 class QueueItem(object):
-    def __init__(self, row_id, folderish, pair_state):
+    def __init__(self, row_id, folderish, pair_state, local_path=None, remote_ref=None, size=None,
+                 last_local_updated=None, last_remote_updated=None, error_count=0):
         self.id = row_id
         self.folderish = folderish
         self.pair_state = pair_state
+        # Only needed by the priority policies
+        self.local_path = local_path
+        self.remote_ref = remote_ref
+        self.size = size
+        self.last_local_updated = last_local_updated
+        self.last_remote_updated = last_remote_updated
+        # Retries of the error queue
+        self.error_count = error_count
 
     def __repr__(self):
         return "%s[%s](Folderish:%s, State: %s)" % (
@@ -27,29 +41,513 @@ class QueueItem(object):
                         self.folderish, self.pair_state)
 
 
+class QueuePriority(object):
+    '''
+    Order the queues by adding a delay in seconds to the push time of each
+    item: an item waits at most its delay behind the ones pushed after it,
+    so the big or old items are only delayed and never starve.
+    The delays of the enabled policies are added up, from the fields of
+    the QueueItem given by the DAO.
+    '''
+    POLICIES = ("smallest", "recent", "drive_edit", "depth")
+    # Bytes per second of delay for the smallest policy
+    SIZE_RATE = 1024 * 1024
+    # Age in seconds of the last modification per second of delay for the recent policy
+    AGE_RATE = 60
+    # Delay per folder level for the depth policy
+    DEPTH_DELAY = 1
+    # Delay of the documents not opened with DriveEdit
+    DRIVE_EDIT_DELAY = 60
+    # Maximum delay of a policy
+    MAX_DELAY = 600
+    # Maximum delay of each priority class
+    CLASSES = ((1, "high"), (DRIVE_EDIT_DELAY, "normal"), (None, "low"))
+
+    def __init__(self, policies):
+        self.policies = []
+        for policy in policies:
+            if policy in self.POLICIES:
+                self.policies.append(policy)
+            else:
+                log.warn("Unknown queue priority policy: %s", policy)
+        # Documents opened with DriveEdit, until their pair is processed
+        self._edit_refs = set()
+
+    def add_edit_ref(self, doc_id):
+        self._edit_refs.add(doc_id)
+
+    def set_processed(self, state):
+        if state.remote_ref is not None:
+            self._edit_refs.discard(self._get_doc_id(state.remote_ref))
+
+    def get_delay(self, state):
+        if len(self.policies) == 0:
+            return 0
+        delay = 0
+        for policy in self.policies:
+            delay += min(getattr(self, "_get_" + policy + "_delay")(state), self.MAX_DELAY)
+        return delay
+
+    def get_class(self, delay):
+        for max_delay, name in self.CLASSES:
+            if max_delay is None or delay < max_delay:
+                return name
+
+    def _get_smallest_delay(self, state):
+        if state.folderish or not state.size:
+            return 0
+        return float(state.size) / self.SIZE_RATE
+
+    def _get_recent_delay(self, state):
+        modified = [self._get_timestamp(value) for value in (state.last_local_updated, state.last_remote_updated)]
+        modified = [value for value in modified if value is not None]
+        if len(modified) == 0:
+            return self.MAX_DELAY
+        return max(0, time.time() - max(modified)) / self.AGE_RATE
+
+    def _get_drive_edit_delay(self, state):
+        if state.remote_ref is not None and self._get_doc_id(state.remote_ref) in self._edit_refs:
+            return 0
+        return self.DRIVE_EDIT_DELAY
+
+    def _get_doc_id(self, remote_ref):
+        return remote_ref.split('#')[-1]
+
+    def _get_depth_delay(self, state):
+        if state.local_path is None:
+            return 0
+        return state.local_path.rstrip('/').count('/') * self.DEPTH_DELAY
+
+    def _get_timestamp(self, value):
+        # The dates are stored in UTC
+        if value is None:
+            return None
+        if isinstance(value, datetime):
+            return calendar.timegm(value.utctimetuple())
+        try:
+            return calendar.timegm(time.strptime(value[:19], "%Y-%m-%d %H:%M:%S"))
+        except (ValueError, TypeError):
+            return None
+
+
+class WindowQueue(Queue):
+    '''
+    Queue keeping at most max_size items in memory, the items pushed
+    beyond are left in the database and read back by refill.
+    The items are ordered by their push time plus the priority delay.
+    '''
+    def __init__(self, dao, condition, max_size, priority=None):
+        Queue.__init__(self)
+        self._dao = dao
+        self._condition = condition
+        self.max_size = max_size
+        self._priority = priority
+        self._refill_lock = Lock()
+        # Position (local_path, id) of the database cursor, None when every item is in memory
+        self._position = None
+        # Items left in the database since the cursor started
+        self._spilled = False
+        # Count, total and max wait in seconds of each priority class
+        self._waits = dict()
+
+    def _init(self, maxsize):
+        # Heap of (deadline, sequence, push time, delay, item)
+        self.queue = []
+        self._sequence = count()
+        # Items in memory by row id
+        self._items = dict()
+        # Pushes merged into an item already in memory
+        self.coalesced = 0
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _get_delay(self, item):
+        if self._priority is None:
+            return 0
+        return self._priority.get_delay(item)
+
+    def _push(self, item, delay):
+        now = time.time()
+        heappush(self.queue, (now + delay, next(self._sequence), now, delay, item))
+        self._items[item.id] = item
+
+    def put(self, item, block=True, timeout=None):
+        # The delay can read the database, compute it out of the mutex
+        delay = 0
+        if item.id not in self._items:
+            delay = self._get_delay(item)
+        Queue.put(self, (delay, item), block, timeout)
+
+    def _put(self, entry):
+        # Called with the mutex acquired
+        delay, item = entry
+        queued = self._items.get(item.id)
+        if queued is not None:
+            # The processor reads the pair again, only keep its new state for the routing
+            log.trace("Coalesce %r into %r", item, queued)
+            queued.pair_state = item.pair_state
+            self.coalesced += 1
+            return
+        if len(self.queue) < self.max_size or item.error_count > 0:
+            # The pairs in error are not read back by refill
+            self._push(item, delay)
+            return
+        log.trace("Queue full, leave %r in the database", item)
+        if self._position is None:
+            self._position = ('', 0)
+        else:
+            self._spilled = True
+
+    def _get(self):
+        _, _, pushed, delay, item = heappop(self.queue)
+        del self._items[item.id]
+        name = "normal"
+        if self._priority is not None:
+            name = self._priority.get_class(delay)
+            self._priority.set_processed(item)
+        wait = time.time() - pushed
+        stats = self._waits.setdefault(name, [0, 0, 0])
+        stats[0] += 1
+        stats[1] += wait
+        stats[2] = max(stats[2], wait)
+        return item
+
+    def discard(self, row_id):
+        # Remove the item of a pair pushed to another queue, see QueueManager.push
+        self.mutex.acquire()
+        try:
+            if row_id not in self._items:
+                return False
+            del self._items[row_id]
+            self.queue = [entry for entry in self.queue if entry[-1].id != row_id]
+            heapify(self.queue)
+            self.coalesced += 1
+            return True
+        finally:
+            self.mutex.release()
+
+    def get_head(self):
+        # Deadline of the next item, None if empty
+        self.mutex.acquire()
+        try:
+            if len(self.queue) == 0:
+                return None
+            return self.queue[0][0]
+        finally:
+            self.mutex.release()
+
+    def get_items(self):
+        # Items in the order they will be processed
+        self.mutex.acquire()
+        try:
+            return [entry[-1] for entry in sorted(self.queue)]
+        finally:
+            self.mutex.release()
+
+    def get_waits(self):
+        self.mutex.acquire()
+        try:
+            return dict((name, list(stats)) for name, stats in self._waits.iteritems())
+        finally:
+            self.mutex.release()
+
+    def start_window(self):
+        # Read the whole queue from the database, as on startup
+        self.mutex.acquire()
+        try:
+            self._position = ('', 0)
+            self._spilled = False
+        finally:
+            self.mutex.release()
+        self.refill()
+
+    def has_spilled(self):
+        return self._position is not None
+
+    def refill(self):
+        if self._position is None or self.qsize() > self.max_size / 2:
+            return
+        self._refill_lock.acquire()
+        try:
+            while self._position is not None:
+                limit = self.max_size - self.qsize()
+                if limit <= 0:
+                    return
+                last_path, last_id = self._position
+                rows = self._dao.get_queue_window(self._condition, last_path, last_id, limit)
+                items = [QueueItem(row.id, row.folderish, row.pair_state, row.local_path, row.remote_ref,
+                                   row.size, row.last_local_updated, row.last_remote_updated) for row in rows]
+                delays = [self._get_delay(item) for item in items]
+                self.mutex.acquire()
+                try:
+                    for item, delay in zip(items, delays):
+                        if item.id not in self._items:
+                            self._push(item, delay)
+                    if len(rows) > 0:
+                        self._position = (rows[-1].local_path, rows[-1].id)
+                    if len(rows) < limit:
+                        if self._spilled:
+                            # Some items were left behind the cursor: start again
+                            self._position = ('', 0)
+                            self._spilled = False
+                        else:
+                            self._position = None
+                    if len(self.queue) > 0:
+                        self.not_empty.notify()
+                finally:
+                    self.mutex.release()
+                if len(rows) == limit:
+                    return
+        finally:
+            self._refill_lock.release()
+
+
+class ProcessorTuner(object):
+    '''
+    Adjust the number of additional file processors every INTERVAL seconds:
+    add one while the throughput does not drop, halve them on errors or on a
+    drop bigger than HYSTERESIS, then hold for HOLD_INTERVALS intervals
+    '''
+    INTERVAL = 30
+    # Minimum of synchronized pairs and errors in an interval to take a decision
+    MIN_SAMPLES = 10
+    # Relative variation of the throughput considered as noise
+    HYSTERESIS = 0.1
+    MAX_ERROR_RATE = 0.1
+    HOLD_INTERVALS = 2
+
+    def __init__(self, processors, min_processors=1, max_processors=10):
+        self.min_processors = min_processors
+        self.max_processors = max_processors
+        self.processors = max(min_processors, min(processors, max_processors))
+        self._lock = Lock()
+        self._files = 0
+        self._bytes = 0
+        self._errors = 0
+        self._start = time.time()
+        # Throughput of the last interval, in bytes or files per second
+        self._last_rate = None
+        self._last_unit = None
+        self._hold = 0
+        self._metrics = {"decision": "start"}
+
+    def add_sync(self, size=0):
+        self._lock.acquire()
+        try:
+            self._files += 1
+            self._bytes += size
+        finally:
+            self._lock.release()
+
+    def add_error(self):
+        self._lock.acquire()
+        try:
+            self._errors += 1
+        finally:
+            self._lock.release()
+
+    def tune(self, pending=True):
+        '''
+        Return the number of additional processors to use from the
+        measures since the last call
+        '''
+        self._lock.acquire()
+        try:
+            now = time.time()
+            duration = max(now - self._start, 0.001)
+            files, size, errors = self._files, self._bytes, self._errors
+            if files + errors < self.MIN_SAMPLES and pending:
+                # Not enough measures yet, keep accumulating
+                return self.processors
+            self._files = self._bytes = self._errors = 0
+            self._start = now
+        finally:
+            self._lock.release()
+        error_rate = float(errors) / (files + errors) if files + errors > 0 else 0
+        # The bytes only make sense when there was a transfer
+        unit = "bytes" if size > 0 else "files"
+        rate = size / duration if size > 0 else files / duration
+        if unit != self._last_unit:
+            # Not comparable with the previous interval
+            self._last_rate = None
+        if not pending or files + errors < self.MIN_SAMPLES:
+            # Idle, nothing to measure
+            decision = "idle"
+            rate = None
+        elif error_rate > self.MAX_ERROR_RATE:
+            decision = self._decrease("errors")
+        elif self._last_rate is not None and rate < self._last_rate * (1 - self.HYSTERESIS):
+            decision = self._decrease("slower")
+        elif self._hold > 0:
+            self._hold -= 1
+            decision = "hold"
+        elif self.processors < self.max_processors:
+            self.processors += 1
+            decision = "increase"
+        else:
+            decision = "max"
+        if rate is not None:
+            self._last_rate = rate
+            self._last_unit = unit
+        self._metrics = {"decision": decision, "files_rate": round(files / duration, 2),
+                         "bytes_rate": int(size / duration), "error_rate": round(error_rate, 2)}
+        log.debug("Processors tuning: %s to %d %r", decision, self.processors, self._metrics)
+        return self.processors
+
+    def _decrease(self, reason):
+        self.processors = max(self.min_processors, self.processors / 2)
+        self._hold = self.HOLD_INTERVALS
+        # The throughput was measured with more processors
+        self._last_rate = None
+        return "decrease_" + reason
+
+    def get_metrics(self):
+        metrics = dict(self._metrics)
+        metrics["processors"] = self.processors
+        return metrics
+
+
+class PathNode(object):
+    __slots__ = ('children', 'workers', 'total', 'files')
+
+    def __init__(self):
+        self.children = dict()
+        # Worker processing this path and if the pair is a folder
+        self.workers = dict()
+        # Workers on this path and its descendants
+        self.total = 0
+        self.files = 0
+
+
+class PathIndex(object):
+    '''
+    Trie of the local paths being processed by path component, the lookups
+    only depend on the depth of the path
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self._root = PathNode()
+        self._paths = dict()
+
+    def _split(self, path):
+        return [name for name in path.split('/') if name]
+
+    def add(self, worker, path, folderish):
+        self._lock.acquire()
+        try:
+            self._remove(worker)
+            names = self._split(path)
+            increment = 0 if folderish else 1
+            node = self._root
+            node.total += 1
+            node.files += increment
+            for name in names:
+                node = node.children.setdefault(name, PathNode())
+                node.total += 1
+                node.files += increment
+            node.workers[worker] = folderish
+            self._paths[worker] = (names, folderish)
+        finally:
+            self._lock.release()
+
+    def remove(self, worker):
+        self._lock.acquire()
+        try:
+            self._remove(worker)
+        finally:
+            self._lock.release()
+
+    def _remove(self, worker):
+        if worker not in self._paths:
+            return
+        names, folderish = self._paths.pop(worker)
+        decrement = 0 if folderish else 1
+        node = self._root
+        node.total -= 1
+        node.files -= decrement
+        for name in names:
+            child = node.children[name]
+            child.total -= 1
+            child.files -= decrement
+            if child.total == 0:
+                # Nothing left under this path
+                del node.children[name]
+                return
+            node = child
+        del node.workers[worker]
+
+    def _find(self, path):
+        node = self._root
+        for name in self._split(path):
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def get_workers(self, path, exact_match=True):
+        self._lock.acquire()
+        try:
+            node = self._find(path)
+            if node is None:
+                return []
+            if exact_match:
+                return node.workers.keys()
+            workers = []
+            nodes = [node]
+            while nodes:
+                node = nodes.pop()
+                workers.extend(node.workers.keys())
+                nodes.extend(node.children.values())
+            return workers
+        finally:
+            self._lock.release()
+
+    def has_files(self, path):
+        # Is a file being processed under path
+        self._lock.acquire()
+        try:
+            node = self._find(path)
+            return node is not None and node.files > 0
+        finally:
+            self._lock.release()
+
+
 class QueueManager(QObject):
     # Always create thread from the main thread
+    # Number of items pushed since the last signal, 0 to only check the processors
     newItem = pyqtSignal(object)
+    _itemsPushed = pyqtSignal()
     newError = pyqtSignal(object)
     queueEmpty = pyqtSignal()
     queueProcessing = pyqtSignal()
     queueFinishedProcessing = pyqtSignal()
     # Only used by Unit Test
     _disable = False
+    # Items kept in memory by each queue, the others wait in the database
+    QUEUE_WINDOW_SIZE = 5000
+    # Minimum interval in seconds between two newItem signals, for all the queues
+    # as the listeners only launch the processors and count the new items
+    NEW_ITEM_INTERVAL = 0.1
     '''
     classdocs
     '''
-    def __init__(self, engine, dao, max_file_processors=5):
+    def __init__(self, engine, dao, max_file_processors=5, priorities=None, autotune=False):
         '''
         Constructor
         '''
         super(QueueManager, self).__init__()
         self._dao = dao
         self._engine = engine
-        self._local_folder_queue = Queue()
-        self._local_file_queue = Queue()
-        self._remote_file_queue = Queue()
-        self._remote_folder_queue = Queue()
+        self._priority = QueuePriority(priorities or [])
+        self._local_folder_queue = self._create_queue("pair_state LIKE 'locally%' AND pair_state != 'locally_created'"
+                                                      " AND folderish = 1")
+        # The childs of a folder are only queued once it is created, so the
+        # folders of this queue can be created in parallel by any processor
+        self._local_folder_creation_queue = self._create_queue("pair_state = 'locally_created' AND folderish = 1")
+        self._local_file_queue = self._create_queue("pair_state LIKE 'locally%' AND folderish = 0")
+        self._remote_file_queue = self._create_queue("pair_state LIKE 'remotely%' AND folderish = 0")
+        self._remote_folder_queue = self._create_queue("pair_state LIKE 'remotely%' AND folderish = 1")
         self._connected = local()
         self._local_folder_enable = True
         self._local_file_enable = True
@@ -64,11 +562,43 @@ class QueueManager(QObject):
         self.set_max_processors(max_file_processors)
         self._threads_pool = list()
         self._processors_pool = list()
+        # Additional processors ending after their current item
+        self._draining_pool = list()
         self._get_file_lock = Lock()
+        self._push_lock = Lock()
+        # Wake the idle processors on push, and on wake_processors when they must check their state
+        self._item_condition = Condition()
+        self._wake_count = 0
+        self._busy_processors = set()
+        # Local paths of the pairs being processed
+        self._processing = PathIndex()
+
+        # Adjust the additional processors from the throughput
+        self._tuner = None
+        if autotune:
+            self._tuner = ProcessorTuner(self._max_processors)
+            self._max_processors = self._tuner.processors
+            self._engine.newSync.connect(self._on_pair_sync)
+            self._tune_timer = QTimer()
+            self._tune_timer.timeout.connect(self._on_tune_timer)
+            self._tune_timer.start(ProcessorTuner.INTERVAL * 1000)
+
+        # Coalesce the newItem signals, see _notify_new_items
+        self._new_items_lock = Lock()
+        self._new_items = 0
+        # Time of the pending _itemsPushed signal, None if there is none
+        self._new_items_signal = None
+        self._new_items_last = 0
+        # Count, total and max delay in seconds of the event loop to handle _itemsPushed
+        self._new_items_latency = [0, 0, 0]
+        self._new_items_timer = QTimer()
+        self._new_items_timer.setSingleShot(True)
+        self._new_items_timer.timeout.connect(self._on_new_items)
+        self._itemsPushed.connect(self._on_items_pushed)
 
         # ERROR HANDLING
         self._error_lock = Lock()
-        self._on_error_queue = dict()
+        self._on_error_queue = RetryScheduler()
         self._error_timer = QTimer()
         self._error_timer.timeout.connect(self._on_error_timer)
         self.newError.connect(self._on_new_error)
@@ -76,6 +606,30 @@ class QueueManager(QObject):
         # LAST ACTION
         self._dao.register_queue_manager(self)
 
+    def _create_queue(self, condition):
+        return WindowQueue(self._dao, condition, self.QUEUE_WINDOW_SIZE, priority=self._priority)
+
+    def _get_queues(self):
+        return [self._local_folder_queue, self._local_folder_creation_queue, self._local_file_queue,
+                self._remote_folder_queue, self._remote_file_queue]
+
+    def init_queue_windows(self):
+        # Only load the first items of each queue, the next ones are read when needed
+        for queue in self._get_queues():
+            queue.start_window()
+        # The pairs in error are not read by the windows, retry them now as before a restart
+        self._error_lock.acquire()
+        try:
+            for doc_pair in self._dao.get_errors(limit=0):
+                if doc_pair.pair_state in ('synchronized', 'unsynchronized'):
+                    continue
+                doc_pair.error_next_try = 0
+                self._on_error_queue.push(doc_pair.id, doc_pair, doc_pair.error_next_try)
+            if len(self._on_error_queue) > 0:
+                self.newError.emit(0)
+        finally:
+            self._error_lock.release()
+
     def init_processors(self):
         log.trace("Init processors")
         self.newItem.connect(self.launch_processors)
@@ -91,10 +645,14 @@ class QueueManager(QObject):
             self.push(item)
 
     def _copy_queue(self, queue):
-        result = deepcopy(queue.queue)
+        result = deepcopy(queue.get_items())
         result.reverse()
         return result
 
+    def add_priority_ref(self, doc_id):
+        # Used by the drive_edit priority policy
+        self._priority.add_edit_ref(doc_id)
+
     def set_max_processors(self, max_file_processors):
         if max_file_processors < 2:
             max_file_processors = 2
@@ -122,6 +680,7 @@ class QueueManager(QObject):
         self._local_file_enable = value
         if self._local_file_thread is not None and not value:
             self._local_file_thread.quit()
+        self.wake_processors()
         if value:
             self.queueProcessing.emit()
 
@@ -129,6 +688,7 @@ class QueueManager(QObject):
         self._local_folder_enable = value
         if self._local_folder_thread is not None and not value:
             self._local_folder_thread.quit()
+        self.wake_processors()
         if value:
             self.queueProcessing.emit()
 
@@ -136,6 +696,7 @@ class QueueManager(QObject):
         self._remote_file_enable = value
         if self._remote_file_thread is not None and not value:
             self._remote_file_thread.quit()
+        self.wake_processors()
         if value:
             self.queueProcessing.emit()
 
@@ -143,6 +704,7 @@ class QueueManager(QObject):
         self._remote_folder_enable = value
         if self._remote_folder_thread is not None and not value:
             self._remote_folder_thread.quit()
+        self.wake_processors()
         if value:
             self.queueProcessing.emit()
 
@@ -153,60 +715,84 @@ class QueueManager(QObject):
         return self._copy_queue(self._remote_file_queue)
 
     def get_local_folder_queue(self):
-        return self._copy_queue(self._local_folder_queue)
+        return self._copy_queue(self._local_folder_creation_queue) + self._copy_queue(self._local_folder_queue)
 
     def get_remote_folder_queue(self):
         return self._copy_queue(self._remote_folder_queue)
 
-    def push_ref(self, row_id, folderish, pair_state):
-        self.push(QueueItem(row_id, folderish, pair_state))
+    def push_ref(self, row_id, folderish, pair_state, **fields):
+        # The fields are the ones used by the priority policies, see QueueItem
+        self.push(QueueItem(row_id, folderish, pair_state, **fields))
 
     def push(self, state):
         if state.pair_state is None:
             log.trace("Don't push an empty pair_state: %r", state)
             return
         log.trace("Pushing %r", state)
-        row_id = state.id
         if state.pair_state.startswith('locally'):
             if state.folderish:
-                self._local_folder_queue.put(state)
-                log.trace('Pushed to _local_folder_queue, now of size: %d', self._local_folder_queue.qsize())
+                if state.pair_state == 'locally_created':
+                    queue = self._local_folder_creation_queue
+                else:
+                    queue = self._local_folder_queue
             else:
-                if "deleted" in state.pair_state:
-                    self._engine.cancel_action_on(state.id)
-                self._local_file_queue.put(state)
-                log.trace('Pushed to _local_file_queue, now of size: %d', self._local_file_queue.qsize())
-            self.newItem.emit(row_id)
+                queue = self._local_file_queue
         elif state.pair_state.startswith('remotely'):
             if state.folderish:
-                self._remote_folder_queue.put(state)
-                log.trace('Pushed to _remote_folder_queue, now of size: %d', self._remote_folder_queue.qsize())
+                queue = self._remote_folder_queue
             else:
-                if "deleted" in state.pair_state:
-                    self._engine.cancel_action_on(state.id)
-                self._remote_file_queue.put(state)
-                log.trace('Pushed to _remote_file_queue, now of size: %d', self._remote_file_queue.qsize())
-            self.newItem.emit(row_id)
+                queue = self._remote_file_queue
         else:
             # deleted and conflicted
             log.debug("Not processable state: %r", state)
+            return
+        if not state.folderish and "deleted" in state.pair_state:
+            self._engine.cancel_action_on(state.id)
+        self._push_lock.acquire()
+        try:
+            # The pair changed of queue: only keep its last state, in the new queue
+            for other in self._get_queues():
+                if other is not queue and other.discard(state.id):
+                    log.trace("Move %r to the queue of its new state", state)
+            queue.put(state)
+        finally:
+            self._push_lock.release()
+        log.trace('Pushed to %s queue, now of size: %d', state.pair_state, queue.qsize())
+        self._notify_item()
+        self._notify_new_items(1)
 
     @pyqtSlot()
     def _on_error_timer(self):
-        cur_time = int(time.time())
         self._error_lock.acquire()
         try:
-            for doc_pair in self._on_error_queue.values():
-                if doc_pair.error_next_try < cur_time:
-                    queueItem = QueueItem(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
-                    del self._on_error_queue[doc_pair.id]
-                    log.debug('End of blacklist period, pushing doc_pair: %r', doc_pair)
-                    self.push(queueItem)
+            # Only the pairs ready are read from the heap
+            for doc_pair in self._on_error_queue.pop_all():
+                queueItem = QueueItem(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, doc_pair.local_path,
+                                      doc_pair.remote_ref, doc_pair.size, doc_pair.last_local_updated,
+                                      doc_pair.last_remote_updated, error_count=max(doc_pair.error_count, 1))
+                log.debug('End of blacklist period, pushing doc_pair: %r', doc_pair)
+                self.push(queueItem)
             if len(self._on_error_queue) == 0:
                 self._error_timer.stop()
         finally:
             self._error_lock.release()
 
+    @pyqtSlot(object, object)
+    def _on_pair_sync(self, doc_pair, metrics):
+        # Only count the size of the transfers
+        size = 0
+        if "speed" in metrics and doc_pair.size is not None:
+            size = doc_pair.size
+        self._tuner.add_sync(size)
+
+    @pyqtSlot()
+    def _on_tune_timer(self):
+        pending = self.get_overall_size() > 0 or self.is_active()
+        processors = self._tuner.tune(pending)
+        if processors != self._max_processors:
+            self._max_processors = processors
+            self.launch_processors()
+
     @pyqtSlot()
     def _on_new_error(self):
         self._error_timer.start(1000)
@@ -215,6 +801,8 @@ class QueueManager(QObject):
         return self._error_threshold
 
     def push_error(self, doc_pair, exception=None):
+        if self._tuner is not None:
+            self._tuner.add_error()
         error_count = doc_pair.error_count
         if (exception is not None and type(exception) == WindowsError
             and hasattr(exception, 'winerror') and exception.winerror == WINERROR_CODE_PROCESS_CANNOT_ACCESS_FILE):
@@ -225,7 +813,7 @@ class QueueManager(QObject):
         if error_count > self._error_threshold:
             log.debug("Giving up on pair : %r", doc_pair)
             return
-        interval = self._error_interval * error_count
+        interval = int(RetryScheduler.get_backoff(self._error_interval, error_count))
         doc_pair.error_next_try = interval + int(time.time())
         log.debug("Blacklisting pair for %ds: %r", interval, doc_pair)
         self._error_lock.acquire()
@@ -233,63 +821,170 @@ class QueueManager(QObject):
             emit_sig = False
             if len(self._on_error_queue) == 0:
                 emit_sig = True
-            self._on_error_queue[doc_pair.id] = doc_pair
+            self._on_error_queue.push(doc_pair.id, doc_pair, doc_pair.error_next_try)
             if emit_sig:
                 self.newError.emit(doc_pair.id)
         finally:
             self._error_lock.release()
 
     def cancel_queued_errors(self):
-        for doc_pair in self._on_error_queue.values():
-            doc_pair.error_next_try = 0
+        # Retry all of them on the next error timer
+        self._error_lock.acquire()
+        try:
+            for doc_pair in self._on_error_queue.get_items():
+                doc_pair.error_next_try = 0
+            self._on_error_queue.release_all()
+        finally:
+            self._error_lock.release()
 
-    def _get_local_folder(self):
-        if self._local_folder_queue.empty():
-            return None
+    def _notify_new_items(self, count):
+        # Only one _itemsPushed signal is pending in the event loop at a time
+        self._new_items_lock.acquire()
         try:
-            state = self._local_folder_queue.get(True, 3)
-        except Empty:
-            return None
-        return state
+            self._new_items += count
+            if self._new_items_signal is not None:
+                return
+            self._new_items_signal = time.time()
+        finally:
+            self._new_items_lock.release()
+        self._itemsPushed.emit()
 
-    def _get_local_file(self):
-        if self._local_file_queue.empty():
-            return None
+    @pyqtSlot()
+    def _on_items_pushed(self):
+        self._new_items_lock.acquire()
         try:
-            state = self._local_file_queue.get(True, 3)
-        except Empty:
-            return None
-        return state
+            if self._new_items_signal is not None:
+                latency = time.time() - self._new_items_signal
+                self._new_items_latency[0] += 1
+                self._new_items_latency[1] += latency
+                self._new_items_latency[2] = max(self._new_items_latency[2], latency)
+        finally:
+            self._new_items_lock.release()
+        self._on_new_items()
 
-    def _get_remote_folder(self):
-        if self._remote_folder_queue.empty():
-            return None
+    @pyqtSlot()
+    def _on_new_items(self):
+        now = time.time()
+        self._new_items_lock.acquire()
         try:
-            state = self._remote_folder_queue.get(True, 3)
-        except Empty:
-            return None
-        return state
+            if self._new_items_signal is None:
+                return
+            wait = self._new_items_last + self.NEW_ITEM_INTERVAL - now
+            if wait > 0:
+                # Signaled less than NEW_ITEM_INTERVAL ago, the next pushes are added to this one
+                self._new_items_timer.start(int(wait * 1000) + 1)
+                return
+            count = self._new_items
+            self._new_items = 0
+            self._new_items_signal = None
+            self._new_items_last = now
+        finally:
+            self._new_items_lock.release()
+        self.newItem.emit(count)
 
-    def _get_remote_file(self):
-        if self._remote_file_queue.empty():
-            return None
+    def _wait_item(self, queues):
+        # Block the idle processors until an item is pushed to one of the queues,
+        # the engine stops or wake_processors is called
+        self._item_condition.acquire()
         try:
-            state = self._remote_file_queue.get(True, 3)
-        except Empty:
-            return None
+            wake_count = self._wake_count
+            while (wake_count == self._wake_count and not self._engine.is_stopped()
+                   and len([queue for queue in queues if not queue.empty()]) == 0):
+                self._item_condition.wait()
+        finally:
+            self._item_condition.release()
+
+    def _notify_item(self):
+        self._item_condition.acquire()
+        try:
+            self._item_condition.notify_all()
+        finally:
+            self._item_condition.release()
+
+    def wake_processors(self):
+        # Let the idle processors handle their thread events: quit, suspend, drain
+        self._item_condition.acquire()
+        try:
+            self._wake_count += 1
+            self._item_condition.notify_all()
+        finally:
+            self._item_condition.release()
+
+    def _set_busy(self, busy):
+        # Track the processors working on an item, see is_active
+        thread_id = current_thread().ident
+        if busy:
+            self._busy_processors.add(thread_id)
+        elif thread_id in self._busy_processors:
+            self._busy_processors.discard(thread_id)
+            if len(self._busy_processors) == 0:
+                # Let launch_processors check if the processing is finished
+                self._notify_new_items(0)
+
+    def _get_queue_item(self, queues, enabled, wait):
+        # enabled is checked again after the wait as the queues can be suspended meanwhile
+        for queue in queues:
+            queue.refill()
+        if wait:
+            self._wait_item(queues if enabled() else [])
+        state = None
+        if enabled():
+            for queue in queues:
+                try:
+                    state = queue.get(False)
+                    break
+                except Empty:
+                    pass
+        self._set_busy(state is not None)
         return state
 
-    def _get_file(self):
+    def _get_local_folder(self, wait=False):
+        return self._get_queue_item([self._local_folder_queue, self._local_folder_creation_queue],
+                                    lambda: self._local_folder_enable, wait)
+
+    def _get_local_file(self, wait=False):
+        return self._get_queue_item([self._local_file_queue], lambda: self._local_file_enable, wait)
+
+    def _get_remote_folder(self, wait=False):
+        return self._get_queue_item([self._remote_folder_queue], lambda: self._remote_folder_enable, wait)
+
+    def _get_remote_file(self, wait=False):
+        return self._get_queue_item([self._remote_file_queue], lambda: self._remote_file_enable, wait)
+
+    def _get_file_queues(self):
+        # The folder creations first as they release their childs
+        folder_queues = []
+        if self._local_folder_enable:
+            folder_queues.append(self._local_folder_creation_queue)
+        queues = []
+        if self._remote_file_enable:
+            queues.append(self._remote_file_queue)
+        if self._local_file_enable:
+            queues.append(self._local_file_queue)
+        return folder_queues, queues
+
+    def _get_file(self, wait=False):
+        folder_queues, queues = self._get_file_queues()
+        for queue in folder_queues + queues:
+            queue.refill()
+        if wait:
+            self._wait_item(folder_queues + queues)
+            folder_queues, queues = self._get_file_queues()
+        state = None
         self._get_file_lock.acquire()
-        if self._remote_file_queue.empty() and self._local_file_queue.empty():
+        try:
+            # Take the item with the earliest deadline, the empty queues last
+            heads = [(queue.get_head(), queue) for queue in queues]
+            queues = [queue for head, queue in sorted(heads, key=lambda head: (head[0] is None, head[0]))]
+            for queue in folder_queues + queues:
+                try:
+                    state = queue.get(False)
+                    break
+                except Empty:
+                    pass
+        finally:
             self._get_file_lock.release()
-            return None
-        state = None
-        if (self._remote_file_queue.qsize() > self._local_file_queue.qsize()):
-            state = self._get_remote_file()
-        else:
-            state = self._get_local_file()
-        self._get_file_lock.release()
+        self._set_busy(state is not None)
         return state
 
     @pyqtSlot()
@@ -297,6 +992,10 @@ class QueueManager(QObject):
         for thread in self._processors_pool:
             if thread.isFinished():
                 self._processors_pool.remove(thread)
+        self._draining_pool = [thread for thread in self._draining_pool if not thread.isFinished()]
+        # The processors ended during an item are not busy anymore
+        self._busy_processors.intersection_update([thread.worker._thread_id for thread in self._get_threads()
+                                                   if not thread.isFinished()])
         if (self._local_folder_thread is not None and
                 self._local_folder_thread.isFinished()):
             self._local_folder_thread = None
@@ -310,7 +1009,7 @@ class QueueManager(QObject):
                 self._remote_file_thread.isFinished()):
             self._remote_file_thread = None
         if not self._engine.is_paused() and not self._engine.is_stopped():
-            self.newItem.emit(None)
+            self._notify_new_items(0)
 
     def active(self):
         # Recheck threads
@@ -318,14 +1017,18 @@ class QueueManager(QObject):
         return self.is_active()
 
     def is_active(self):
-        return (self._local_folder_thread is not None
-                or self._local_file_thread is not None
-                or self._remote_file_thread is not None
-                or self._remote_folder_thread is not None
-                or len(self._processors_pool) > 0)
+        # The processors are kept while idle, only the ones working on an item count
+        return len(self._busy_processors) > 0
+
+    def _get_threads(self):
+        threads = [thread for thread in (self._local_folder_thread, self._local_file_thread,
+                                         self._remote_folder_thread, self._remote_file_thread)
+                   if thread is not None]
+        return threads + self._processors_pool + self._draining_pool
 
     def _create_thread(self, item_getter, name=None):
-        processor = self._engine.create_processor(item_getter, name=name)
+        # The processor waits for the next items instead of ending with an empty queue
+        processor = self._engine.create_processor(item_getter, name=name, persistent=True)
         thread = self._engine.create_thread(worker=processor)
         thread.finished.connect(self._thread_finished)
         thread.terminated.connect(self._thread_finished)
@@ -334,7 +1037,9 @@ class QueueManager(QObject):
 
     def get_metrics(self):
         metrics = dict()
-        metrics["local_folder_queue"] = self._local_folder_queue.qsize()
+        # The folder creations are part of the local folder queue
+        metrics["local_folder_creation_queue"] = self._local_folder_creation_queue.qsize()
+        metrics["local_folder_queue"] = self._local_folder_queue.qsize() + metrics["local_folder_creation_queue"]
         metrics["local_file_queue"] = self._local_file_queue.qsize()
         metrics["remote_folder_queue"] = self._remote_folder_queue.qsize()
         metrics["remote_file_queue"] = self._remote_file_queue.qsize()
@@ -343,71 +1048,65 @@ class QueueManager(QObject):
         metrics["local_file_thread"] = self._local_file_thread is not None
         metrics["local_folder_thread"] = self._local_folder_thread is not None
         metrics["error_queue"] = len(self._on_error_queue)
+        metrics["coalesced_items"] = sum([queue.coalesced for queue in self._get_queues()])
+        metrics["spilled_queues"] = len([queue for queue in self._get_queues() if queue.has_spilled()])
         metrics["total_queue"] = (metrics["local_folder_queue"] + metrics["local_file_queue"]
                                 + metrics["remote_folder_queue"] + metrics["remote_file_queue"])
         metrics["additional_processors"] = len(self._processors_pool)
+        metrics["busy_processors"] = len(self._busy_processors)
+        metrics["priority_wait"] = self._get_wait_metrics()
+        count, total, latency = self._new_items_latency
+        metrics["new_item_latency"] = {"count": count, "average": int(total * 1000 / count) if count else 0,
+                                       "max": int(latency * 1000)}
+        if self._tuner is not None:
+            metrics["processors_tuning"] = self._tuner.get_metrics()
         return metrics
 
+    def _get_wait_metrics(self):
+        # Wait in the queues of each priority class, in ms
+        waits = dict()
+        for queue in self._get_queues():
+            for name, stats in queue.get_waits().iteritems():
+                total = waits.setdefault(name, [0, 0, 0])
+                total[0] += stats[0]
+                total[1] += stats[1]
+                total[2] = max(total[2], stats[2])
+        result = dict()
+        for name, stats in waits.iteritems():
+            result[name] = {"count": stats[0], "average": int(stats[1] * 1000 / stats[0]),
+                            "max": int(stats[2] * 1000)}
+        return result
+
     def get_overall_size(self):
-        return (self._local_folder_queue.qsize() + self._local_file_queue.qsize()
-                + self._remote_folder_queue.qsize() + self._remote_file_queue.qsize())
-
-    def is_processing_file(self, worker, path, exact_match=False):
-        if not hasattr(worker, "_current_doc_pair"):
-            return False
-        if (worker._current_doc_pair is None or
-            worker._current_doc_pair.local_path is None):
-            return False
-        if exact_match:
-            result = worker._current_doc_pair.local_path == path
+        return sum([queue.qsize() for queue in self._get_queues()])
+
+    def set_processing(self, worker, doc_pair):
+        # Called by the processors on acquire and release, None when done
+        if doc_pair is None or doc_pair.local_path is None:
+            self._processing.remove(worker)
         else:
-            result = worker._current_doc_pair.local_path.startswith(path)
-        if result:
-            log.trace("Worker(%r) is processing: %s", worker.get_metrics(), path)
-        return result
+            self._processing.add(worker, doc_pair.local_path, doc_pair.folderish)
 
     def get_processors_on(self, path, exact_match=True):
-        res = []
-        if self._local_folder_thread is not None:
-            if self.is_processing_file(self._local_folder_thread.worker, path, exact_match):
-                res.append(self._local_folder_thread.worker)
-        if self._remote_folder_thread is not None:
-            if self.is_processing_file(self._remote_folder_thread.worker, path, exact_match):
-                res.append(self._remote_folder_thread.worker)
-        if self._local_file_thread is not None:
-            if self.is_processing_file(self._local_file_thread.worker, path, exact_match):
-                res.append(self._local_file_thread.worker)
-        if self._remote_file_thread is not None:
-            if self.is_processing_file(self._remote_file_thread.worker, path, exact_match):
-                res.append(self._remote_file_thread.worker)
-        for thread in self._processors_pool:
-            if self.is_processing_file(thread.worker, path, exact_match):
-                res.append(thread.worker)
+        # The path and its descendants if not exact_match
+        res = self._processing.get_workers(path, exact_match)
+        if res:
+            log.trace("Workers %r are processing: %s", res, path)
         return res
 
     def has_file_processors_on(self, path):
-        # First check local and remote file
-        if self._local_file_thread is not None:
-            if self.is_processing_file(self._local_file_thread.worker, path):
-                return True
-        if self._remote_file_thread is not None:
-            if self.is_processing_file(self._remote_file_thread.worker, path):
-                return True
-        for thread in self._processors_pool:
-            if self.is_processing_file(thread.worker, path):
-                return True
-        return False
+        return self._processing.has_files(path)
 
     @pyqtSlot()
     def launch_processors(self):
-        if (self._disable or (self._local_folder_queue.empty() and self._local_file_queue.empty()
-                and self._remote_folder_queue.empty() and self._remote_file_queue.empty())):
+        if self._disable or len([queue for queue in self._get_queues() if not queue.empty()]) == 0:
             self.queueEmpty.emit()
             if not self.is_active():
                 self.queueFinishedProcessing.emit()
             return
         log.trace("Launching processors")
-        if self._local_folder_thread is None and not self._local_folder_queue.empty() and self._local_folder_enable:
+        if (self._local_folder_thread is None and self._local_folder_enable
+                and not (self._local_folder_queue.empty() and self._local_folder_creation_queue.empty())):
             log.debug("creating local folder processor")
             self._local_folder_thread = self._create_thread(self._get_local_folder, name="LocalFolderProcessor")
         if self._local_file_thread is None and not self._local_file_queue.empty() and self._local_file_enable:
@@ -419,7 +1118,15 @@ class QueueManager(QObject):
         if self._remote_file_thread is None and not self._remote_file_queue.empty() and self._remote_file_enable:
             log.debug("creating remote file processor")
             self._remote_file_thread = self._create_thread(self._get_remote_file, name="RemoteFileProcessor")
-        if self._remote_file_queue.qsize() + self._local_file_queue.qsize() == 0:
+        while len(self._processors_pool) > self._max_processors:
+            log.debug("draining additional file processor")
+            # Let it finish its current transfer, it ends on its next item
+            thread = self._processors_pool.pop()
+            thread.worker.drain()
+            self._draining_pool.append(thread)
+            self.wake_processors()
+        if (self._remote_file_queue.qsize() + self._local_file_queue.qsize()
+                + self._local_folder_creation_queue.qsize() == 0):
             return
         while len(self._processors_pool) < self._max_processors:
             log.debug("creating additional file processor")
@@ -83,6 +83,9 @@ class Tracker(Worker):
         for _, engine in engines.iteritems():
             stats = engine.get_metrics()
             for key, value in stats.iteritems():
+                # Only the counters, not the detailed metrics like the SQL statistics
+                if not isinstance(value, (int, long, float)):
+                    continue
                 log.trace("Send Statistics(Engine) %s:%d", key, value)
                 self._tracker.send('event', category='Statistics', action='Engine', label=key, value=value)
         self._stat_timer.start(60 * 60 * 1000)
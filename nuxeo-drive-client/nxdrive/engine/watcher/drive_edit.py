@@ -107,6 +107,8 @@ class DriveEdit(Worker):
             # TO_REVIEW Display an error message
             log.debug("No engine found for %s(%s)", server_url, doc_id)
             return
+        # Synchronize the document first if it is also in the local folder
+        engine.get_queue_manager().add_priority_ref(doc_id)
         # Get document info
         remote_client = engine.get_remote_doc_client()
         # Avoid any link with the engine, remote_doc are not cached so we can do that
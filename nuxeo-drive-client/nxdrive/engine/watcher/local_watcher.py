@@ -138,11 +138,13 @@ class LocalWatcher(EngineWorker):
         self._protected_files = dict()
 
         info = self.client.get_info(u'/')
-        self._scan_recursive(info)
-        for deleted in self._delete_files:
-            if deleted in self._protected_files:
-                continue
-            self._dao.delete_local_state(self._delete_files[deleted])
+        # Commit the deletions of the scan together, the folders are committed one by one
+        with self._dao.group_commit():
+            self._scan_recursive(info)
+            for deleted in self._delete_files:
+                if deleted in self._protected_files:
+                    continue
+                self._dao.delete_local_state(self._delete_files[deleted])
         self._metrics['last_local_scan_time'] = current_milli_time() - start_ms
         log.debug("Full scan finished in %dms", self._metrics['last_local_scan_time'])
         self._local_scan_finished = True
@@ -164,18 +166,35 @@ class LocalWatcher(EngineWorker):
 
     def _scan_recursive(self, info, recursive=True):
         self._interact()
+        # Commit the states of each folder together
+        with self._dao.group_commit():
+            to_scan_new, to_scan = self._scan_folder(info)
+
+        for child_info in to_scan_new:
+            self._scan_recursive(child_info)
+
+        if not recursive:
+            return
+
+        for child_info in to_scan:
+            self._scan_recursive(child_info)
+
+    def _scan_folder(self, info):
         # Load all children from FS
         # detect recently deleted children
         try:
             fs_children_info = self.client.get_children_info(info.path)
         except OSError:
             # The folder has been deleted in the mean time
-            return
+            return [], []
         db_children = self._dao.get_local_children(info.path)
         # Create a list of all children by their name
         children = dict()
         to_scan = []
         to_scan_new = []
+        # New children inserted together at the end of the loop
+        new_infos = []
+        new_digests = []
         for child in db_children:
             children[child.local_name] = child
 
@@ -188,8 +207,10 @@ class LocalWatcher(EngineWorker):
                     remote_id = self.client.get_remote_id(child_info.path)
                     if remote_id is None:
                         log.debug("Found new %s %s", child_type, child_info.path)
+                        # Computed here so a locked or vanished file only skips this child
+                        new_digests.append(child_info.get_digest())
+                        new_infos.append(child_info)
                         self._metrics['new_files'] = self._metrics['new_files'] + 1
-                        self._dao.insert_local_state(child_info, info.path)
                     else:
                         log.debug("Found potential moved file %s[%s]", child_info.path, remote_id)
                         doc_pair = self._dao.get_normal_state_from_remote(remote_id)
@@ -299,6 +320,18 @@ class LocalWatcher(EngineWorker):
                     self.increase_error(child_pair, "SCAN RECURSIVE", exception=e)
                     continue
 
+        try:
+            self._dao.insert_local_states(new_infos, info.path, digests=new_digests)
+        except Exception:
+            log.warn('Cannot insert the new children of %r together, inserting them one by one', info.path,
+                     exc_info=True)
+            for child_info in new_infos:
+                try:
+                    self._dao.insert_local_state(child_info, info.path)
+                except Exception:
+                    log.error('Error during recursive scan of %r, ignoring until next full scan', child_info.path,
+                              exc_info=True)
+
         for deleted in children.values():
             if deleted.pair_state == "remotely_created":
                 continue
@@ -309,15 +342,7 @@ class LocalWatcher(EngineWorker):
                 self._dao.remove_state(deleted)
             else:
                 self._delete_files[deleted.remote_ref] = deleted
-
-        for child_info in to_scan_new:
-            self._scan_recursive(child_info)
-
-        if not recursive:
-            return
-
-        for child_info in to_scan:
-            self._scan_recursive(child_info)
+        return to_scan_new, to_scan
 
     def _setup_watchdog(self):
         from watchdog.observers import Observer
@@ -80,6 +80,10 @@ class RemoteWatcher(EngineWorker):
                     self._current_interval = self.server_interval * 100
                     if self._handle_changes(first_pass):
                         first_pass = False
+                    # Keep the query planner statistics up to date
+                    self._dao.analyze()
+                    # Reclaim the pages freed by the deleted states
+                    self._dao.incremental_vacuum()
                 else:
                     self._current_interval = self._current_interval - 1
                 sleep(0.01)
@@ -105,8 +109,9 @@ class RemoteWatcher(EngineWorker):
             return
         self._get_changes()
         self._save_changes_state()
-        # recursive update
-        self._scan_remote_recursive(from_state, remote_info)
+        # recursive update, committed by batch of states
+        with self._dao.group_commit():
+            self._scan_remote_recursive(from_state, remote_info)
         self._last_remote_full_scan = datetime.utcnow()
         self._dao.update_config('remote_last_full_scan', self._last_remote_full_scan)
         self._dao.clean_scanned()
@@ -212,6 +217,10 @@ class RemoteWatcher(EngineWorker):
         db_children = self._dao.get_remote_children(doc_pair.remote_ref)
         children = dict()
         to_scan = []
+        # Children updated and created together once all of them are scanned
+        to_update = []
+        new_infos = []
+        new_paths = []
         for child in db_children:
             children[child.remote_ref] = child
 
@@ -223,11 +232,21 @@ class RemoteWatcher(EngineWorker):
                 child_pair = children.pop(child_info.uid)
                 if self._check_modified(child_pair, child_info):
                     child_pair.remote_state = 'modified'
-                self._dao.update_remote_state(child_pair, child_info, remote_parent_path)
+                to_update.append((child_pair, child_info))
             else:
+                local_path = path_join(doc_pair.local_path, safe_filename(child_info.name))
+                if self._dao.get_state_from_local(local_path) is None:
+                    # Nothing to match locally
+                    new_infos.append(child_info)
+                    new_paths.append(local_path)
+                    continue
                 child_pair, new_pair = self._find_remote_child_match_or_create(doc_pair, child_info)
             if ((new_pair or force_recursion) and remote_info.folderish):
                     to_scan.append((child_pair, child_info))
+        self._dao.update_remote_states(to_update, remote_parent_path)
+        row_ids = self._dao.insert_remote_states(new_infos, remote_parent_path, new_paths, doc_pair.local_path)
+        for row_id, child_info in zip(row_ids, new_infos):
+            to_scan.append((self._dao.get_state_from_id(row_id, from_write=True), child_info))
         # Delete remaining
         for deleted in children.values():
             # TODO Should be DAO
@@ -286,7 +305,8 @@ class RemoteWatcher(EngineWorker):
         if path == '/':
             self._scan_remote()
         else:
-            self._scan_pair(path)
+            with self._dao.group_commit():
+                self._scan_pair(path)
         self._dao.delete_path_to_scan(path)
         self._dao.delete_config('remote_need_full_scan')
         self._dao.clean_scanned()
@@ -349,7 +369,9 @@ class RemoteWatcher(EngineWorker):
                     self._partial_full_scan(remote_ref)
                     paths = self._dao.get_paths_to_scan()
             self._action = Action("Handle remote changes")
-            self._update_remote_states()
+            # Commit the changes before saving the last event log id
+            with self._dao.group_commit():
+                self._update_remote_states()
             self._save_changes_state()
             if first_pass:
                 self.initiate.emit()
@@ -375,9 +397,9 @@ class RemoteWatcher(EngineWorker):
         return False
 
     def _save_changes_state(self):
-        self._dao.update_config('remote_last_sync_date', self._last_sync_date)
-        self._dao.update_config('remote_last_event_log_id', self._last_event_log_id)
-        self._dao.update_config('remote_last_root_definitions', self._last_root_definitions)
+        self._dao.update_configs({'remote_last_sync_date': self._last_sync_date,
+                                  'remote_last_event_log_id': self._last_event_log_id,
+                                  'remote_last_root_definitions': self._last_root_definitions})
 
     def _get_changes(self):
         """Fetch incremental change summary from the server"""
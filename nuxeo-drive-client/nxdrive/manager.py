@@ -137,14 +137,14 @@ class ProxySettings(object):
                         " please update your password to acquire a new one.")
         token = token + "_proxy"
         password = encrypt(self.password, token)
-        dao.update_config("proxy_password", password)
-        dao.update_config("proxy_username", self.username)
-        dao.update_config("proxy_exceptions", self.exceptions)
-        dao.update_config("proxy_port", self.port)
-        dao.update_config("proxy_type", self.proxy_type)
-        dao.update_config("proxy_config", self.config)
-        dao.update_config("proxy_server", self.server)
-        dao.update_config("proxy_authenticated", self.authenticated)
+        dao.update_configs({"proxy_password": password,
+                            "proxy_username": self.username,
+                            "proxy_exceptions": self.exceptions,
+                            "proxy_port": self.port,
+                            "proxy_type": self.proxy_type,
+                            "proxy_config": self.config,
+                            "proxy_server": self.server,
+                            "proxy_authenticated": self.authenticated})
 
     def load(self, dao, token=None):
         self.config = dao.get_config("proxy_config", "System")
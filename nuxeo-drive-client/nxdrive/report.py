@@ -4,6 +4,7 @@ Created on 6 mai 2015
 @author: Remi Cattiau
 '''
 import os
+import tempfile
 from datetime import datetime
 from nxdrive.logging_config import get_logger, get_handler, MAX_LOG_DISPLAYED
 from zipfile import ZipFile
@@ -32,6 +33,17 @@ class Report(object):
         self._zipfile = os.path.join(folder, self._report_name + '.zip')
 
     def copy_db(self, myzip, dao):
+        # Online backup in a temporary file then streamed to the zip, the writers keep working
+        fd, path = tempfile.mkstemp(suffix='.db', prefix='report_')
+        os.close(fd)
+        try:
+            if dao.backup(path):
+                myzip.write(path, os.path.basename(dao.get_db()))
+                return
+        except Exception as e:
+            log.warn("Online backup of %s failed, copy it locked: %r", dao.get_db(), e)
+        finally:
+            os.remove(path)
         # Lock to avoid inconsistence
         dao._lock.acquire()
         try:
@@ -29,9 +29,9 @@ class RemoteTestClient(RemoteFileSystemClient):
             upload_tmp_dir, check_suspended)
         self._upload_remote_error = None
 
-    def do_get(self, url, file_out=None):
+    def do_get(self, url, file_out=None, digest=None, digest_algorithm=None, digests=None):
         if self._upload_remote_error is None:
-            super(RemoteTestClient, self).do_get(url, file_out)
+            return super(RemoteTestClient, self).do_get(url, file_out, digest, digest_algorithm, digests)
         else:
             raise self._upload_remote_error
 
@@ -0,0 +1,51 @@
+"""Fake engine objects for the unit tests of the engine components"""
+from PyQt4.QtCore import QObject, pyqtSignal
+
+
+class FakeEngine(QObject):
+    '''
+    Engine giving its DAO and QueueManager to the workers, without any
+    client or watcher
+    '''
+    invalidClientsCache = pyqtSignal()
+
+    def __init__(self, dao, queue_manager=None):
+        super(FakeEngine, self).__init__()
+        self.stopped = False
+        self.queue_manager = queue_manager
+        self._dao = dao
+
+    def get_uid(self):
+        return "engine"
+
+    def get_dao(self):
+        return self._dao
+
+    def get_queue_manager(self):
+        return self.queue_manager
+
+    def is_stopped(self):
+        return self.stopped
+
+    def cancel_action_on(self, ref_id):
+        pass
+
+
+class FakeQueueManager(object):
+    '''
+    Record the pairs pushed by the DAO, with their queue fields
+    '''
+    def __init__(self):
+        self.pushed = []
+
+    def init_queue_windows(self):
+        pass
+
+    def push_ref(self, row_id, folderish, pair_state, **fields):
+        self.pushed.append((row_id, fields))
+
+    def get_pushed_ids(self):
+        return [row_id for row_id, _ in self.pushed]
+
+    def set_processing(self, worker, doc_pair):
+        pass
@@ -4,7 +4,7 @@ Created on 2 juil. 2015
 @author: Remi Cattiau
 '''
 import unittest
-from nxdrive.engine.blacklist_queue import BlacklistQueue
+from nxdrive.engine.blacklist_queue import BlacklistQueue, RetryScheduler
 from time import sleep
 
 
@@ -53,3 +53,36 @@ class BlacklistQueueTest(unittest.TestCase):
         self.assertEquals(item._count, 3)
         item = queue.get()
         self.assertIsNone(item)
+
+
+class RetrySchedulerTest(unittest.TestCase):
+
+    def testOrder(self):
+        scheduler = RetryScheduler()
+        scheduler.push(1, "Item1", 30)
+        scheduler.push(2, "Item2", 10)
+        scheduler.push(3, "Item3", 20)
+        self.assertEquals(len(scheduler), 3)
+        self.assertEquals(scheduler.get_next_try(), 10)
+        # Reschedule and cancel
+        scheduler.push(2, "Item2", 40)
+        self.assertEquals(scheduler.cancel(3), "Item3")
+        self.assertIsNone(scheduler.cancel(3))
+        self.assertEquals(scheduler.get_next_try(), 30)
+        self.assertEquals(scheduler.pop_all(cur_time=31), ["Item1"])
+        self.assertIsNone(scheduler.pop(cur_time=40))
+        self.assertEquals(len(scheduler), 1)
+        # Everything is ready once released
+        scheduler.push(4, "Item4", 50)
+        scheduler.release_all()
+        self.assertEquals(sorted(scheduler.pop_all(cur_time=1)), ["Item2", "Item4"])
+        self.assertEquals(len(scheduler), 0)
+        self.assertIsNone(scheduler.get_next_try())
+
+    def testBackoff(self):
+        self.assertEquals(RetryScheduler.get_backoff(60, 1, jitter=0), 60)
+        self.assertEquals(RetryScheduler.get_backoff(60, 3, jitter=0), 240)
+        self.assertEquals(RetryScheduler.get_backoff(60, 5, jitter=0, max_delay=600), 600)
+        for _ in range(10):
+            delay = RetryScheduler.get_backoff(60, 2)
+            self.assertTrue(108 <= delay <= 132)
@@ -6,10 +6,17 @@ Created on 31 mars 2015
 import unittest
 import os
 import sys
+import sqlite3
 import nxdrive
-from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.dao.sqlite import EngineDAO, STATE_COLUMNS
 from nxdrive.engine.engine import Engine
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+from nxdrive.client.local_client import FileInfo
+from nxdrive.tests.fakes import FakeQueueManager
 import tempfile
+from threading import Thread, Event
+import time
+from datetime import datetime
 
 
 class EngineDAOTest(unittest.TestCase):
@@ -75,7 +82,12 @@ class EngineDAOTest(unittest.TestCase):
         self._dao = EngineDAO(migrate_db.name)
         c = self._dao._get_read_connection().cursor()
         cols = c.execute("PRAGMA table_info('States')").fetchall()
-        self.assertEquals(len(cols), 30)
+        self.assertEquals(len(cols), 29)
+        # The error details moved out of States are still read with the errors
+        self.assertEquals([(error.id, error.last_error_details) for error in self._dao.get_errors()],
+                          [(50, "Details")])
+        self.test_state_indexes()
+        self._check_counters()
         self.test_batch_folder_files()
         self.test_batch_upload_files()
         self.test_conflicts()
@@ -83,6 +95,562 @@ class EngineDAOTest(unittest.TestCase):
         self.test_acquire_processors()
         self.test_configuration()
 
+    def test_state_indexes(self):
+        c = self._dao._get_read_connection().cursor()
+        self.assertEquals(self._dao.get_config("schema_version"), "6")
+        plan = c.execute("EXPLAIN QUERY PLAN SELECT * FROM States WHERE local_path=?", ("/",)).fetchone()
+        self.assertIn("StatesLocalPath", plan["detail"])
+        plan = c.execute("EXPLAIN QUERY PLAN SELECT * FROM States WHERE remote_parent_ref=?", ("",)).fetchone()
+        self.assertIn("StatesRemoteParentRef", plan["detail"])
+        # Prefix searches must be a range on the index
+        plan = c.execute("EXPLAIN QUERY PLAN SELECT * FROM States WHERE local_path >= ? AND local_path < ?",
+                         ("/Folder", "/Foldes")).fetchone()
+        self.assertIn("StatesLocalPath", plan["detail"])
+
+    def test_partial_local(self):
+        folder = self._dao.get_state_from_id(2)
+        states = self._dao.get_states_from_partial_local(folder.local_path + '/')
+        self.assertTrue(len(states) > 0)
+        for state in states:
+            self.assertTrue(state.local_path.startswith(folder.local_path + '/'))
+        self.assertEquals(len(states), len([state for state in self._dao.get_states_from_partial_local('/')
+                                            if state.local_path.startswith(folder.local_path + '/')]))
+
+    def _check_counters(self):
+        # Compare the counters with a full recount
+        c = self._dao._get_read_connection().cursor()
+        counters = c.execute("SELECT pair_state, folderish, error_count, total, size FROM StatesCounters"
+                             " WHERE total > 0 ORDER BY pair_state, folderish, error_count").fetchall()
+        states = c.execute("SELECT pair_state, folderish, error_count, COUNT(*), SUM(IFNULL(size, 0)) FROM States"
+                           " GROUP BY pair_state, folderish, error_count"
+                           " ORDER BY pair_state, folderish, error_count").fetchall()
+        self.assertEquals([tuple(row) for row in counters], [tuple(row) for row in states])
+        self.assertEquals(self._dao.get_sync_count(), self._dao.get_count("pair_state='synchronized'"))
+        self.assertEquals(self._dao.get_syncing_count(), self._dao.get_count(
+            "pair_state!='synchronized' AND pair_state!='conflicted' AND pair_state!='unsynchronized'"))
+        self.assertEquals(self._dao.get_error_count(), self._dao.get_count("error_count > 3"))
+        self.assertEquals(self._dao.get_global_size(), c.execute(
+            "SELECT SUM(size) FROM States WHERE pair_state='synchronized'").fetchone()[0])
+
+    def test_state_counters(self):
+        self._check_counters()
+        self.assertEquals(self._dao.get_sync_count(filetype="folder"),
+                          self._dao.get_count("pair_state='synchronized' AND folderish=1"))
+        row = self._dao.get_state_from_id(3)
+        self._dao.increase_error(row, "Test")
+        self._dao.set_conflict_state(self._dao.get_state_from_id(4))
+        self._dao.delete_local_state(self._dao.get_state_from_id(5))
+        self._check_counters()
+        folder = self._dao.get_state_from_id(2)
+        self._dao.mark_descendants_remotely_created(folder)
+        self._check_counters()
+        self._dao.remove_state(folder)
+        self._check_counters()
+        self._dao.reinit_states()
+        self._check_counters()
+        self.assertEquals(self._dao.get_sync_count(), 0)
+        self.assertIsNone(self._dao.get_global_size())
+
+    def test_state_row(self):
+        row = self._dao.get_state_from_id(2)
+        self.assertEquals(row["local_path"], row.local_path)
+        self.assertEquals(row[row.keys().index("local_path")], row.local_path)
+        copy = row.copy()
+        self.assertEquals(copy, row)
+        copy.update_state(local_state="modified")
+        copy.error_next_try = 0
+        self.assertNotEquals(copy, row)
+        self.assertEquals(row.local_state, "synchronized")
+        self.assertFalse(hasattr(row, "error_next_try"))
+        # Expressions are available by index
+        c = self._dao._get_read_connection().cursor()
+        self.assertEquals(c.execute("SELECT COUNT(*), id FROM States WHERE id=2").fetchone()[0], 1)
+
+    def test_recursive_update(self):
+        folder = self._dao.get_state_from_id(2)
+        children = self._dao.get_states_from_partial_local(folder.local_path + '/')
+        c = self._dao._get_read_connection().cursor()
+        plan = c.execute("EXPLAIN QUERY PLAN SELECT * FROM States" + self._dao._get_recursive_condition(folder),
+                         self._dao._get_recursive_params(folder)).fetchall()
+        self.assertIn("StatesLocalPath", plan[0]["detail"])
+        # Move the subtree with a name that needs escaping
+        self._dao.update_remote_parent_path(folder, u"/new")
+        self._dao.update_local_parent_path(folder, u"Folder's", '/')
+        moved = self._dao.get_states_from_partial_local(u"/Folder's/")
+        self.assertEquals(len(moved), len(children))
+        for state in moved:
+            self.assertTrue(state.local_parent_path.startswith(u"/Folder's"))
+            self.assertTrue(state.remote_parent_path.startswith(u"/new/" + folder.remote_ref))
+        self.assertEquals(len(self._dao.get_states_from_partial_local(folder.local_path + '/')), 0)
+        folder.local_path = u"/Folder's"
+        self._dao.remove_state(folder)
+        self.assertEquals(len(self._dao.get_states_from_partial_local(u"/Folder's/")), 0)
+        self.assertIsNotNone(self._dao.get_state_from_local('/'))
+
+    def test_incremental_vacuum(self):
+        # Existing database converted by the first incremental vacuum
+        self.assertEquals(self._dao.incremental_vacuum(), 0)
+        self._check_incremental_vacuum(self._dao)
+
+    def test_incremental_vacuum_wal(self):
+        # New database
+        wal_db = self.get_db_temp_file()
+        if sys.platform != 'win32':
+            os.remove(wal_db.name)
+        dao = EngineDAO(wal_db.name, wal=True)
+        self._check_incremental_vacuum(dao)
+        self._clean_dao(dao)
+        # Database migrated from a version without incremental vacuum
+        migrate_db = self.get_db_temp_file()
+        db = open(self._get_default_db('test_engine_migration.db'), 'rb')
+        with open(migrate_db.name, 'wb') as f:
+            f.write(db.read())
+        dao = EngineDAO(migrate_db.name, wal=True)
+        # Not converted during the start but by the first incremental vacuum
+        con = dao._get_write_connection()
+        self.assertEquals(con.execute("PRAGMA auto_vacuum").fetchone()[0], 0)
+        self.assertEquals(dao.incremental_vacuum(), 0)
+        self._check_incremental_vacuum(dao)
+        self._clean_dao(dao)
+
+    def _check_incremental_vacuum(self, dao):
+        # The mode is cached by the connections opened before a conversion, check the one vacuuming
+        con = dao._get_write_connection()
+        self.assertEquals(con.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        c = dao._get_read_connection().cursor()
+        con.executemany("INSERT INTO Filters(path) VALUES(?)", [("/" + "a" * 200 + str(i),) for i in range(5000)])
+        con.commit()
+        con.execute("DELETE FROM Filters")
+        con.commit()
+        free_pages = c.execute("PRAGMA freelist_count").fetchone()[0]
+        self.assertTrue(free_pages > 10)
+        # Nothing to do under the threshold
+        dao.VACUUM_THRESHOLD = free_pages + 1
+        self.assertEquals(dao.incremental_vacuum(), 0)
+        dao.VACUUM_THRESHOLD = 1
+        self.assertEquals(dao.incremental_vacuum(max_pages=10), 10)
+        self.assertEquals(c.execute("PRAGMA freelist_count").fetchone()[0], free_pages - 10)
+
+    def test_wal_mode(self):
+        wal_db = self.get_db_temp_file()
+        if sys.platform != 'win32':
+            os.remove(wal_db.name)
+        dao = EngineDAO(wal_db.name, wal=True, pragmas={"cache_size": -4096, "synchronous": "FULL; DROP"})
+        c = dao._get_read_connection().cursor()
+        self.assertEquals(c.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEquals(c.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        self.assertEquals(c.execute("PRAGMA cache_size").fetchone()[0], -4096)
+        # NORMAL is the default with WAL, invalid values are ignored
+        self.assertEquals(c.execute("PRAGMA synchronous").fetchone()[0], 1)
+        # Readers keep reading the last committed data during a write
+        dao.auto_commit = False
+        dao.update_config("wal", "1")
+        self.assertIsNone(dao.get_config("wal"))
+        dao.commit()
+        dao.auto_commit = True
+        self.assertEquals(dao.get_config("wal"), "1")
+        dao.analyze(force=True)
+        self._clean_dao(dao)
+
+    def test_writer_thread(self):
+        writer_db = self.get_db_temp_file()
+        db = open(self._get_default_db(), 'rb')
+        with open(writer_db.name, 'wb') as f:
+            f.write(db.read())
+        dao = EngineDAO(writer_db.name, writer=True)
+        results = []
+        threads = []
+
+        def synchronize(row_id):
+            row = dao.get_state_from_id(row_id)
+            results.append(dao.acquire_processor(row_id, row_id))
+            results.append(dao.synchronize_state(row))
+            dao.dispose_thread()
+        for row_id in range(3, 13):
+            threads.append(Thread(target=synchronize, args=(row_id,)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(results, [True] * 20)
+        for row_id in range(3, 13):
+            self.assertEquals(dao.get_state_from_id(row_id).processor, 0)
+        # Write without waiting for the result
+        future = dao.submit_write(dao.update_last_transfer, 3, "download")
+        self.assertIsNone(future.result(5))
+        self.assertEquals(dao.get_state_from_id(3).last_transfer, "download")
+        self.assertEquals(dao.get_write_queue_size(), 0)
+        writer = dao._writer
+        self._clean_dao(dao)
+        self.assertFalse(writer.is_alive())
+
+    def test_writer_stop_timeout(self):
+        dao = EngineDAO(self.get_db_temp_file().name, writer=True)
+        writer = dao._writer
+        writer.STOP_TIMEOUT = 0.5
+        blocked = Event()
+        # A write that never ends must not block the stop
+        dao.submit_write(blocked.wait)
+        start = time.time()
+        writer.stop()
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(writer.is_alive())
+        blocked.set()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        dao._writer = None
+        self._clean_dao(dao)
+
+    def _get_writer_dao(self):
+        writer_db = self.get_db_temp_file()
+        db = open(self._get_default_db(), 'rb')
+        with open(writer_db.name, 'wb') as f:
+            f.write(db.read())
+        return EngineDAO(writer_db.name, writer=True)
+
+    def test_writer_commit_error(self):
+        dao = self._get_writer_dao()
+        commit = dao._commit
+        errors = []
+
+        def failing_commit(con):
+            if not errors:
+                errors.append(1)
+                raise sqlite3.OperationalError("database is locked")
+            commit(con)
+        dao._commit = failing_commit
+        # The failed commit is reported to the caller and the writer goes on
+        self.assertRaises(sqlite3.OperationalError, dao.update_last_transfer, 3, "download")
+        self.assertTrue(dao._writer.is_alive())
+        dao.update_last_transfer(3, "upload")
+        self.assertEquals(dao.get_state_from_id(3).last_transfer, "upload")
+        self._clean_dao(dao)
+
+    def test_writer_timeout(self):
+        dao = self._get_writer_dao()
+        writer = dao._writer
+        writer.WRITE_TIMEOUT = 0.2
+        blocked = Event()
+        dao.submit_write(blocked.wait)
+        # Executed in the caller thread when the writer is stuck
+        dao.update_last_transfer(3, "download")
+        self.assertEquals(dao.get_state_from_id(3).last_transfer, "download")
+        dao.update_last_transfer(3, "upload")
+        blocked.set()
+        # The cancelled writes are not executed again by the writer
+        dao.submit_write(dao.update_last_transfer, 4, "download").result(5)
+        self.assertEquals(dao.get_state_from_id(3).last_transfer, "upload")
+        self._clean_dao(dao)
+
+    def test_queue_window(self):
+        from nxdrive.engine.queue_manager import WindowQueue, QueueItem
+        con = self._dao._get_write_connection()
+        con.execute("UPDATE States SET pair_state='locally_modified' WHERE local_parent_path='/SmallFolder/Test'")
+        con.commit()
+        condition = "pair_state LIKE 'locally%' AND folderish = 0"
+        queue = WindowQueue(self._dao, condition, 5)
+        queue.start_window()
+        self.assertEquals(queue.qsize(), 5)
+        self.assertTrue(queue.has_spilled())
+
+        def drain(max_size=5):
+            ids = []
+            while True:
+                queue.refill()
+                if queue.empty():
+                    return ids
+                self.assertLessEqual(queue.qsize(), max_size)
+                ids.append(queue.get().id)
+        # The file of the remotely created folder is not queued on startup
+        self.assertEquals(drain(), range(25, 47))
+        self.assertFalse(queue.has_spilled())
+        # The items pushed to a full queue are read back from the database,
+        # but the childs of a folder to synchronize and the pairs in error
+        con.execute("UPDATE States SET error_count=1 WHERE id=40")
+        con.commit()
+        for row_id in range(25, 31) + [50]:
+            queue.put(QueueItem(row_id, False, 'locally_modified'))
+        self.assertEquals(queue.qsize(), 5)
+        self.assertTrue(queue.has_spilled())
+        # The retries of the error queue are kept in memory
+        queue.put(QueueItem(40, False, 'locally_modified', error_count=1))
+        self.assertEquals(queue.qsize(), 6)
+        ids = drain(max_size=6)
+        self.assertEquals(ids[:5], range(25, 30))
+        self.assertEquals(ids.count(40), 1)
+        self.assertNotIn(50, ids)
+        self.assertEquals(sorted(set(ids[5:])), range(25, 47))
+        self.assertFalse(queue.has_spilled())
+        con.execute("UPDATE States SET error_count=0 WHERE id=40")
+        con.commit()
+        # The pushes of an item already queued are merged
+        queue.put(QueueItem(25, False, 'locally_modified'))
+        queue.put(QueueItem(25, False, 'locally_created'))
+        self.assertEquals(queue.qsize(), 1)
+        self.assertEquals(queue.coalesced, 1)
+        self.assertEquals(queue.get().pair_state, 'locally_created')
+        queue.put(QueueItem(25, False, 'locally_modified'))
+        self.assertEquals(queue.qsize(), 1)
+
+    def test_queue_priority(self):
+        from nxdrive.engine.queue_manager import WindowQueue, QueueItem, QueuePriority
+        priority = QueuePriority(["smallest", "drive_edit"])
+        priority.SIZE_RATE = 1000
+        priority.add_edit_ref("edited")
+        queue = WindowQueue(self._dao, "folderish = 0", 10, priority=priority)
+
+        def get_item(row_id, size, remote_ref=None):
+            return QueueItem(row_id, False, 'locally_modified', '/File%d' % row_id, remote_ref, size)
+        self.assertEquals(priority.get_delay(get_item(1, 10 ** 9)), priority.MAX_DELAY + priority.DRIVE_EDIT_DELAY)
+        queue.put(get_item(1, 100000))
+        queue.put(get_item(2, 10))
+        queue.put(get_item(3, 10, "defaultFileSystemItemFactory#default#edited"))
+        self.assertEquals([item.id for item in queue.get_items()], [3, 2, 1])
+        self.assertEquals(queue.get().id, 3)
+        self.assertEquals(queue.get_waits().keys(), ["high"])
+        # The DriveEdit priority expires once the document is processed
+        self.assertEquals(priority.get_delay(get_item(3, 0, "defaultFileSystemItemFactory#default#edited")),
+                          priority.DRIVE_EDIT_DELAY)
+        # An item waits at most its delay
+        priority.DRIVE_EDIT_DELAY = 0
+        queue.put(get_item(4, 100))
+        time.sleep(0.2)
+        queue.put(get_item(5, 10))
+        self.assertEquals([queue.get().id for _ in range(4)], [4, 5, 2, 1])
+
+    def test_queue_fields(self):
+        queue_manager = FakeQueueManager()
+        self._dao.register_queue_manager(queue_manager)
+        row = self._dao.get_state_from_id(3)
+        self._dao.force_remote(row)
+        # The pair is not read again by the queue priorities
+        self.assertEquals(queue_manager.pushed, [(3, {"local_path": row.local_path, "remote_ref": row.remote_ref, "size": row.size,
+                                        "last_local_updated": row.last_local_updated,
+                                        "last_remote_updated": row.last_remote_updated})])
+
+    def test_backup(self):
+        from nxdrive.engine.dao.sqlite import OnlineBackup
+        if not OnlineBackup.is_available():
+            raise unittest.SkipTest("No sqlite library for the online backup")
+        backup_db = self.get_db_temp_file()
+        self._dao.BACKUP_PAGES = 1
+        self._dao.update_config("backup", "1")
+        self.assertTrue(self._dao.backup(backup_db.name))
+        dao = EngineDAO(backup_db.name)
+        self.assertEquals(dao.get_config("backup"), "1")
+        self.assertEquals(len(dao.get_states_from_partial_local('/')),
+                          len(self._dao.get_states_from_partial_local('/')))
+        self._clean_dao(dao)
+
+    def test_backup_restarts(self):
+        from nxdrive.engine.dao.sqlite import OnlineBackup
+        import sqlite3
+        if not OnlineBackup.is_available():
+            raise unittest.SkipTest("No sqlite library for the online backup")
+        backup_db = self.get_db_temp_file()
+        backup = OnlineBackup(self._dao.get_db(), backup_db.name, 1, 0.01)
+        backup.MAX_RESTARTS = 1
+        done = Event()
+
+        def write():
+            i = 0
+            while not done.is_set():
+                i += 1
+                self._dao.update_config("backup", str(i))
+            self._dao.dispose_thread()
+        thread = Thread(target=write)
+        thread.start()
+        try:
+            # The writes are never blocked by a copy of the whole database
+            self.assertRaises(sqlite3.OperationalError, backup.run)
+        finally:
+            done.set()
+            thread.join()
+
+    def test_sql_stats(self):
+        stats_db = self.get_db_temp_file()
+        db = open(self._get_default_db(), 'rb')
+        with open(stats_db.name, 'wb') as f:
+            f.write(db.read())
+        self.assertIsNone(self._dao.get_sql_stats())
+        self.assertNotIn("sql", self._dao.get_metrics())
+        dao = EngineDAO(stats_db.name, stats=True)
+        for row_id in range(3, 13):
+            dao.get_state_from_id(row_id)
+        dao.update_last_transfer(3, "download")
+        dao.get_states_from_partial_local('/')
+        stats = dao.get_sql_stats(limit=None)
+        self.assertIn("lock", stats["lock_waits"])
+        statements = dict((statement["template"], statement) for statement in stats["statements"])
+        statement = statements["SELECT " + STATE_COLUMNS + " FROM States WHERE id=?"]
+        self.assertEquals(statement["count"], 10)
+        self.assertEquals(statement["rows"], 10)
+        self.assertGreaterEqual(statement["p99"], statement["p50"])
+        self.assertTrue(any("last_transfer" in template for template in statements))
+        # The query plan is given for the statements taking the most time
+        plans = [statement["plan"] for statement in stats["statements"] if "plan" in statement]
+        self.assertTrue(any(plan for plan in plans))
+        self.assertNotIn("sql", dao.get_metrics())
+        # A summary without the plans is in the engine metrics
+        engine = type("MetricsEngine", (object,), dict(SQL_METRICS_STATEMENTS=2, get_metrics=Engine.get_metrics.im_func))()
+        engine._dao = dao
+        engine._invalid_credentials = False
+        sql = engine.get_metrics()["sql"]
+        self.assertEquals(len(sql["statements"]), 2)
+        self.assertFalse(any("plan" in statement for statement in sql["statements"]))
+        engine._dao = self._dao
+        self.assertNotIn("sql", engine.get_metrics())
+        self._clean_dao(dao)
+
+    def _check_state_index(self, dao):
+        index = dao._state_index
+        c = dao._get_read_connection().cursor()
+        rows = c.execute("SELECT " + STATE_COLUMNS + " FROM States").fetchall()
+        self.assertEquals(len(index), len(rows))
+        for row in rows:
+            self.assertEquals(dao.get_state_from_id(row.id), row)
+            self.assertEquals(dao.get_state_from_local(row.local_path), c.execute(
+                "SELECT " + STATE_COLUMNS + " FROM States WHERE local_path=? ORDER BY id", (row.local_path,)).fetchone())
+            self.assertEquals(dao.get_states_from_remote(row.remote_ref), c.execute(
+                "SELECT " + STATE_COLUMNS + " FROM States WHERE remote_ref=? ORDER BY id", (row.remote_ref,)).fetchall())
+
+    def test_state_index(self):
+        self._clean_dao(self._dao)
+        self._dao = EngineDAO(self.tmp_db.name, state_index=True)
+        self._check_state_index(self._dao)
+        self.assertTrue(self._dao.get_metrics()["state_index_memory"] > 0)
+        row = self._dao.get_state_from_id(3)
+        # Rows are copies
+        row.local_state = "moved"
+        self.assertEquals(self._dao.get_state_from_id(3).local_state, "synchronized")
+        self._dao.synchronize_state(row, state="unsynchronized")
+        self._dao.increase_error(self._dao.get_state_from_id(4), "Test")
+        folder = self._dao.get_state_from_id(2)
+        self._dao.update_local_parent_path(folder, u"Moved", '/')
+        self._check_state_index(self._dao)
+        self.assertIsNone(self._dao.get_state_from_local(folder.local_path + u"/IMG_8274.JPG"))
+        self.assertIsNotNone(self._dao.get_state_from_local(u"/Moved/IMG_8274.JPG"))
+        # Uncommitted rows of a group commit are read from the database
+        with self._dao.group_commit():
+            self._dao.remove_state(self._dao.get_state_from_id(5))
+            self.assertIsNone(self._dao.get_state_from_id(5))
+            self.assertIsNotNone(self._dao._state_index.get(5))
+        self._check_state_index(self._dao)
+        self._dao.reinit_states()
+        self.assertEquals(len(self._dao._state_index), 0)
+        self._dao.disable_state_index()
+        self.assertFalse("state_index_rows" in self._dao.get_metrics())
+
+    def _get_remote_info(self, name, uid, parent_uid, folderish=False):
+        return RemoteFileInfo(name, uid, parent_uid, "/" + uid, folderish, datetime.utcnow(), "user",
+                              "digest" + uid, "md5", None, True, True, True, folderish)
+
+    def test_bulk_states(self):
+        parent = self._dao.get_state_from_id(2)
+        infos = [self._get_remote_info(u"Bulk %d" % i, u"bulk#%d" % i, parent.remote_ref) for i in range(10)]
+        paths = [parent.local_path + u"/Bulk %d" % i for i in range(10)]
+        remote_parent_path = parent.remote_parent_path + "/" + parent.remote_ref
+        row_ids = self._dao.insert_remote_states(infos, remote_parent_path, paths, parent.local_path)
+        self.assertEquals(len(row_ids), 10)
+        for row_id, info, path in zip(row_ids, infos, paths):
+            row = self._dao.get_state_from_id(row_id)
+            self.assertEquals(row.remote_ref, info.uid)
+            self.assertEquals(row.local_path, path)
+            self.assertEquals(row.pair_state, "remotely_created")
+        # Only the changed rows are updated
+        rows = [self._dao.get_state_from_id(row_id) for row_id in row_ids]
+        unchanged = infos[0]._replace(last_modification_time=rows[0].last_remote_updated)
+        updates = [(rows[0], unchanged), (rows[1], infos[1]._replace(name=u"Renamed"))]
+        self._dao.update_remote_states(updates, remote_parent_path)
+        self.assertEquals(self._dao.get_state_from_id(row_ids[0]).version, rows[0].version)
+        renamed = self._dao.get_state_from_id(row_ids[1])
+        self.assertEquals(renamed.remote_name, u"Renamed")
+        self.assertEquals(renamed.version, rows[1].version + 1)
+        self.assertEquals(self._dao.insert_remote_states([], remote_parent_path, [], parent.local_path), [])
+        infos = [FileInfo(unicode(self.tmpdir or tempfile.gettempdir()), u"/SmallFolder/Local %d" % i, True, datetime.utcnow())
+                 for i in range(5)]
+        row_ids = self._dao.insert_local_states(infos, u"/SmallFolder")
+        self.assertEquals([self._dao.get_state_from_id(row_id).local_path for row_id in row_ids],
+                          [info.path for info in infos])
+        # A failing batch leaves no partial rows so the children can be inserted one by one
+        infos = [FileInfo(unicode(self.tmpdir or tempfile.gettempdir()), u"/SmallFolder/Failing %d" % i, False,
+                          datetime.utcnow()) for i in range(2)]
+        self.assertRaises(Exception, self._dao.insert_local_states, infos, u"/SmallFolder", digests=["digest", object()])
+        self._dao.insert_local_state(infos[1], u"/SmallFolder")
+        self.assertIsNone(self._dao.get_state_from_local(u"/SmallFolder/Failing 0"))
+        self.assertIsNotNone(self._dao.get_state_from_local(u"/SmallFolder/Failing 1"))
+
+    def test_read_connection_pool(self):
+        connections = []
+
+        def read():
+            connections.append(self._dao._get_read_connection())
+            self._dao.get_config("remote_user")
+            self._dao.dispose_thread()
+        for _ in range(3):
+            thread = Thread(target=read)
+            thread.start()
+            thread.join()
+        # Each short-lived thread reuse the same connection
+        self.assertEquals(len(set(connections)), 1)
+        self.assertEquals(self._dao.get_read_pool_size(), 1)
+
+    def test_group_commit(self):
+        values = []
+
+        def read():
+            values.append(self._dao.get_config("group"))
+            self._dao.dispose_thread()
+
+        def check(expected):
+            thread = Thread(target=read)
+            thread.start()
+            thread.join()
+            self.assertEquals(values.pop(), expected)
+        callbacks = []
+        with self._dao.group_commit(max_rows=2):
+            self._dao.update_config("group", "1")
+            self._dao._after_commit(callbacks.append, "1")
+            # Visible to the writing thread only
+            self.assertEquals(self._dao.get_config("group"), "1")
+            check(None)
+            self.assertEquals(len(callbacks), 0)
+            self._dao.update_config("group", "2")
+            # max_rows reached, the group has been committed
+            check("2")
+            self.assertEquals(callbacks, ["1"])
+            with self._dao.group_commit():
+                self._dao.update_config("group", "3")
+            # Nested group commit on exit
+            check("3")
+            self._dao.update_config("group", "4")
+            check("3")
+        check("4")
+        self.assertIsNone(self._dao._get_group_commit())
+
+    def test_group_commit_error(self):
+        callbacks = []
+        row = self._dao.get_states_from_partial_local('/')[0]
+        try:
+            with self._dao.group_commit():
+                self._dao.update_config("group", "1")
+                self._dao.update_last_transfer(row.id, "upload")
+                self._dao._after_commit(callbacks.append, "1")
+                # The pending writes are read with the row factory of the DAO
+                self.assertEquals(self._dao.get_state_from_id(row.id).last_transfer, "upload")
+                self.assertEquals(self._dao.get_config("group"), "1")
+                raise ValueError("Failure in the group")
+        except ValueError:
+            pass
+        # The writes done before the error are committed as without group
+        self.assertEquals(self._dao.get_config("group"), "1")
+        self.assertEquals(self._dao.get_state_from_id(row.id).last_transfer, "upload")
+        self.assertEquals(callbacks, ["1"])
+        self.assertIsNone(self._dao._get_group_commit())
+        # The next writes are not impacted
+        self._dao.update_config("group", "2")
+        self.assertEquals(self._dao.get_config("group"), "2")
+
     def test_conflicts(self):
         self.assertEquals(self._dao.get_conflict_count(), 3)
         self.assertEquals(len(self._dao.get_conflicts()), 3)
@@ -97,10 +665,15 @@ class EngineDAOTest(unittest.TestCase):
         self.assertEquals(self._dao.get_error_count(), 0)
         row = self._dao.get_state_from_id(row.id)
         self.assertIsNone(row.last_error)
-        self.assertIsNone(row.last_error_details)
         self.assertEqual(row.error_count, 0)
+        # The error details are only read with the errors
+        self.assertNotIn("last_error_details", row.keys())
+        self.assertNotIn("last_sync_error_date", row.keys())
+        errors = [error for error in self._dao.get_errors(-1) if error.id == row.id]
+        self.assertIsNone(errors[0].last_error_details)
         # Test increase
-        self._dao.increase_error(row, "Test")
+        self._dao.increase_error(row, "Test", details="Traceback")
+        self.assertEquals(self._dao.get_errors(0)[0].last_error_details, "Traceback")
         self.assertEquals(self._dao.get_error_count(), 0)
         self._dao.increase_error(row, "Test 2")
         self.assertEquals(self._dao.get_error_count(), 0)
@@ -207,6 +780,18 @@ class EngineDAOTest(unittest.TestCase):
         self.assertEquals(result, "DefaultValue")
         result = self._dao.get_config("empty")
         self.assertEquals(result, None)
+        # The cached values are the ones read back from the database
+        values = {"int": 3, "bool": True, "str": "value", "date": datetime(2015, 6, 1, 10, 30),
+                  "remote_user": None}
+        self._dao.update_configs(values)
+        c = self._dao._get_read_connection().cursor()
+        for name in values:
+            row = c.execute("SELECT value FROM Configuration WHERE name=?", (name,)).fetchone()
+            self.assertEquals(self._dao.get_config(name), None if row is None else row.value)
+        self.assertEquals(self._dao.get_config("int"), "3")
+        self.assertEquals(self._dao.get_config("date"), "2015-06-01 10:30:00")
+        self._dao.delete_config("int")
+        self.assertIsNone(self._dao.get_config("int"))
 
     def test_filters(self):
         # Contains by default /fakeFilter/Test_Parent and /fakeFilter/Retest
@@ -218,3 +803,11 @@ class EngineDAOTest(unittest.TestCase):
         self.assertEquals(len(self._dao.get_filters()), 1)
         self._dao.add_filter(u"/otherFilter")
         self.assertEquals(len(self._dao.get_filters()), 2)
+        self.assertTrue(self._dao.is_filter(u"/fakeFilter"))
+        self.assertTrue(self._dao.is_filter(u"/fakeFilter/Test_Parent/child"))
+        self.assertFalse(self._dao.is_filter(u"/fakeFilter2"))
+        self.assertFalse(self._dao.is_filter(u"/another"))
+        allowed, filtered = self._dao.split_filtered([u"/otherFilter/a", u"/fake", u"/fakeFilter/b", u"/z"],
+                                                     lambda path: path)
+        self.assertEquals(allowed, [u"/fake", u"/z"])
+        self.assertEquals(filtered, [u"/otherFilter/a", u"/fakeFilter/b"])
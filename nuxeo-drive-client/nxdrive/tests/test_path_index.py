@@ -0,0 +1,29 @@
+import unittest
+from nxdrive.engine.queue_manager import PathIndex
+
+
+class PathIndexTest(unittest.TestCase):
+
+    def testLookups(self):
+        index = PathIndex()
+        index.add("folder", "/Folder", True)
+        index.add("file", "/Folder/Sub/File.txt", False)
+        index.add("other", "/Folder2/File.txt", False)
+        self.assertEquals(index.get_workers("/Folder"), ["folder"])
+        self.assertEquals(sorted(index.get_workers("/Folder", exact_match=False)), ["file", "folder"])
+        self.assertEquals(index.get_workers("/Folder/Sub/File.txt"), ["file"])
+        self.assertEquals(index.get_workers("/Folder/Sub"), [])
+        self.assertEquals(index.get_workers("/Missing", exact_match=False), [])
+        self.assertTrue(index.has_files("/Folder"))
+        self.assertTrue(index.has_files("/"))
+        # Moving a worker to another pair
+        index.add("file", "/Folder2/Other.txt", False)
+        self.assertFalse(index.has_files("/Folder"))
+        self.assertEquals(sorted(index.get_workers("/Folder2", exact_match=False)), ["file", "other"])
+        index.remove("file")
+        index.remove("other")
+        index.remove("other")
+        self.assertFalse(index.has_files("/"))
+        self.assertEquals(index.get_workers("/", exact_match=False), ["folder"])
+        index.remove("folder")
+        self.assertEquals(index._root.children, dict())
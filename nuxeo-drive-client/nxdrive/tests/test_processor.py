@@ -0,0 +1,187 @@
+import unittest
+import hashlib
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from StringIO import StringIO
+import nxdrive
+from nxdrive.client.local_client import FileInfo, LocalClient
+from nxdrive.client.remote_file_system_client import RemoteFileInfo, RemoteFileSystemClient
+from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.processor import Processor
+from nxdrive.tests.fakes import FakeEngine, FakeQueueManager
+
+
+class FakeLocalClient(object):
+
+    def __init__(self, on_set_remote_id):
+        self._on_set_remote_id = on_set_remote_id
+
+    def get_remote_id(self, path):
+        return None
+
+    def set_remote_id(self, path, remote_ref):
+        self._on_set_remote_id(path, remote_ref)
+
+
+class FakeRemoteClient(object):
+
+    def __init__(self, on_make_folder):
+        self._on_make_folder = on_make_folder
+
+    def make_folder(self, parent_ref, name):
+        self._on_make_folder(parent_ref, name)
+        uid = "defaultFileSystemItemFactory#default#" + name
+        return RemoteFileInfo(name, uid, parent_ref, "/" + uid, True, datetime.utcnow(), "user",
+                              None, None, None, True, True, True, True)
+
+
+class MemoryLocalClient(LocalClient):
+    '''Keep the remote ids in memory instead of the extended attributes'''
+
+    def __init__(self, base_folder):
+        super(MemoryLocalClient, self).__init__(base_folder)
+        self._remote_ids = dict()
+
+    def get_remote_id(self, ref, name="ndrive"):
+        return self._remote_ids.get(ref)
+
+    def set_remote_id(self, ref, remote_id, name="ndrive"):
+        self._remote_ids[ref] = remote_id
+
+
+class FakeOpener(object):
+
+    def __init__(self, content):
+        self._content = content
+
+    def open(self, req, timeout=None):
+        return FakeResponse(self._content)
+
+
+class FakeResponse(object):
+
+    def __init__(self, content):
+        self._stream = StringIO(content)
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def info(self):
+        return None
+
+
+class FakeDownloadClient(RemoteFileSystemClient):
+    '''Download the content through do_get without any server'''
+
+    def __init__(self, content, digest_algorithm):
+        self.server_url = 'http://localhost:8080/nuxeo/'
+        self.user_id = 'user'
+        self.check_suspended = None
+        self.blob_timeout = 60
+        self.opener = FakeOpener(content)
+        self._remote_error = None
+        self._local_error = None
+        digest = getattr(hashlib, digest_algorithm)(content).hexdigest()
+        # Created in /SmallFolder/Test
+        parent_uid = "defaultFileSystemItemFactory#default#a12ac6d3-d324-4ed2-a6b4-ddd9d8a7eb35"
+        self._info = RemoteFileInfo(u"New.txt", "uid", parent_uid, "/uid", False,
+                                    datetime.utcnow(), "user", digest, digest_algorithm, "nxfile/default/uid",
+                                    True, True, True, False)
+
+    def _get_common_headers(self):
+        return dict()
+
+    def is_filtered(self, path):
+        return False
+
+    def get_info(self, fs_item_id, parent_fs_item_id=None, raise_if_missing=True):
+        return self._info
+
+
+class ProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        db = os.path.join(self.tmpdir, "engine.db")
+        shutil.copy(os.path.join(os.path.dirname(nxdrive.__file__), 'tests', 'resources', 'test_engine.db'), db)
+        self.dao = EngineDAO(db)
+        self.queue_manager = FakeQueueManager()
+        self.dao.register_queue_manager(self.queue_manager)
+        self.processor = Processor(FakeEngine(self.dao, self.queue_manager), None)
+
+    def tearDown(self):
+        self.dao.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def _insert_folder(self, path):
+        info = FileInfo(unicode(self.tmpdir), path, True, datetime.utcnow())
+        return self.dao.get_state_from_id(self.dao.insert_local_state(info, os.path.dirname(path)))
+
+    def test_folder_creation_releases_childs(self):
+        folder = self._insert_folder(u"/SmallFolder/PLOP/New")
+        child = self._insert_folder(u"/SmallFolder/PLOP/New/Child")
+        # The child waits for the creation of its parent
+        self.assertEquals(self.queue_manager.get_pushed_ids(), [folder.id])
+        pushed = dict()
+
+        def on_make_folder(parent_ref, name):
+            pushed["make_folder"] = self.queue_manager.get_pushed_ids()
+
+        def on_set_remote_id(path, remote_ref):
+            pushed["set_remote_id"] = self.queue_manager.get_pushed_ids()
+        self.processor._synchronize_locally_created(folder, FakeLocalClient(on_set_remote_id),
+                                                    FakeRemoteClient(on_make_folder))
+        self.assertNotIn(child.id, pushed["make_folder"])
+        # Queued as soon as the remote ref of its parent is known, before the end of the parent sync
+        self.assertIn(child.id, pushed["set_remote_id"])
+        self.assertEquals(self.dao.get_state_from_id(folder.id).pair_state, 'synchronized')
+
+    def test_child_of_folder_in_creation(self):
+        folder = self._insert_folder(u"/SmallFolder/PLOP/New")
+        child = self._insert_folder(u"/SmallFolder/PLOP/New/Child")
+
+        def fail(*args):
+            self.fail("The child must wait for its parent")
+        # Processed before its parent is created: nothing is done, the parent queues it once created
+        self.processor._synchronize_locally_created(child, FakeLocalClient(fail), FakeRemoteClient(fail))
+        self.assertEquals(self.dao.get_state_from_id(child.id).pair_state, 'locally_created')
+        self.assertEquals(self.queue_manager.get_pushed_ids(), [folder.id])
+
+    def _download(self, digest_algorithm):
+        content = "New content of the file\n" * 1000
+        local_client = MemoryLocalClient(unicode(self.tmpdir))
+        local_client.make_folder(u"/", u"SmallFolder")
+        local_client.make_folder(u"/SmallFolder", u"Test")
+        remote_client = FakeDownloadClient(content, digest_algorithm)
+        parent = self.dao.get_state_from_id(21)
+        row_id = self.dao.insert_remote_state(remote_client.get_info("uid"),
+                                              parent.remote_parent_path + "/" + parent.remote_ref,
+                                              u"/SmallFolder/Test/New.txt", u"/SmallFolder/Test")
+        self.processor._current_metrics = dict()
+        reads = []
+        get_digest = FileInfo.get_digest
+
+        def counted_get_digest(info, digest_func=None):
+            reads.append(info.path)
+            return get_digest(info, digest_func=digest_func)
+        FileInfo.get_digest = counted_get_digest
+        try:
+            self.processor._synchronize_remotely_created(self.dao.get_state_from_id(row_id), local_client,
+                                                         remote_client)
+        finally:
+            FileInfo.get_digest = get_digest
+        self.assertEquals(local_client.get_content(u"/SmallFolder/Test/New.txt"), content)
+        doc_pair = self.dao.get_state_from_id(row_id)
+        self.assertEquals(doc_pair.pair_state, 'synchronized')
+        self.assertEquals(doc_pair.local_digest, local_client.get_info(u"/SmallFolder/Test/New.txt").get_digest())
+        return reads
+
+    def test_download_digest(self):
+        # The local digest is the one checked against the server, the file is not read again
+        self.assertEquals(self._download("md5"), [])
+
+    def test_download_digest_other_algorithm(self):
+        # The local digest is computed while downloading along the server one
+        self.assertEquals(self._download("sha1"), [])
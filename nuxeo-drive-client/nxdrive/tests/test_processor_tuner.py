@@ -0,0 +1,45 @@
+import unittest
+from nxdrive.engine.queue_manager import ProcessorTuner
+
+
+class ProcessorTunerTest(unittest.TestCase):
+
+    def _run_interval(self, tuner, files, errors=0, size=0):
+        # Simulate an interval of 10s
+        tuner._start -= 10
+        for _ in range(files):
+            tuner.add_sync(size)
+        for _ in range(errors):
+            tuner.add_error()
+        return tuner.tune()
+
+    def testTuning(self):
+        tuner = ProcessorTuner(3, min_processors=1, max_processors=5)
+        # Not enough measures
+        self.assertEquals(self._run_interval(tuner, 2), 3)
+        # Increase while the throughput does not drop
+        self.assertEquals(self._run_interval(tuner, 20), 4)
+        self.assertEquals(self._run_interval(tuner, 20, size=1000), 5)
+        self.assertEquals(self._run_interval(tuner, 20, size=1000), 5)
+        self.assertEquals(tuner.get_metrics()["decision"], "max")
+        # Halve on a throughput drop then hold
+        self.assertEquals(self._run_interval(tuner, 10, size=1000), 2)
+        self.assertEquals(tuner.get_metrics()["decision"], "decrease_slower")
+        self.assertEquals(self._run_interval(tuner, 10, size=1000), 2)
+        self.assertEquals(self._run_interval(tuner, 10, size=1000), 2)
+        self.assertEquals(self._run_interval(tuner, 10, size=1000), 3)
+        # Halve on errors, never under the minimum
+        self.assertEquals(self._run_interval(tuner, 10, errors=5), 1)
+        self.assertEquals(tuner.get_metrics()["decision"], "decrease_errors")
+        self.assertEquals(self._run_interval(tuner, 10, errors=5), 1)
+        # Nothing to measure without pending items
+        tuner.add_sync()
+        self.assertEquals(tuner.tune(pending=False), 1)
+        self.assertEquals(tuner.get_metrics()["decision"], "idle")
+
+    def testThroughputUnit(self):
+        tuner = ProcessorTuner(3, min_processors=1, max_processors=5)
+        self.assertEquals(self._run_interval(tuner, 20, size=1000), 4)
+        # Only files without transfer: the rates in bytes and files cannot be compared
+        self.assertEquals(self._run_interval(tuner, 10), 5)
+        self.assertEquals(tuner.get_metrics()["decision"], "increase")
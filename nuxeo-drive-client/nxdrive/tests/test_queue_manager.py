@@ -0,0 +1,170 @@
+import unittest
+import os
+import shutil
+import tempfile
+from threading import Thread
+from time import sleep
+from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.processor import Processor
+from nxdrive.engine.queue_manager import QueueManager, QueueItem
+from nxdrive.tests.fakes import FakeEngine
+
+
+class QueueManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dao = EngineDAO(os.path.join(self.tmpdir, "engine.db"))
+        self.engine = FakeEngine(self.dao)
+        self.manager = QueueManager(self.engine, self.dao)
+        self.engine.queue_manager = self.manager
+        # The processors are simulated by the test threads
+        self.manager._disable = True
+        self.items = []
+        self.threads = []
+
+    def tearDown(self):
+        self.engine.stopped = True
+        self.manager.wake_processors()
+        for thread in self.threads:
+            thread.join(5)
+        self.dao.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def _start_processor(self, getter, count=1):
+        # Wait for count items as a persistent processor, then release the last one
+        def run():
+            while len(self.items) < count and not self.engine.is_stopped():
+                item = getter(wait=True)
+                if item is not None:
+                    self.items.append(item.id)
+            getter()
+        thread = Thread(target=run)
+        thread.start()
+        self.threads.append(thread)
+        return thread
+
+    def _count_checks(self, queue):
+        # Count the times the idle processors check the queue
+        checks = []
+        empty = queue.empty
+
+        def counted_empty():
+            checks.append(1)
+            return empty()
+        queue.empty = counted_empty
+        return checks
+
+    def test_wake_on_push(self):
+        checks = self._count_checks(self.manager._local_file_queue)
+        thread = self._start_processor(self.manager._get_local_file, count=2)
+        sleep(0.5)
+        self.assertFalse(self.manager.is_active())
+        # Waiting without polling the queues
+        self.assertLessEqual(len(checks), 2)
+        self.manager.push_ref(1, False, 'locally_modified')
+        self.manager.push_ref(2, False, 'locally_modified')
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(self.items, [1, 2])
+        self.assertFalse(self.manager.is_active())
+
+    def test_is_active(self):
+        self.manager.push_ref(1, False, 'locally_modified')
+        self.assertEquals(self.manager._get_local_file().id, 1)
+        # Busy while working on its item only
+        self.assertTrue(self.manager.is_active())
+        self.assertIsNone(self.manager._get_local_file())
+        self.assertFalse(self.manager.is_active())
+
+    def test_coalesce_across_queues(self):
+        self.manager.push_ref(1, False, 'locally_modified')
+        self.manager.push_ref(2, False, 'locally_modified')
+        self.manager.push_ref(1, False, 'remotely_modified')
+        self.manager.push_ref(1, False, 'remotely_modified')
+        # Only the last state of the pair is queued
+        self.assertEquals([item.id for item in self.manager.get_local_file_queue()], [2])
+        self.assertEquals([item.id for item in self.manager.get_remote_file_queue()], [1])
+        metrics = self.manager.get_metrics()
+        self.assertEquals(metrics["total_queue"], 2)
+        self.assertEquals(metrics["coalesced_items"], 2)
+
+    def test_cancel_queued_errors(self):
+        doc_pair = QueueItem(1, False, 'locally_modified', '/File.txt')
+        doc_pair.error_count = 1
+        self.manager.push_error(doc_pair)
+        self.assertGreater(doc_pair.error_next_try, 0)
+        self.manager._on_error_timer()
+        self.assertEquals(self.manager.get_overall_size(), 0)
+        # Retried on the next error timer
+        self.manager.cancel_queued_errors()
+        self.assertEquals(doc_pair.error_next_try, 0)
+        self.manager._on_error_timer()
+        self.assertEquals([item.id for item in self.manager.get_local_file_queue()], [1])
+        self.assertEquals(self.manager.get_metrics()["error_queue"], 0)
+
+    def test_new_item_throttle(self):
+        counts = []
+        self.manager.newItem.connect(counts.append)
+        self.manager.NEW_ITEM_INTERVAL = 0.5
+        self.manager.push_ref(1, False, 'locally_modified')
+        self.assertEquals(counts, [1])
+        # The next pushes are signaled together once the interval is elapsed
+        self.manager.push_ref(2, False, 'locally_modified')
+        self.manager.push_ref(3, False, 'remotely_modified')
+        self.manager.push_ref(3, False, 'remotely_modified')
+        self.manager._on_new_items()
+        self.assertEquals(counts, [1])
+        sleep(0.5)
+        self.manager._on_new_items()
+        self.assertEquals(counts, [1, 3])
+        self.assertEquals(self.manager.get_metrics()["new_item_latency"]["count"], 2)
+
+    def test_stop(self):
+        thread = self._start_processor(self.manager._get_file)
+        sleep(0.2)
+        self.engine.stopped = True
+        self.manager.wake_processors()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(self.items, [])
+
+    def test_suspend(self):
+        thread = self._start_processor(self.manager._get_remote_file)
+        sleep(0.2)
+        self.manager.suspend()
+        self.manager.push_ref(1, False, 'remotely_modified')
+        sleep(0.2)
+        # Nothing is processed while suspended
+        self.assertEquals(self.items, [])
+        self.assertTrue(thread.is_alive())
+        self.manager.resume()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(self.items, [1])
+
+    def test_drain(self):
+        processor = Processor(self.engine, self.manager._get_file, persistent=True)
+        processor._continue = True
+        self.manager.push_ref(1, False, 'locally_modified')
+        self.assertEquals(processor._get_next_item().id, 1)
+        # A drained processor ends after its current item, the next ones stay queued
+        processor.drain()
+        self.manager.push_ref(2, False, 'locally_modified')
+        self.assertIsNone(processor._get_next_item())
+        self.assertEquals([item.id for item in self.manager.get_local_file_queue()], [2])
+
+    def test_drain_idle(self):
+        processor = Processor(self.engine, self.manager._get_file, persistent=True)
+        processor._continue = True
+        items = []
+        thread = Thread(target=lambda: items.append(processor._get_next_item()))
+        thread.start()
+        self.threads.append(thread)
+        sleep(0.2)
+        self.assertTrue(thread.is_alive())
+        processor.drain()
+        self.manager.wake_processors()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(items, [None])
@@ -0,0 +1,78 @@
+'''
+Benchmark of the EngineDAO bulk inserts and updates
+
+Usage: python bulk_benchmark.py [children]
+
+Insert then update the remote children of one folder (100k by default),
+one row at a time as the scanners used to and with the executemany based
+insert_remote_states/update_remote_states, and print the rows per second.
+'''
+import os
+import sys
+import shutil
+import tempfile
+from time import time
+from datetime import datetime
+from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+
+PARENT_REF = u'fsitem#default#parent'
+PARENT_PATH = u'/Folder'
+
+
+def get_infos(children, name):
+    now = datetime.utcnow()
+    return [RemoteFileInfo(u'%s %d.txt' % (name, i), u'fsitem#default#%d' % i, PARENT_REF,
+                           u'/' + PARENT_REF + u'/%d' % i, False, now, u'user', u'digest%d' % i, 'md5',
+                           None, True, True, True, False) for i in xrange(children)]
+
+
+def print_rate(label, rows, start):
+    duration = time() - start
+    print "  %-30s %8d rows/s" % (label, rows / duration)
+
+
+def one_by_one(dao, children):
+    infos = get_infos(children, u'File')
+    start = time()
+    with dao.group_commit():
+        for info in infos:
+            dao.insert_remote_state(info, PARENT_PATH, PARENT_PATH + u'/' + info.name, PARENT_PATH)
+    print_rate("insert_remote_state", children, start)
+    rows = dao.get_remote_children(PARENT_REF)
+    infos = get_infos(children, u'Renamed')
+    start = time()
+    with dao.group_commit():
+        for row, info in zip(rows, infos):
+            dao.update_remote_state(row, info, PARENT_PATH)
+    print_rate("update_remote_state", children, start)
+
+
+def bulk(dao, children):
+    infos = get_infos(children, u'File')
+    start = time()
+    with dao.group_commit():
+        dao.insert_remote_states(infos, PARENT_PATH, [PARENT_PATH + u'/' + info.name for info in infos], PARENT_PATH)
+    print_rate("insert_remote_states", children, start)
+    rows = dao.get_remote_children(PARENT_REF)
+    infos = get_infos(children, u'Renamed')
+    start = time()
+    with dao.group_commit():
+        dao.update_remote_states(zip(rows, infos), PARENT_PATH)
+    print_rate("update_remote_states", children, start)
+
+
+def benchmark(children):
+    print "%d children" % children
+    for run in (one_by_one, bulk):
+        folder = tempfile.mkdtemp()
+        try:
+            dao = EngineDAO(os.path.join(folder, 'benchmark.db'))
+            run(dao, children)
+            dao.dispose()
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
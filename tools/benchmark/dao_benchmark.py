@@ -0,0 +1,125 @@
+'''
+Benchmark of the EngineDAO hot queries on big States tables
+
+Usage: python dao_benchmark.py [rows [rows ...]]
+
+For each size a temporary database is filled with a synthetic tree
+(100 items per folder), then every query is timed with and without the
+States indexes and its query plan is printed.
+'''
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+from time import time
+from datetime import datetime
+from nxdrive.engine.dao.sqlite import EngineDAO
+
+FOLDER_SIZE = 100
+ITERATIONS = 20
+
+
+def generate_states(rows):
+    sync_date = datetime.utcnow()
+    folders = max(1, rows / FOLDER_SIZE)
+    for i in xrange(rows):
+        folder = i % folders
+        folderish = int(i < folders)
+        if folderish:
+            parent = folder / FOLDER_SIZE
+            parent_path = u'/Folder %d' % parent if folder >= FOLDER_SIZE else u''
+            name = u'Folder %d' % folder
+        else:
+            parent = folder
+            parent_path = u'/Folder %d' % folder
+            name = u'File %d.txt' % i
+        pair_state = 'synchronized' if i % 50 else 'locally_modified'
+        error_count = 4 if i % 1000 == 0 else 0
+        yield (parent_path + u'/' + name, parent_path, name, u'fsitem#default#%d' % i,
+               u'fsitem#default#%d' % parent, u'/org.nuxeo.drive/%d' % parent,
+               name, 'digest%d' % (i % (rows / 2 + 1)), folderish, i % 4096, pair_state,
+               error_count, sync_date)
+
+
+def fill_dao(dao, rows):
+    con = dao._get_write_connection()
+    con.executemany("INSERT INTO States(local_path, local_parent_path, local_name, remote_ref, remote_parent_ref,"
+                    " remote_parent_path, remote_name, remote_digest, folderish, size, pair_state, error_count,"
+                    " last_sync_date, local_state, remote_state)"
+                    " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,'synchronized','synchronized')", generate_states(rows))
+    con.commit()
+
+
+class FolderPair(object):
+    folderish = 1
+
+    def __init__(self, local_path):
+        self.local_path = local_path
+
+
+def get_queries(dao, rows):
+    folder = max(1, rows / FOLDER_SIZE) / 2
+    path = u'/Folder %d' % folder
+    return [
+        ("get_state_from_local", "SELECT * FROM States WHERE local_path=?", (path + u'/File %d.txt' % (folder + FOLDER_SIZE),)),
+        ("get_local_children", "SELECT * FROM States WHERE local_parent_path=?", (path,)),
+        ("get_remote_children", "SELECT * FROM States WHERE remote_parent_ref=?", (u'fsitem#default#%d' % folder,)),
+        ("get_states_from_remote", "SELECT * FROM States WHERE remote_ref=?", (u'fsitem#default#%d' % folder,)),
+        ("get_valid_duplicate_file", "SELECT * FROM States WHERE remote_digest=? AND pair_state='synchronized'",
+            ('digest%d' % folder,)),
+        ("get_errors", "SELECT * FROM States WHERE error_count>?", (3,)),
+        ("get_last_files", "SELECT * FROM States WHERE pair_state='synchronized' AND folderish=0"
+            " ORDER BY last_sync_date DESC LIMIT 10", ()),
+        ("get_states_from_partial_local", "SELECT * FROM States WHERE local_path >= ? AND local_path < ?",
+            (path + u'/', path + u'0')),
+        ("recursive_condition", "SELECT COUNT(*) FROM States" + dao._get_recursive_condition(FolderPair(path)),
+            dao._get_recursive_params(FolderPair(path))),
+    ]
+
+
+def run_queries(con, queries, label):
+    print "  %s" % label
+    for name, query, params in queries:
+        plan = con.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+        start = time()
+        for _ in xrange(ITERATIONS):
+            con.execute(query, params).fetchall()
+        duration = (time() - start) * 1000 / ITERATIONS
+        print "    %-32s %10.3fms  %s" % (name, duration, ' | '.join([str(row[-1]) for row in plan]))
+
+
+def drop_indexes(con):
+    indexes = con.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='States'"
+                          " AND sql IS NOT NULL").fetchall()
+    for index in indexes:
+        con.execute("DROP INDEX " + index[0])
+    con.commit()
+
+
+def benchmark(rows):
+    folder = tempfile.mkdtemp()
+    try:
+        dao = EngineDAO(os.path.join(folder, 'benchmark.db'))
+        start = time()
+        fill_dao(dao, rows)
+        print "%d rows inserted in %dms" % (rows, (time() - start) * 1000)
+        queries = get_queries(dao, rows)
+        dao.dispose()
+        # Use a new connection for each run to avoid cached query plans
+        con = sqlite3.connect(os.path.join(folder, 'benchmark.db'))
+        con.execute("ANALYZE")
+        run_queries(con, queries, "with indexes")
+        drop_indexes(con)
+        con.close()
+        con = sqlite3.connect(os.path.join(folder, 'benchmark.db'))
+        run_queries(con, queries, "without indexes")
+        con.close()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    for size in sizes:
+        benchmark(size)
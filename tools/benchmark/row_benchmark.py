@@ -0,0 +1,88 @@
+'''
+Micro-benchmark of the States row objects
+
+Usage: python row_benchmark.py [rows]
+
+Load the rows as register_queue_manager does, with the former
+sqlite3.Row based StateRow and with the slot based one, then compare
+the loading time, the attribute access time and the memory used per row
+by the row object itself (the column values are shared by both).
+'''
+import os
+import sys
+import gc
+import shutil
+import sqlite3
+import tempfile
+from time import time
+from nxdrive.engine.dao.sqlite import EngineDAO, StateRow
+from dao_benchmark import fill_dao
+
+ATTRIBUTES = ['id', 'local_path', 'local_parent_path', 'remote_ref', 'folderish', 'pair_state']
+
+
+class LegacyRow(sqlite3.Row):
+    # StateRow as it was before the slot based rows
+
+    def __init__(self, arg1, arg2):
+        super(LegacyRow, self).__init__(arg1, arg2)
+        self._custom = dict()
+
+    def __getattr__(self, name):
+        if name in self._custom:
+            return self._custom[name]
+        return self[name]
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            super(LegacyRow, self).__setattr__(name, value)
+        else:
+            self._custom[name] = value
+
+
+def get_row_size(row):
+    if isinstance(row, LegacyRow):
+        # The row keeps a tuple of the values and a dict for the custom attributes
+        return sys.getsizeof(row) + sys.getsizeof(tuple(row)) + sys.getsizeof(row._custom)
+    return sys.getsizeof(row)
+
+
+def load(db, factory):
+    con = sqlite3.connect(db)
+    con.row_factory = factory
+    gc.collect()
+    start = time()
+    rows = con.execute("SELECT * FROM States WHERE pair_state != 'synchronized'"
+                       " AND pair_state != 'unsynchronized'").fetchall()
+    load_time = time() - start
+    start = time()
+    for row in rows:
+        for name in ATTRIBUTES:
+            getattr(row, name)
+    access_time = time() - start
+    size = get_row_size(rows[0])
+    con.close()
+    return len(rows), load_time, access_time, size
+
+
+def benchmark(rows):
+    folder = tempfile.mkdtemp()
+    try:
+        db = os.path.join(folder, 'benchmark.db')
+        dao = EngineDAO(db)
+        fill_dao(dao, rows)
+        # Queue every row as a full resynchronization would
+        con = dao._get_write_connection()
+        con.execute("UPDATE States SET pair_state='locally_modified'")
+        con.commit()
+        dao.dispose()
+        for label, factory in (("sqlite3.Row", LegacyRow), ("slots", StateRow)):
+            count, load_time, access_time, size = load(db, factory)
+            print "  %-12s %d rows loaded in %dms, %d attributes read in %dms, %d bytes per row" % (
+                label, count, load_time * 1000, count * len(ATTRIBUTES), access_time * 1000, size)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
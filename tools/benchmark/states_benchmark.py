@@ -0,0 +1,75 @@
+'''
+Benchmark of the full local scan with the error details in States or in StatesErrors
+
+Usage: python states_benchmark.py [rows]
+
+Fill a database (1M rows by default) where one row out of ERROR_RATIO has
+an error stack trace, once with the details inline in the States rows as
+before the schema version 6 and once in the StatesErrors side table. Then
+read every folder children as the local watcher full scan does, and print
+the pages of the States table touched and the scan time.
+'''
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+from time import time
+from nxdrive.engine.dao.sqlite import EngineDAO
+from dao_benchmark import fill_dao
+
+ERROR_RATIO = 10
+DETAILS = u'Traceback (most recent call last):\n' + u'  File "nxdrive/engine/processor.py", line 42, in _execute\n' * 40
+
+
+def add_errors(con, inline):
+    if inline:
+        con.execute("ALTER TABLE States ADD COLUMN last_error_details TEXT")
+        con.execute("UPDATE States SET last_error_details=? WHERE id % ? = 0", (DETAILS, ERROR_RATIO))
+    else:
+        con.execute("INSERT INTO StatesErrors(id, last_error_details) SELECT id, ? FROM States WHERE id % ? = 0",
+                    (DETAILS, ERROR_RATIO))
+    con.commit()
+
+
+def get_pages(con):
+    # Leaf and overflow pages holding the States rows
+    return con.execute("SELECT COUNT(*) FROM dbstat WHERE name='States'").fetchone()[0]
+
+
+def scan(con):
+    folders = [row[0] for row in con.execute("SELECT DISTINCT local_parent_path FROM States").fetchall()]
+    start = time()
+    rows = 0
+    for folder in folders:
+        rows += len(con.execute("SELECT * FROM States WHERE local_parent_path=?", (folder,)).fetchall())
+    return rows, time() - start
+
+
+def benchmark(rows):
+    print "%d rows, 1 out of %d with error details" % (rows, ERROR_RATIO)
+    for label, inline in (("inline details", True), ("StatesErrors", False)):
+        folder = tempfile.mkdtemp()
+        try:
+            db = os.path.join(folder, 'benchmark.db')
+            dao = EngineDAO(db)
+            fill_dao(dao, rows)
+            dao.dispose()
+            con = sqlite3.connect(db)
+            add_errors(con, inline)
+            try:
+                pages = get_pages(con)
+            except sqlite3.OperationalError:
+                # sqlite built without the dbstat table
+                pages = con.execute("PRAGMA page_count").fetchone()[0]
+            con.close()
+            con = sqlite3.connect(db)
+            count, duration = scan(con)
+            con.close()
+            print "  %-16s %8d States pages, %d rows scanned in %dms" % (label, pages, count, duration * 1000)
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)